@@ -0,0 +1,263 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Editing many documents at once, without the GUI.
+
+Documents are edited through the same models as in the GUI, and saved the same
+way. Every document is processed in a separate worker process.
+'''
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import locale
+import multiprocessing
+import sys
+
+import djvu.const
+import djvu.decode
+import djvu.sexpr
+
+from djvusmooth import djvused
+from djvusmooth import indirect
+from djvusmooth import models
+from djvusmooth import safesave
+from djvusmooth.document import AnnotationsModel, MetadataModel, OutlineModel, TextModel
+
+ZONE_TYPES = (
+    djvu.const.TEXT_ZONE_PAGE,
+    djvu.const.TEXT_ZONE_COLUMN,
+    djvu.const.TEXT_ZONE_REGION,
+    djvu.const.TEXT_ZONE_PARAGRAPH,
+    djvu.const.TEXT_ZONE_LINE,
+    djvu.const.TEXT_ZONE_WORD,
+    djvu.const.TEXT_ZONE_CHARACTER,
+)
+
+system_encoding = locale.getpreferredencoding()
+
+class Operations(object):
+
+    '''
+    Changes to be made in every document.
+
+    flatten is the name of the zone type (e.g. 'line'): zones of this type and
+    below are removed from the text.
+
+    metadata is a list of (key, value) pairs for the shared metadata; the key
+    is removed if value is None.
+
+    outline is a list of lines of the outline in the plain-text format, as
+    used for editing it in an external editor.
+    '''
+
+    def __init__(self):
+        self.flatten = None
+        self.remove_text = False
+        self.metadata = []
+        self.outline = None
+        self.remove_outline = False
+        self.remove_mapareas = False
+
+    def __nonzero__(self):
+        return bool(
+            self.flatten is not None or
+            self.remove_text or
+            self.metadata or
+            self.outline is not None or
+            self.remove_outline or
+            self.remove_mapareas
+        )
+
+def _edit_text(document, operations):
+    text_model = TextModel(document)
+    page_nos = range(len(document.pages))
+    if operations.remove_text:
+        pages = ((n, None) for n, sexpr in text_model.iter_page_texts(page_nos) if sexpr)
+    else:
+        zone = djvu.const.get_text_zone_type(djvu.sexpr.Symbol(operations.flatten))
+        pages = text_model.iter_stripped_pages(page_nos, zone)
+    text_model.set_serialized_pages(pages)
+    return text_model
+
+def _edit_metadata(document, operations):
+    metadata_model = MetadataModel(document)
+    metadata = metadata_model[models.SHARED_ANNOTATIONS_PAGENO]
+    for key, value in operations.metadata:
+        if value is None:
+            if key in metadata:
+                del metadata[key]
+        elif metadata.get(key) != value:
+            metadata[key] = value
+    return metadata_model
+
+def _edit_outline(document, operations):
+    outline_model = OutlineModel(document)
+    if operations.outline is not None:
+        outline_model.import_plaintext(operations.outline)
+    elif len(outline_model.root):
+        outline_model.remove()
+    return outline_model
+
+def _edit_annotations(path, document, operations):
+    annotations_model = AnnotationsModel(path)
+    for n in xrange(len(document.pages)):
+        page = annotations_model[n]
+        for node in list(page.mapareas):
+            page.remove_maparea(node)
+    return annotations_model
+
+def process_document(path, operations):
+    '''
+    Make the changes in the document, and save it.
+
+    Return True if the document has been modified.
+    '''
+    context = djvu.decode.Context()
+    document = context.new_document(djvu.decode.FileURI(path))
+    document.decoding_job.wait()
+    if document.decoding_job.is_error:
+        raise djvused.IOError('Cannot open the document')
+    document_models = []
+    if operations.flatten is not None or operations.remove_text:
+        document_models += _edit_text(document, operations),
+    if operations.metadata:
+        document_models += _edit_metadata(document, operations),
+    if operations.outline is not None or operations.remove_outline:
+        document_models += _edit_outline(document, operations),
+    if operations.remove_mapareas:
+        document_models += _edit_annotations(path, document, operations),
+    snapshots = [snapshot for model in document_models for snapshot in model.take_snapshot()]
+    if not snapshots:
+        return False
+    # Export everything for a page at once, so that djvused commands for the
+    # page can be coalesced.
+    snapshots.sort(key=lambda snapshot: snapshot.n)
+    npages = len(set(snapshot.n for snapshot in snapshots))
+    try:
+        component_paths = indirect.get_component_paths(document, path)
+    except djvu.decode.NotAvailable:
+        component_paths = None
+    document_type = document.type
+    page_count = len(document.pages)
+    if component_paths is not None:
+        components, index_snapshots = indirect.split_snapshots(snapshots, component_paths)
+        # Components are saved by the worker's own djvused processes, one at
+        # a time, as documents are already processed in parallel.
+        indirect.save(path, page_count, components, index_snapshots, nworkers=1)
+    else:
+        safesave.save(path, document_type, page_count, snapshots, npages=npages)
+    return True
+
+def _process_document(args):
+    path, operations = args
+    try:
+        modified = process_document(path, operations)
+    except Exception as exception:
+        # Not every exception can be passed back from the worker.
+        return path, None, str(exception) or type(exception).__name__
+    return path, modified, None
+
+def process_documents(paths, operations, jobs=None):
+    '''
+    Process the documents in parallel, in jobs worker processes (by default,
+    as many as there are CPUs).
+
+    Yield (path, modified, error) tuples, in the order in which the documents
+    are done. modified is None if the document could not be processed, and
+    error is the error message then.
+    '''
+    # Find djvused beforehand, so that every worker doesn't have to.
+    djvused.discover()
+    tasks = [(path, operations) for path in paths]
+    if jobs == 1:
+        for task in tasks:
+            yield _process_document(task)
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(_process_document, tasks):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def _parse_set_metadata(s):
+    key, equals, value = s.partition('=')
+    if not key or not equals:
+        raise argparse.ArgumentTypeError('expected KEY=VALUE: {0!r}'.format(s))
+    return key, value.decode(system_encoding)
+
+def _parse_remove_metadata(s):
+    return s, None
+
+def _parse_jobs(s):
+    n = int(s)
+    if n < 1:
+        raise argparse.ArgumentTypeError('expected a positive number: {0!r}'.format(s))
+    return n
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog='djvusmooth-batch', description='Edit DjVu documents in batch.')
+    ag = ap.add_mutually_exclusive_group()
+    ag.add_argument('--flatten', metavar='ZONE', choices=[str(zone) for zone in ZONE_TYPES],
+        help='remove text zones of this type (one of: %(choices)s) and below')
+    ag.add_argument('--remove-text', action='store_true', help='remove the text layer')
+    ap.add_argument('--set-metadata', dest='metadata', metavar='KEY=VALUE', action='append', type=_parse_set_metadata, default=[],
+        help='set the document metadata key')
+    ap.add_argument('--remove-metadata', dest='metadata', metavar='KEY', action='append', type=_parse_remove_metadata,
+        help='remove the document metadata key')
+    ag = ap.add_mutually_exclusive_group()
+    ag.add_argument('--import-outline', metavar='FILE', type=argparse.FileType('r'),
+        help='replace the outline with the one in FILE, in the plain-text format used for external editing')
+    ag.add_argument('--remove-outline', action='store_true', help='remove the outline')
+    ap.add_argument('--remove-mapareas', action='store_true', help='remove hyperlinks and other map areas from every page')
+    ap.add_argument('-j', '--jobs', metavar='N', type=_parse_jobs,
+        help='number of documents processed in parallel (default: number of CPUs)')
+    ap.add_argument('-v', '--verbose', action='store_true', help='report every document')
+    ap.add_argument('files', metavar='FILE', nargs='+')
+    options = ap.parse_args(argv)
+    operations = Operations()
+    operations.flatten = options.flatten
+    operations.remove_text = options.remove_text
+    operations.metadata = options.metadata
+    if options.import_outline is not None:
+        with options.import_outline as file:
+            operations.outline = map(str.expandtabs, itertools.imap(str.rstrip, file))
+    operations.remove_outline = options.remove_outline
+    operations.remove_mapareas = options.remove_mapareas
+    if not operations:
+        ap.error('nothing to do')
+    status = 0
+    try:
+        for path, modified, error in process_documents(options.files, operations, jobs=options.jobs):
+            if error is not None:
+                print('{prog}: {path}: {error}'.format(prog=ap.prog, path=path, error=error), file=sys.stderr)
+                status = 1
+            elif options.verbose:
+                print('{path}: {status}'.format(path=path, status=('saved' if modified else 'unchanged')))
+    except IOError as exception:
+        print('{prog}: {error}'.format(prog=ap.prog, error=exception), file=sys.stderr)
+        return 1
+    return status
+
+__all__ = ['Operations', 'process_document', 'process_documents', 'main']
+
+# vim:ts=4 sts=4 sw=4 et
@@ -13,120 +13,338 @@
 # FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
 # more details.
 
+import collections
+import itertools
 import os.path
+import re
 import threading
 
 from djvu.sexpr import Expression, Symbol
 
 from . import ipc
 
+# Set by discover():
 djvused_path = None
-if os.name == 'nt':
-    from . import dependencies
-    djvused_path = os.path.join(dependencies.djvulibre_path, 'djvused.exe')
-else:
-    from . import pkgconfig
-    try:
-        djvulibre_bin_path = os.path.join(pkgconfig.Package('ddjvuapi').variable('exec_prefix'), 'bin')
-    except (IOError, OSError):
-        pass
-    else:
-        djvused_path = os.path.join(djvulibre_bin_path, 'djvused')
-if djvused_path is None or not os.path.isfile(djvused_path):
-    # Let's hope it's within $PATH...
-    djvused_path = 'djvused'
+djvused_version = None
+
+_discovery_lock = threading.Lock()
+_usable = None
+_config_entries = None
 
-def _djvused_usability_check():
+def _find_djvused():
+    path = None
+    if os.name == 'nt':
+        from . import dependencies
+        path = os.path.join(dependencies.djvulibre_path, 'djvused.exe')
+    else:
+        from . import pkgconfig
+        try:
+            djvulibre_bin_path = os.path.join(pkgconfig.Package('ddjvuapi').variable('exec_prefix'), 'bin')
+        except EnvironmentError:
+            pass
+        else:
+            path = os.path.join(djvulibre_bin_path, 'djvused')
+    if path is None or not os.path.isfile(path):
+        # Let's hope it's within $PATH...
+        path = 'djvused'
+    return path
+
+def _which(path):
+    '''
+    Return absolute path of the executable, or None if it can't be found.
+    '''
+    if os.path.dirname(path):
+        return os.path.abspath(path)
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        full_path = os.path.join(directory, path)
+        if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
+            return os.path.abspath(full_path)
+
+def _get_cache_key(path):
+    stat = os.stat(path)
+    return '{mtime!r} {size}'.format(mtime=stat.st_mtime, size=int(stat.st_size))
+
+def _djvused_usability_check(path):
+    '''
+    Return version of djvused, or raise IOError if it's not usable.
+    '''
     try:
         djvused = ipc.Subprocess(
-            [djvused_path],
+            [path],
             stdout=ipc.PIPE,
             stderr=ipc.PIPE
         )
-        djvused.communicate()
+        stdout, stderr = djvused.communicate()
         if djvused.returncode == 10:
-            return
-    except (IOError, OSError):
+            match = re.search(r'DjVuLibre-([0-9][0-9.]*[0-9])', stdout + stderr)
+            return match.group(1) if match else ''
+    except EnvironmentError:
         pass
-    raise IOError('{path!r} does not seem to be usable'.format(path=djvused_path))
+    raise IOError('{path!r} does not seem to be usable'.format(path=path))
+
+def _discover(config):
+    global djvused_path, djvused_version, _config_entries
+    if config is not None:
+        path = config.read('djvused_path', '').encode('UTF-8')
+        try:
+            cache_hit = (
+                path and
+                config.read_bool('djvused_usable', False) and
+                config.read('djvused_key', '') == _get_cache_key(path)
+            )
+        except OSError:
+            cache_hit = False
+        if cache_hit:
+            djvused_path = path
+            djvused_version = str(config.read('djvused_version', ''))
+            return
+    path = _find_djvused()
+    full_path = _which(path)
+    djvused_version = _djvused_usability_check(full_path or path)
+    djvused_path = full_path or path
+    if full_path is not None:
+        _config_entries = dict(
+            djvused_path=full_path,
+            djvused_key=_get_cache_key(full_path),
+            djvused_version=djvused_version,
+            djvused_usable=1,
+        )
 
-_djvused_usability_check()
+def discover(config=None):
+    '''
+    Find djvused and check that it's usable; return its path, or raise IOError.
+
+    Only the first call does anything. If the config (a
+    djvusmooth.config.Config object) is not None, the results cached in it by
+    remember() are used, as long as the path, modification time and size of
+    the binary match; so neither pkg-config nor djvused have to be run.
+
+    The config is only read, so this can be run in a background thread.
+    '''
+    global _usable
+    with _discovery_lock:
+        if _usable is None:
+            try:
+                _discover(config)
+            except IOError as exception:
+                _usable = exception
+            else:
+                _usable = True
+    if _usable is not True:
+        raise _usable
+    return djvused_path
+
+def remember(config):
+    '''
+    Cache the results of discover() in the config, unless they have been read
+    from it. Call this from the thread that owns the config.
+    '''
+    if _usable is not True or _config_entries is None:
+        return
+    for key, value in sorted(_config_entries.iteritems()):
+        config[key] = value
 
 class IOError(IOError):
     pass
 
+class CommitCancelled(Exception):
+    pass
+
+_PAGE_COUNT_COMMAND = 'n'
+
+# Command that prints a single line (the number of pages), which marks that
+# the preceding commands have been executed. Markers can't be told apart from
+# output of other commands, so commands that print anything are not allowed
+# when markers are used.
+_MARKER_COMMAND = _PAGE_COUNT_COMMAND
+
+_SHARED_ANNOTATIONS_KEY = (0,)
+
+class _PagePlan(object):
+
+    '''
+    Commands for a single page (or for the whole document, if select_command
+    is None), by kind. A command replaces the earlier command of the same kind;
+    e.g. remove-txt replaces set-txt.
+    '''
+
+    def __init__(self, select_command=None):
+        self.select_command = select_command
+        self.commands = collections.OrderedDict()
+
+    def add(self, kind, commands):
+        self.commands.pop(kind, None)
+        self.commands[kind] = commands
+
+    def get_script(self):
+        if not self.commands:
+            return []
+        script = []
+        if self.select_command is not None:
+            script += self.select_command,
+        for commands in self.commands.itervalues():
+            script += commands
+        return script
+
 class StreamEditor(object):
 
+    '''
+    Commands that modify a page are coalesced: the page is selected only once,
+    and only the last command of every kind (text, annotations, metadata, page
+    title) is executed. Pages are modified in the page order, and the
+    document-wide commands (outline, thumbnails) are executed after them,
+    but before any command that can't be coalesced.
+
+    Scripts that contain any other commands are executed as they are.
+    '''
+
     def __init__(self, file_name, autosave=False):
         self._file_name = file_name
-        self._commands = []
         self._autosave = autosave
+        self._process = None
+        self._reset()
+
+    def _reset(self):
+        self._commands = []
+        self._page_starts = []
+        self._plans = {}
+        self._document_plan = _PagePlan()
+        self._key = None
+        self._coalesce = True
+        self._printing = False
 
     def clone(self):
         return StreamEditor(self._filename, self._autosave)
 
-    def _add(self, *commands):
+    def _check(self, commands):
         for command in commands:
             if not isinstance(command, str):
                 raise TypeError
-        self._commands += commands
+
+    def _add(self, *commands):
+        '''
+        Add commands that can't be coalesced.
+        '''
+        self._check(commands)
+        if self._process is None:
+            self._commands += commands
+            self._coalesce = False
+            return
+        plan = self._plans.get(self._key)
+        if plan is not None:
+            # Execute whatever is pending for the selected page, including the
+            # select command, so that the new commands apply to that page.
+            script = plan.get_script()
+            if not script and plan.select_command is not None:
+                script = [plan.select_command]
+            self._write(script)
+            plan.commands.clear()
+            plan.select_command = None
+        # The new commands might depend on the document-wide changes, e.g.
+        # save-bundled.
+        self._write(self._document_plan.get_script())
+        self._document_plan.commands.clear()
+        self._write(commands)
+
+    def _add_printing(self, command):
+        '''
+        Add a command that prints something.
+        '''
+        if self._process is not None and self._progress is not None:
+            raise ValueError('{0!r} cannot be used while reporting progress'.format(command))
+        self._printing = True
+        self._add(command)
+
+    def _select(self, key, command):
+        if self._process is None:
+            self._page_starts += len(self._commands),
+            self._commands += command,
+        elif key != self._key:
+            self._flush_plan(self._key)
+        plan = self._plans.get(key)
+        if plan is None:
+            self._plans[key] = _PagePlan(command)
+        elif command == 'create-shared-ant':
+            plan.select_command = command
+        self._key = key
+
+    def _set(self, kind, *commands):
+        self._check(commands)
+        if self._key is None:
+            # No page is selected, so the commands would apply to all pages.
+            self._add(*commands)
+            return
+        if self._process is None:
+            self._commands += commands
+        self._plans[self._key].add(kind, commands)
+
+    def _set_document(self, kind, *commands):
+        self._check(commands)
+        if self._process is None:
+            self._commands += commands
+        self._document_plan.add(kind, commands)
 
     def select_all(self):
         self._add('select')
+        self._key = None
 
     def select(self, page_id):
-        self._add('select %s' % page_id)
+        self._select((1, page_id), 'select %s' % page_id)
 
     def select_shared_annotations(self):
-        self._add('select-shared-ant')
+        self._select(_SHARED_ANNOTATIONS_KEY, 'select-shared-ant')
 
     def create_shared_annotations(self):
-        self._add('create-shared-ant')
+        self._select(_SHARED_ANNOTATIONS_KEY, 'create-shared-ant')
 
     def set_annotations(self, annotations):
-        self._add('set-ant')
-        for annotation in annotations:
-            self._add(str(annotation))
-        self._add('.')
+        self._set('ant', 'set-ant', *([str(annotation) for annotation in annotations] + ['.']))
 
     def remove_annotations(self):
-        self._add('remove-ant')
+        self._set('ant', 'remove-ant')
 
     def print_annotations(self):
-        self._add('print-ant')
+        self._add_printing('print-ant')
 
     def set_metadata(self, meta):
-        self._add('set-meta')
+        commands = ['set-meta']
         for key, value in meta.iteritems():
             value = unicode(value)
-            self._add('%s\t%s' % (Expression(Symbol(key)), Expression(value)))
-        self._add('.')
+            commands += '%s\t%s' % (Expression(Symbol(key)), Expression(value)),
+        commands += '.',
+        self._set('meta', *commands)
 
     def remove_metadata(self):
-        self._add('remove-meta')
+        self._set('meta', 'remove-meta')
 
     def set_text(self, text):
         if text is None:
             self.remove_text()
         else:
-            self._add('set-txt', str(text), '.')
+            self._set('txt', 'set-txt', str(text), '.')
 
     def remove_text(self):
-        self._add('remove-txt')
+        self._set('txt', 'remove-txt')
+
+    def print_text(self):
+        self._add_printing('print-txt')
+
+    def print_page_count(self):
+        self._add_printing(_PAGE_COUNT_COMMAND)
 
     def set_outline(self, outline):
         if outline is None:
             outline = ''
-        self._add('set-outline', str(outline), '.')
+        self._set_document('outline', 'set-outline', str(outline), '.')
 
     def set_thumbnails(self, size):
-        self._add('set-thumbnails %d' % size)
+        self._set_document('thumbnails', 'set-thumbnails %d' % size)
 
     def remove_thumbnails(self):
-        self._add('remove-thumbnails')
+        self._set_document('thumbnails', 'remove-thumbnails')
 
     def set_page_title(self, title):
-        self._add('set-page-title %s' % Expression(title))
+        self._set('page-title', 'set-page-title %s' % Expression(title))
 
     def save_page(self, file_name, include=False):
         command = 'save-page'
@@ -135,10 +353,10 @@ class StreamEditor(object):
         self._add('%s %s' % command, file_name)
 
     def save_as_bundled(self, file_name):
-        self._add('save-bundled %s' % file_name)
+        self._add('save-bundled %s' % Expression(file_name))
 
     def save_as_indirect(self, file_name):
-        self._add('save-indirect %s' % file_name)
+        self._add('save-indirect %s' % Expression(file_name))
 
     def save(self):
         self._add('save')
@@ -147,7 +365,7 @@ class StreamEditor(object):
         result[0] = fo.read()
 
     def _execute(self, commands, save=False):
-        args = [djvused_path]
+        args = [discover()]
         if save:
             args += '-s',
         args += self._file_name,
@@ -173,10 +391,176 @@ class StreamEditor(object):
         reader_thread.join()
         return result[0]
 
-    def commit(self):
+    def _get_batches(self):
+        '''
+        Split the script into batches, one for every modified page.
+        '''
+        if not self._coalesce:
+            if not self._commands:
+                return []
+            starts = [i for i in self._page_starts if i > 0]
+            return [
+                self._commands[i:j]
+                for i, j in zip([0] + starts, starts + [len(self._commands)])
+            ]
+        plans = [plan for key, plan in sorted(self._plans.iteritems())]
+        plans += self._document_plan,
+        batches = (plan.get_script() for plan in plans)
+        return [batch for batch in batches if batch]
+
+    def _progress_thread(self, process, progress, npages):
+        for line in iter(process.stdout.readline, ''):
+            self._done += 1
+            if not progress(self._done, max(npages, self._done) + 1):
+                with self._lock:
+                    if self._closing and self._done >= self._markers:
+                        # Too late, the document is being saved.
+                        continue
+                    self._cancelled = True
+                    process.kill()
+                    return
+
+    def start(self, progress=None, npages=0):
+        '''
+        Start djvused. From now on, commands for a page are written to it as
+        soon as another page is selected, rather than kept until commit(), so
+        that they don't pile up in memory. Commands for a page can be coalesced
+        only until then, so select every page only once, in the page order.
+
+        If progress is not None, progress(done, total) is called whenever
+        commands for another page have been executed. The total is npages plus
+        the final step, saving the document. If progress returns false,
+        djvused is killed before it saves anything, and CommitCancelled is
+        raised by a subsequent command or by commit(). Commands that print
+        something (e.g. print_text()) can't be used then; ValueError is raised
+        for them.
+        '''
+        args = [discover()]
+        if self._autosave:
+            args += '-s',
+        args += self._file_name,
+        if progress is not None and self._printing:
+            raise ValueError('commands that print something cannot be used while reporting progress')
+        batches = self._get_batches()
+        self._reset()
+        self._process = ipc.Subprocess(args,
+            stdin=ipc.PIPE,
+            stdout=ipc.PIPE,
+            stderr=ipc.PIPE
+        )
+        self._progress = progress
+        self._npages = npages
+        self._done = self._markers = 0
+        self._unmarked = False
+        self._lock = threading.Lock()
+        self._cancelled = self._closing = False
+        self._output = [None]
+        if progress is None:
+            target = self._reader_thread
+            args = self._process.stdout, self._output
+        else:
+            target = self._progress_thread
+            args = self._process, progress, npages
+        self._stdout_thread = threading.Thread(target=target, args=args)
+        self._stdout_thread.setDaemon(True)
+        self._stdout_thread.start()
+        for batch in batches:
+            self._write(batch)
+            self._write_marker()
+
+    def _flush_plan(self, key):
+        plan = self._plans.pop(key, None)
+        if plan is None:
+            return
+        self._write(plan.get_script())
+        self._write_marker()
+
+    def _write(self, commands):
+        if not commands:
+            return
+        try:
+            stdin = self._process.stdin
+            for command in commands:
+                stdin.write(command + '\n')
+        except EnvironmentError:
+            # djvused has exited prematurely.
+            self._abort()
+        self._unmarked = True
+
+    def _write_marker(self):
+        if self._progress is None or not self._unmarked:
+            return
+        self._write([_MARKER_COMMAND])
+        self._markers += 1
+        self._unmarked = False
+        try:
+            self._process.stdin.flush()
+        except EnvironmentError:
+            self._abort()
+
+    def _abort(self):
+        process = self._process
+        self._process = None
+        self._reset()
+        process.wait()
+        self._stdout_thread.join()
+        if self._cancelled:
+            raise CommitCancelled
+        raise IOError(process.stderr.readline().lstrip('* '))
+
+    def cancel(self):
+        '''
+        Kill djvused started by start(), so that nothing is saved.
+        '''
+        process = self._process
+        if process is None:
+            return
+        self._process = None
+        self._reset()
+        process.kill()
+        process.wait()
+        self._stdout_thread.join()
+
+    def _finish(self):
+        self._flush_plan(self._key)
+        self._write(self._document_plan.get_script())
+        self._write_marker()
+        self._reset()
+        with self._lock:
+            self._closing = True
+        process = self._process
+        self._process = None
         try:
-            return self._execute(self._commands, save=self._autosave)
-        finally:
-            self._commands = []
+            process.stdin.close()
+        except EnvironmentError:
+            pass
+        process.wait()
+        self._stdout_thread.join()
+        if self._cancelled:
+            raise CommitCancelled
+        if process.returncode:
+            raise IOError(process.stderr.readline().lstrip('* '))
+        if self._progress is not None:
+            total = max(self._npages, self._done) + 1
+            self._progress(total, total)
+        return self._output[0]
+
+    def commit(self, progress=None):
+        '''
+        Execute the commands, and return their output.
+
+        If progress is not None, commands are streamed to djvused page by
+        page, as if start() was called with it. Execution can be cancelled
+        until djvused has executed all the commands.
+        '''
+        if self._process is None and progress is None:
+            try:
+                script = itertools.chain(*self._get_batches())
+                return self._execute(script, save=self._autosave)
+            finally:
+                self._reset()
+        if self._process is None:
+            self.start(progress, npages=len(self._get_batches()))
+        return self._finish()
 
 # vim:ts=4 sts=4 sw=4 et
@@ -0,0 +1,129 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Models backed by a DjVu document.
+
+Nothing here depends on wx, so that documents can be edited without the GUI.
+'''
+
+import threading
+
+import djvu.decode
+import djvu.sexpr
+
+from djvusmooth.djvused import StreamEditor
+import djvusmooth.models.annotations
+import djvusmooth.models.metadata
+import djvusmooth.models.outline
+import djvusmooth.models.text
+from djvusmooth import models
+
+# Held while the document file is being replaced or reopened, and while models
+# read data from it.
+document_lock = threading.RLock()
+
+class TextModel(models.text.Text):
+
+    def __init__(self, document):
+        models.text.Text.__init__(self)
+        self._document = document
+
+    def reset_document(self, document):
+        self._document = document
+
+    def acquire_data(self, n):
+        with document_lock:
+            text = self._document.pages[n].text
+            text.wait()
+            return text.sexpr
+
+    def prefetch_data(self, n):
+        try:
+            self._document.pages[n].text.sexpr
+        except djvu.decode.NotAvailable:
+            pass
+
+class OutlineModel(models.outline.Outline):
+
+    def __init__(self, document):
+        self._document = document
+        models.outline.Outline.__init__(self)
+
+    def reset_document(self, document):
+        self._document = document
+
+    def acquire_data(self):
+        with document_lock:
+            outline = self._document.outline
+            outline.wait()
+            return outline.sexpr
+
+class AnnotationsModel(models.annotations.Annotations):
+
+    def __init__(self, document_path):
+        models.annotations.Annotations.__init__(self)
+        self.__djvused = StreamEditor(document_path)
+
+    def reset_document(self, document):
+        pass  # Nothing to do
+
+    def acquire_data(self, n):
+        djvused = self.__djvused
+        if n == models.SHARED_ANNOTATIONS_PAGENO:
+            djvused.select_shared_annotations()
+        else:
+            djvused.select(n + 1)
+        djvused.print_annotations()
+        with document_lock:
+            s = '(%s)' % djvused.commit()  # FIXME: optimize
+        try:
+            return djvu.sexpr.Expression.from_string(s)
+        except djvu.sexpr.ExpressionSyntaxError:
+            raise  # FIXME
+
+class MetadataModel(models.metadata.Metadata):
+
+    def __init__(self, document):
+        models.metadata.Metadata.__init__(self)
+        self._document = document
+
+    def reset_document(self, document):
+        self._document = document
+
+    def acquire_data(self, n):
+        with document_lock:
+            document_annotations = self._document.annotations
+            document_annotations.wait()
+            document_metadata = document_annotations.metadata
+            if n == models.SHARED_ANNOTATIONS_PAGENO:
+                return document_metadata
+            page_annotations = self._document.pages[n].annotations
+            page_annotations.wait()
+            page_metadata = page_annotations.metadata
+        result = {}
+        for k, v in page_metadata.iteritems():
+            if k not in document_metadata:
+                pass
+            elif v != document_metadata[k]:
+                pass
+            else:
+                continue
+            result[k] = v
+        return result
+
+__all__ = ['document_lock', 'AnnotationsModel', 'MetadataModel', 'OutlineModel', 'TextModel']
+
+# vim:ts=4 sts=4 sw=4 et
@@ -0,0 +1,119 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Fast copying of files.
+
+Data is copied in large chunks. Files can be also cloned, i.e. share data with
+the original until either of them is modified, on file systems that support
+it.
+'''
+
+import errno
+import os
+import shutil
+import sys
+
+try:
+    import fcntl
+except ImportError:  # no coverage
+    fcntl = None
+
+CHUNK_SIZE = 8 << 20
+
+# ioctl(2) request for cloning files on Linux, _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+# Errors meaning that cloning is not supported for these files.
+_UNSUPPORTED_ERRNOS = frozenset(
+    getattr(errno, name)
+    for name in ('ENOSYS', 'EXDEV', 'EINVAL', 'ENOTSUP', 'EOPNOTSUPP', 'EBADF')
+    if hasattr(errno, name)
+)
+
+def copy_data(source_fd, target_fd):
+    '''
+    Copy data from the current position of source_fd until the end of file.
+    '''
+    while True:
+        data = os.read(source_fd, CHUNK_SIZE)
+        if not data:
+            return
+        view = memoryview(data)
+        while view:
+            view = view[os.write(target_fd, view):]
+
+def _clone_data(source_fd, target_fd):
+    '''
+    Make target_fd share data with source_fd. Return true on success.
+    '''
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+    except EnvironmentError as ex:
+        if ex.errno in _UNSUPPORTED_ERRNOS or ex.errno == errno.ENOTTY:
+            return False
+        raise
+    return True
+
+def copy_file(source_path, target_path, clone=False):
+    '''
+    Copy contents and permission bits of the file.
+
+    If clone is true, the copy shares data with the original, if the file
+    system supports it.
+    '''
+    source_fd = os.open(source_path, os.O_RDONLY)
+    try:
+        target_fd = os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            if not (clone and _clone_data(source_fd, target_fd)):
+                copy_data(source_fd, target_fd)
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+    shutil.copymode(source_path, target_path)
+
+def clone_file(source_path, target_path):
+    '''
+    Clone the file if the file system supports it; otherwise, copy it.
+    '''
+    copy_file(source_path, target_path, clone=True)
+
+def sync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def replace_file(source_path, target_path):
+    '''
+    Atomically replace target file with the source file. The source file is
+    synced first, so that the target is not lost on crash.
+    '''
+    sync_file(source_path)
+    os.rename(source_path, target_path)
+    try:
+        sync_file(os.path.dirname(os.path.abspath(target_path)))
+    except EnvironmentError:
+        # Not every platform or file system allows syncing directories.
+        pass
+
+__all__ = ['copy_file', 'copy_data', 'clone_file', 'replace_file', 'sync_file']
+
+# vim:ts=4 sts=4 sw=4 et
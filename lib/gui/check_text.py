@@ -0,0 +1,86 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+import wx
+
+from djvusmooth.text import check
+from djvusmooth.i18n import _
+
+PROBLEM_DESCRIPTIONS = {
+    check.OUTSIDE_PARENT: _('zone sticks out of its parent'),
+    check.EMPTY_SIZE: _('zone has zero or negative size'),
+    check.OUTSIDE_PAGE: _('zone sticks out of the page'),
+    check.OVERLAPPING_WORDS: _('word overlaps the preceding word'),
+    check.EMPTY_TEXT: _('zone has no text'),
+}
+
+class ProblemList(wx.ListCtrl):
+
+    def __init__(self, parent, problems):
+        wx.ListCtrl.__init__(self, parent, size=(480, 320), style=(wx.LC_REPORT | wx.LC_VIRTUAL | wx.LC_SINGLE_SEL))
+        self._problems = problems
+        self.InsertColumn(0, _('Page'))
+        self.InsertColumn(1, _('Zone'))
+        self.InsertColumn(2, _('Problem'), width=320)
+        self.SetItemCount(len(problems))
+
+    def OnGetItemText(self, item, column):
+        problem = self._problems[item]
+        if column == 0:
+            return str(problem.page_no + 1)
+        elif column == 1:
+            return _(str(problem.zone_type))
+        else:
+            return PROBLEM_DESCRIPTIONS[problem.code]
+
+class CheckTextDialog(wx.Dialog):
+
+    '''
+    Modeless list of problems of the text layer.
+
+    Activating a problem calls on_activate(problem).
+    '''
+
+    def __init__(self, parent, problems, on_activate):
+        wx.Dialog.__init__(self, parent, title=_('Text problems'), style=(wx.DEFAULT_DIALOG_STYLE | wx.RESIZE_BORDER))
+        self._problems = problems
+        self._on_activate = on_activate
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        npages = len(set(problem.page_no for problem in problems))
+        message = _('%(count)d problems on %(npages)d pages.') % dict(count=len(problems), npages=npages)
+        sizer.Add(wx.StaticText(self, label=message), 0, wx.EXPAND | wx.ALL, 5)
+        self._list = ProblemList(self, problems)
+        self._list.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.on_item_activated)
+        sizer.Add(self._list, 1, wx.EXPAND | wx.ALL, 5)
+        line = wx.StaticLine(self, -1, style=wx.LI_HORIZONTAL)
+        sizer.Add(line, 0, wx.EXPAND | wx.BOTTOM | wx.TOP, 5)
+        button_sizer = wx.StdDialogButtonSizer()
+        button = wx.Button(self, wx.ID_CLOSE)
+        button.Bind(wx.EVT_BUTTON, lambda event: self.Close())
+        button_sizer.AddButton(button)
+        button_sizer.Realize()
+        sizer.Add(button_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        self.SetSizerAndFit(sizer)
+        self.Bind(wx.EVT_CLOSE, self.on_close)
+
+    def on_item_activated(self, event):
+        self._on_activate(self._problems[event.GetIndex()])
+
+    def on_close(self, event):
+        self.Destroy()
+
+__all__ = ['CheckTextDialog']
+
+# vim:ts=4 sts=4 sw=4 et
@@ -15,11 +15,16 @@
 # more details.
 
 import sys
+import bisect
+import copy
 import itertools
 import functools
+import heapq
 import locale
 import os.path
+import re
 import threading
+import time
 from Queue import Queue, Empty as QueueEmpty
 
 import djvusmooth.dependencies
@@ -31,24 +36,31 @@ import wx.lib.scrolledpanel
 
 import djvu.decode
 import djvu.const
+import djvu.sexpr
 
-from djvusmooth.djvused import StreamEditor
+from djvusmooth.djvused import StreamEditor, CommitCancelled
+import djvusmooth.djvused
 from djvusmooth.gui.page import PageWidget, PercentZoom, OneToOneZoom, StretchZoom, FitWidthZoom, FitPageZoom
 from djvusmooth.gui.page import RENDER_NONRASTER_TEXT, RENDER_NONRASTER_MAPAREA
-from djvusmooth.gui.metadata import MetadataDialog
-from djvusmooth.gui.flatten_text import FlattenTextDialog
-from djvusmooth.gui.text_browser import TextBrowser
-from djvusmooth.gui.outline_browser import OutlineBrowser
-from djvusmooth.gui.maparea_browser import MapAreaBrowser
 from djvusmooth.gui.history import FileHistory
+from djvusmooth.gui.sidebar import LazyPage
 from djvusmooth.gui import dialogs
 from djvusmooth.text import mangle as text_mangle
+from djvusmooth.text import search as text_search
+from djvusmooth.varietes import prefetch
 import djvusmooth.models.metadata
+import djvusmooth.models.outline
 import djvusmooth.models.annotations
 import djvusmooth.models.text
+import djvusmooth.models.journal
 from djvusmooth import models
 from djvusmooth import external_editor
 from djvusmooth import config
+from djvusmooth import recovery
+from djvusmooth import indirect
+from djvusmooth import filecopy
+from djvusmooth import safesave
+from djvusmooth.document import document_lock, TextModel, OutlineModel, AnnotationsModel, MetadataModel
 
 from djvusmooth import __version__, __author__
 
@@ -59,14 +71,17 @@ LICENSE = 'GPL-2'
 
 MENU_ICON_SIZE = (16, 16)
 
+RECOVERY_SYNC_INTERVAL = 5000  # milliseconds
+SAVE_STATUS_INTERVAL = 0.2  # seconds
+
 WxDjVuMessage, wx.EVT_DJVU_MESSAGE = wx.lib.newevent.NewEvent()
 
 system_encoding = locale.getpreferredencoding()
 
-class OpenDialog(wx.FileDialog):
+class ImportTextDialog(wx.FileDialog):
 
     __wildcard = _(
-        'DjVu files (*.djvu, *.djv)|*.djvu;*.djv|'
+        'hOCR and ALTO files (*.hocr, *.html, *.xml)|*.hocr;*.html;*.xml|'
         'All files|*'
     )
 
@@ -74,36 +89,73 @@ class OpenDialog(wx.FileDialog):
         wx.FileDialog.__init__(self, parent,
             style=wx.FD_OPEN,
             wildcard=self.__wildcard,
-            message=_('Open a DjVu document')
+            message=_('Import text from a hOCR or ALTO file')
         )
 
-class TextModel(models.text.Text):
+class ExportTextDialog(wx.FileDialog):
 
-    def __init__(self, document):
-        models.text.Text.__init__(self)
-        self._document = document
+    __wildcard = _(
+        'Plain text (*.txt)|*.txt|'
+        'hOCR (*.hocr)|*.hocr|'
+        'JSON lines (*.jsonl)|*.jsonl'
+    )
 
-    def reset_document(self, document):
-        self._document = document
+    __formats = 'text', 'hocr', 'jsonl'
+
+    def __init__(self, parent):
+        wx.FileDialog.__init__(self, parent,
+            style=(wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT),
+            wildcard=self.__wildcard,
+            message=_('Export text of the document')
+        )
 
-    def acquire_data(self, n):
-        text = self._document.pages[n].text
-        text.wait()
-        return text.sexpr
+    def get_format(self):
+        return self.__formats[self.GetFilterIndex()]
 
-class OutlineModel(models.outline.Outline):
+class SaveAsDialog(wx.FileDialog):
 
-    def __init__(self, document):
-        self._document = document
-        models.outline.Outline.__init__(self)
+    __wildcard = _(
+        'Bundled DjVu document (*.djvu)|*.djvu|'
+        'Indirect DjVu document (*.djvu)|*.djvu'
+    )
 
-    def reset_document(self, document):
-        self._document = document
+    __formats = 'bundled', 'indirect'
+
+    def __init__(self, parent, format):
+        wx.FileDialog.__init__(self, parent,
+            style=(wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT),
+            wildcard=self.__wildcard,
+            message=_('Save the document as')
+        )
+        self.SetFilterIndex(self.__formats.index(format))
+
+    def get_format(self):
+        return self.__formats[self.GetFilterIndex()]
+
+class OpenDialog(wx.FileDialog):
+
+    __wildcard = _(
+        'DjVu files (*.djvu, *.djv)|*.djvu;*.djv|'
+        'All files|*'
+    )
+
+    def __init__(self, parent):
+        wx.FileDialog.__init__(self, parent,
+            style=wx.FD_OPEN,
+            wildcard=self.__wildcard,
+            message=_('Open a DjVu document')
+        )
 
-    def acquire_data(self):
-        outline = self._document.outline
-        outline.wait()
-        return outline.sexpr
+class SaveJob(object):
+
+    def __init__(self, snapshots, change_count, target=None):
+        self.snapshots = snapshots
+        self.change_count = change_count
+        self.target = target
+        self.queue = Queue()
+        self.thread = None
+        self.progress = 0, 1
+        self.cancelled = False
 
 class PageProxy(object):
     def __init__(self, page, text_model, annotations_model):
@@ -142,58 +194,6 @@ class DocumentProxy(object):
     def register_outline_callback(self, callback):
         self._outline.register_callback(callback)
 
-class AnnotationsModel(models.annotations.Annotations):
-
-    def __init__(self, document_path):
-        models.annotations.Annotations.__init__(self)
-        self.__djvused = StreamEditor(document_path)
-
-    def reset_document(self, document):
-        pass  # Nothing to do
-
-    def acquire_data(self, n):
-        djvused = self.__djvused
-        if n == models.SHARED_ANNOTATIONS_PAGENO:
-            djvused.select_shared_annotations()
-        else:
-            djvused.select(n + 1)
-        djvused.print_annotations()
-        s = '(%s)' % djvused.commit()  # FIXME: optimize
-        try:
-            return djvu.sexpr.Expression.from_string(s)
-        except djvu.sexpr.ExpressionSyntaxError:
-            raise  # FIXME
-
-class MetadataModel(models.metadata.Metadata):
-
-    def __init__(self, document):
-        models.metadata.Metadata.__init__(self)
-        self._document = document
-
-    def reset_document(self, document):
-        self._document = document
-
-    def acquire_data(self, n):
-        document_annotations = self._document.annotations
-        document_annotations.wait()
-        document_metadata = document_annotations.metadata
-        if n == models.SHARED_ANNOTATIONS_PAGENO:
-            result = document_metadata
-        else:
-            page_annotations = self._document.pages[n].annotations
-            page_annotations.wait()
-            page_metadata = page_annotations.metadata
-            result = {}
-            for k, v in page_metadata.iteritems():
-                if k not in document_metadata:
-                    pass
-                elif v != document_metadata[k]:
-                    pass
-                else:
-                    continue
-                result[k] = v
-        return result
-
 class PageTextCallback(models.text.PageTextCallback):
 
     def __init__(self, owner):
@@ -218,6 +218,27 @@ class PageTextCallback(models.text.PageTextCallback):
     def notify_tree_change(self, node):
         self._owner.dirty = True
 
+class SearchIndexCallback(models.text.PageTextCallback):
+
+    def __init__(self, index, n):
+        self._index = index
+        self._n = n
+
+    def notify_node_change(self, node):
+        self._index.invalidate_page(self._n)
+
+    def notify_node_children_change(self, node):
+        self._index.invalidate_page(self._n)
+
+    def notify_node_select(self, node):
+        pass
+
+    def notify_node_deselect(self, node):
+        pass
+
+    def notify_tree_change(self, node):
+        self._index.invalidate_page(self._n)
+
 class OutlineCallback(models.outline.OutlineCallback):
 
     def __init__(self, owner):
@@ -319,6 +340,14 @@ class MainWindow(wx.Frame):
             self._config['external_editor'] = value or ''
         return property(get, set)
 
+    @apply
+    def default_undo_memory_limit():
+        def get(self):
+            return self._config.read_int('undo_memory_limit', models.journal.DEFAULT_MAX_SIZE >> 20)
+        def set(self, value):
+            self._config['undo_memory_limit'] = value
+        return property(get, set)
+
     @apply
     def default_open_dir():
         def get(self):
@@ -354,9 +383,10 @@ class MainWindow(wx.Frame):
         self.splitter = wx.SplitterWindow(self, style=wx.SP_LIVE_UPDATE)
         self.splitter.Bind(wx.EVT_SPLITTER_SASH_POS_CHANGED, self.on_splitter_sash_changed)
         self.sidebar = wx.Notebook(self.splitter, wx.ID_ANY)
-        self.text_browser = TextBrowser(self.sidebar)
-        self.outline_browser = OutlineBrowser(self.sidebar)
-        self.maparea_browser = MapAreaBrowser(self.sidebar)
+        # Browsers are created only when their pages are first activated.
+        self.text_browser = LazyPage(self.sidebar, 'djvusmooth.gui.text_browser', 'TextBrowser')
+        self.outline_browser = LazyPage(self.sidebar, 'djvusmooth.gui.outline_browser', 'OutlineBrowser')
+        self.maparea_browser = LazyPage(self.sidebar, 'djvusmooth.gui.maparea_browser', 'MapAreaBrowser')
         self.sidebar.AddPage(self.outline_browser, _('Outline'))
         self.sidebar.AddPage(self.maparea_browser, _('Hyperlinks'))
         self.sidebar.AddPage(self.text_browser, _('Text'))
@@ -382,6 +412,15 @@ class MainWindow(wx.Frame):
         self.editable_menu_items = []
         self.saveable_menu_items = []
         self.file_history = FileHistory(self._config)
+        self.search_index = None
+        self._search_query = None
+        self.journal = models.journal.Journal(self.default_undo_memory_limit << 20)
+        self.recovery = None
+        self.save_job = None
+        self._change_count = 0
+        self.recovery_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_recovery_timer, self.recovery_timer)
+        self.recovery_timer.Start(RECOVERY_SYNC_INTERVAL)
         self.create_menus()
         self.dirty = False
         self.do_open(None)
@@ -414,8 +453,12 @@ class MainWindow(wx.Frame):
         recent_menu_item = menu.AppendMenu(wx.ID_ANY, _('Open &recent'), recent_menu)
         self.file_history.set_menu(self, recent_menu_item, self.do_open)
         save_menu_item = menu_item(_('&Save') + '\tCtrl+S', _('Save the document'), self.on_save, icon=wx.ART_FILE_SAVE)
+        save_as_menu_item = menu_item(_(u'Save &as…') + '\tCtrl+Shift+S', _('Save the document into another file, as a bundled or indirect document'), self.on_save_as, icon=wx.ART_FILE_SAVE_AS)
         close_menu_item = menu_item(_('&Close') + '\tCtrl+W', _('Close the document'), self.on_close, id=wx.ID_CLOSE)
-        self.editable_menu_items += close_menu_item,
+        menu.AppendSeparator()
+        import_menu_item = menu_item(_(u'&Import text…'), _('Replace the text layer with text from hOCR or ALTO file'), self.on_import_text)
+        export_menu_item = menu_item(_(u'&Export text…'), _('Export the text layer as plain text, hOCR or JSON'), self.on_export_text)
+        self.editable_menu_items += save_as_menu_item, close_menu_item, import_menu_item, export_menu_item
         self.saveable_menu_items += save_menu_item,
         menu.AppendSeparator()
         menu_item(_('&Quit') + '\tCtrl+Q', _('Quit the application'), self.on_exit, icon=wx.ART_QUIT)
@@ -424,11 +467,20 @@ class MainWindow(wx.Frame):
     def _create_edit_menu(self):
         menu = wx.Menu()
         menu_item = functools.partial(self._create_menu_item, menu)
+        menu_item(_('&Undo') + '\tCtrl+Z', _('Undo the last change'), self.on_undo, icon=wx.ART_UNDO, id=wx.ID_UNDO)
+        menu_item(_('&Redo') + '\tCtrl+Y', _('Redo the last undone change'), self.on_redo, icon=wx.ART_REDO, id=wx.ID_REDO)
+        menu.AppendSeparator()
         menu_item(_('&Metadata') + '\tCtrl+M', _('Edit the document or page metadata'), self.on_edit_metadata)
+        menu_item(_(u'&Find…') + '\tCtrl+F', _('Find text in the document'), self.on_find, icon=wx.ART_FIND)
+        menu_item(_('Find &next') + '\tF3', _('Find the next occurrence of the text'), self.on_find_next)
         submenu = wx.Menu()
         submenu_item = functools.partial(self._create_menu_item, submenu)
         submenu_item(_('&External editor') + '\tCtrl+T', _('Edit page text in an external editor'), self.on_external_edit_text)
         submenu_item(_('&Flatten'), _('Remove details from page text'), self.on_flatten_text)
+        submenu_item(_(u'&Transform…'), _('Shift, scale or rotate boxes of page text'), self.on_transform_text)
+        submenu_item(_(u'&Snap to ink…'), _('Shrink word boxes to the ink of the page image'), self.on_snap_text)
+        submenu_item(_(u'&Replace…') + '\tCtrl+H', _('Replace text in all pages'), self.on_replace_text)
+        submenu_item(_('&Check'), _('Look for problems in text of all pages'), self.on_check_text)
         menu.AppendMenu(wx.ID_ANY, _('&Text'), submenu)
         submenu = wx.Menu()
         submenu_item = functools.partial(self._create_menu_item, submenu)
@@ -517,6 +569,7 @@ class MainWindow(wx.Frame):
         if self.default_sidebar_shown:
             sidebar_menu_item.Check()
         menu_item(_(u'External editor…'), _('Setup an external editor'), self.on_setup_external_editor)
+        menu_item(_(u'Undo memory limit…'), _('Setup memory available for undoing changes'), self.on_setup_undo_memory_limit)
         return menu
 
     def _create_help_menu(self):
@@ -538,14 +591,36 @@ class MainWindow(wx.Frame):
         finally:
             dialog.Destroy()
 
+    def on_setup_undo_memory_limit(self, event):
+        dialog = dialogs.NumberEntryDialog(
+            parent=self,
+            message=_('Memory available for undoing changes (MiB):'),
+            prompt='',
+            caption=_('Undo memory limit'),
+            value=self.default_undo_memory_limit,
+            min=1,
+            max=1024
+        )
+        try:
+            if dialog.ShowModal() == wx.ID_OK:
+                self.default_undo_memory_limit = dialog.GetValue()
+                self.journal.max_size = self.default_undo_memory_limit << 20
+        finally:
+            dialog.Destroy()
+
     def on_splitter_sash_changed(self, event):
         self.default_splitter_sash = event.GetSashPosition()
 
     def _on_sidebar_page_changed(self, *methods):
         def event_handler(event):
+            self.sidebar.GetPage(event.GetSelection()).activate()
             methods[event.GetSelection()](event)
         return event_handler
 
+    def activate_sidebar_page(self):
+        if self.splitter.IsSplit():
+            self.sidebar.GetCurrentPage().activate()
+
     def on_char(self, event):
         key_code = event.GetKeyCode()
         if key_code == ord('-'):
@@ -571,14 +646,27 @@ class MainWindow(wx.Frame):
             return self._dirty
         def set(self, value):
             self._dirty = value
+            if value:
+                self._change_count += 1
             self.enable_save(value)
         return property(get, set)
 
     def error_box(self, message, caption=_('Error')):
         wx.MessageBox(message=message, caption=caption, style=(wx.OK | wx.ICON_ERROR), parent=self)
 
+    def on_recovery_timer(self, event):
+        if self.recovery is None:
+            return
+        try:
+            self.recovery.sync()
+        except EnvironmentError:
+            # Don't nag the user every few seconds; saving will report
+            # problems with the file system, if any.
+            pass
+
     def on_exit(self, event):
         if self.do_open(None):
+            self.recovery_timer.Stop()
             x, y = self.GetPosition()
             w, h = self.GetSize()
             self.default_xywh = x, y, w, h
@@ -598,61 +686,433 @@ class MainWindow(wx.Frame):
         self.do_open(None)
 
     def on_save(self, event):
-        self.do_save()
+        if self.dirty:
+            self.start_save()
+
+    def get_document_format(self):
+        if self.document.type == djvu.decode.DOCUMENT_TYPE_INDIRECT:
+            return 'indirect'
+        else:
+            return 'bundled'
+
+    def on_save_as(self, event):
+        if not self.finish_save():
+            return
+        dialog = SaveAsDialog(self, self.get_document_format())
+        dialog.SetDirectory(os.path.dirname(self.path))
+        try:
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            path = dialog.GetPath()
+            format = dialog.get_format()
+        finally:
+            dialog.Destroy()
+        if isinstance(path, unicode):
+            path = path.encode(system_encoding)
+        self.do_save_as(path, format)
+
+    def do_save_as(self, path, format):
+        '''
+        Save the document into another file, and open it. Return true on
+        success.
+        '''
+        if not self.finish_save():
+            return False
+        same_file = os.path.exists(path) and os.path.samefile(path, self.path)
+        if format == self.get_document_format():
+            if same_file:
+                return self.do_save()
+            if not self.dirty and self.document.type in (djvu.decode.DOCUMENT_TYPE_BUNDLED, djvu.decode.DOCUMENT_TYPE_SINGLE_PAGE):
+                # Nothing to change, so the file is just copied.
+                try:
+                    with document_lock:
+                        filecopy.copy_file(self.path, path)
+                except EnvironmentError as exception:
+                    self.on_save_failed(exception)
+                    return False
+                page_no = self.page_no
+                self.do_open(path)
+                self.page_no = page_no
+                return True
+        self.start_save(target=path, format=format, replace=same_file)
+        return self.finish_save()
 
     def on_save_failed(self, exception):
         self.error_box(_('Saving document failed:\n%s') % exception)
 
     def do_save(self):
-        if not self.dirty:
-            return True
-        queue = Queue()
-        sed = StreamEditor(self.path, autosave=True)
-        for model in self.models:
-            model.export(sed)
+        '''
+        Save the document, and wait until it's saved. Return true on success.
+        '''
+        if not self.finish_save():
+            return False
+        if self.dirty:
+            self.start_save()
+        return self.finish_save()
+
+    def start_save(self, target=None, format=None, replace=False):
+        '''
+        Start saving the document in a background thread.
+
+        Snapshots of the dirty models are taken beforehand, so that the models
+        can be edited while the document is being saved.
+
+        If target is not None, the document is saved into the target file
+        instead, in the bundled or indirect format, and the current file is
+        left intact. If replace is true, the target is the current file, but
+        the document is converted to another format.
+        '''
+        if self.save_job is not None:
+            if not self.finish_save():
+                return
+            if not self.dirty and target is None:
+                return
+        snapshots = [snapshot for model in self.models for snapshot in model.take_snapshot()]
+        # Export everything for a page at once, so that djvused commands for
+        # the page can be coalesced.
+        snapshots.sort(key=lambda snapshot: snapshot.n)
+        npages = len(set(snapshot.n for snapshot in snapshots))
+        try:
+            component_paths = indirect.get_component_paths(self.document, self.path)
+        except djvu.decode.NotAvailable:
+            component_paths = None
+        document_type = self.document.type
+        page_count = len(self.document.pages)
+        sed = StreamEditor(self.path)
+        save_job = self.save_job = SaveJob(snapshots, self._change_count, target)
+        if replace:
+            target_path = target + '.tmp'
+        else:
+            target_path = target
+        document_models = self.models
+        last_status_time = [0]
+        def report_progress(done, total):
+            save_job.progress = done, total
+            now = time.time()
+            if now - last_status_time[0] >= SAVE_STATUS_INTERVAL:
+                last_status_time[0] = now
+                wx.CallAfter(self.update_save_status, save_job)
+            return not save_job.cancelled
         def job():
+            # The document lock is held only while the document file is being
+            # replaced and reopened, so that models can read from the current
+            # file in the meantime.
             try:
-                sed.commit()
-                self.document = self.context.new_document(djvu.decode.FileURI(self.path))
-                for model in self.models:
-                    model.reset_document(self.document)
+                if target is None and component_paths is not None:
+                    components, index_snapshots = indirect.split_snapshots(snapshots, component_paths)
+                    indirect.save(self.path, page_count, components, index_snapshots, progress=report_progress, lock=document_lock)
+                elif target is None:
+                    # The document is replaced by its new version only after
+                    # it has been verified.
+                    safesave.save(self.path, document_type, page_count, snapshots, progress=report_progress, npages=npages, lock=document_lock)
+                else:
+                    # Commands are written to djvused as soon as they are
+                    # produced, one page at a time.
+                    sed.start(progress=report_progress, npages=npages)
+                    try:
+                        for snapshot in snapshots:
+                            snapshot.export(sed)
+                        if format == 'indirect':
+                            sed.save_as_indirect(target_path)
+                        elif format == 'bundled':
+                            sed.save_as_bundled(target_path)
+                    except:
+                        sed.cancel()
+                        raise
+                    sed.commit()
+                if target is not None:
+                    if replace:
+                        with document_lock:
+                            filecopy.replace_file(target_path, target)
+                    # The target file is going to be opened instead.
+                    document = None
+                else:
+                    # The document file has been replaced, so it must be
+                    # reopened.
+                    with document_lock:
+                        document = self.context.new_document(djvu.decode.FileURI(self.path))
+                        for model in document_models:
+                            model.reset_document(document)
             except Exception as exception:
-                pass
+                document = None
             else:
                 exception = None
-            queue.put(exception)
-        thread = threading.Thread(target=job)
-        thread.start()
+            save_job.queue.put((document, exception))
+            wx.CallAfter(self.after_save, save_job)
+        save_job.thread = threading.Thread(target=job)
+        save_job.thread.start()
+        self.enable_save(False)
+        self.update_save_status(save_job)
+
+    def get_save_message(self, save_job):
+        done, total = save_job.progress
+        if done < total - 1:
+            return _(u'Saving page %(done)d of %(total)d…') % dict(done=(done + 1), total=(total - 1))
+        else:
+            return _(u'Writing the document…')
+
+    def update_save_status(self, save_job):
+        if save_job is self.save_job:
+            self.SetStatusText(self.get_save_message(save_job))
+
+    def after_save(self, save_job):
+        if save_job is self.save_job:
+            self.finish_save()
+
+    def finish_save(self):
+        '''
+        Wait for the document to be saved in the background, if it's being
+        saved. Return true on success.
+        '''
+        save_job = self.save_job
+        if save_job is None:
+            return True
         dialog = None
         try:
             try:
-                exception = queue.get(block=True, timeout=0.1)
-                if exception is not None:
-                    self.on_save_failed(exception)
-                    return False
+                document, exception = save_job.queue.get(block=True, timeout=0.1)
             except QueueEmpty:
                 dialog = dialogs.ProgressDialog(
                     title=_('Saving document'),
-                    message=_(u'Saving the document, please wait…'),
+                    message=self.get_save_message(save_job),
                     parent=self,
-                    style=(wx.PD_APP_MODAL | wx.PD_ELAPSED_TIME),
+                    style=(wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME | wx.PD_REMAINING_TIME),
                 )
             while dialog is not None:
                 try:
-                    exception = queue.get(block=True, timeout=0.1)
-                    if exception is not None:
-                        self.on_save_failed(exception)
-                        return False
+                    document, exception = save_job.queue.get(block=True, timeout=0.1)
                     break
                 except QueueEmpty:
-                    dialog.Pulse()
+                    done, total = save_job.progress
+                    # The dialog can't be closed until the job is finished.
+                    if not dialog.Update(min(100 * done // total, 99), self.get_save_message(save_job))[0]:
+                        save_job.cancelled = True
         finally:
-            thread.join()
             if dialog is not None:
                 dialog.Destroy()
-        self.dirty = False
+        save_job.thread.join()
+        self.save_job = None
+        self.SetStatusText('')
+        if exception is not None:
+            if self.dirty:
+                # Saving was disabled while the document was being saved.
+                self.enable_save(True)
+            if not isinstance(exception, CommitCancelled):
+                self.on_save_failed(exception)
+            return False
+        if save_job.target is not None:
+            # Everything has been saved into the target file, which becomes
+            # the current document.
+            self.dirty = False
+            page_no = self.page_no
+            self.do_open(save_job.target)
+            self.page_no = page_no
+            return True
+        self.document = document
+        # Models are updated in place: the saved data becomes the original
+        # one, and models that weren't modified in the meantime become clean.
+        for snapshot in save_job.snapshots:
+            snapshot.mark_saved()
+        if self._change_count == save_job.change_count:
+            self.dirty = False
+            self.discard_recovery()
+        else:
+            self.enable_save(True)
+            # The journal is bound to the previous version of the file.
+            self.restart_recovery()
+        self.save_search_index()
         return True
 
+    def discard_recovery(self):
+        if self.recovery is None:
+            return
+        try:
+            self.recovery.discard()
+        except EnvironmentError:
+            pass
+
+    def restart_recovery(self):
+        if self.recovery is None:
+            return
+        try:
+            self.recovery.restart(*self.models)
+        except EnvironmentError:
+            pass
+
+    def do_recover(self):
+        '''
+        Offer to replay the recovery journal; return true if the models were
+        modified.
+        '''
+        if not self.recovery.can_recover():
+            return False
+        dialog = wx.MessageDialog(self,
+            _('The document has unsaved changes from a previous session. Do you want to recover them?'),
+            '', wx.YES_NO | wx.YES_DEFAULT | wx.ICON_QUESTION
+        )
+        try:
+            if dialog.ShowModal() != wx.ID_YES:
+                self.discard_recovery()
+                return False
+        finally:
+            dialog.Destroy()
+        self.document.decoding_job.wait()
+        try:
+            self.recovery.replay(*self.models)
+        except Exception as exception:
+            self.error_box(_('Recovering changes failed:\n%s') % exception)
+        return True
+
+    def on_import_text(self, event):
+        from djvusmooth.text import ocr as text_ocr
+        dialog = ImportTextDialog(self)
+        try:
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            ocr_path = dialog.GetPath()
+        finally:
+            dialog.Destroy()
+        if not self.finish_save():
+            return
+        if self.dirty:
+            # The text is saved directly into the document.
+            dialog = wx.MessageDialog(self, _('The document has to be saved first. Do you want to save your changes?'), '', wx.YES_NO | wx.YES_DEFAULT | wx.ICON_QUESTION)
+            try:
+                if dialog.ShowModal() != wx.ID_YES:
+                    return
+            finally:
+                dialog.Destroy()
+            if not self.do_save():
+                return
+        document = self.document
+        path = self.path
+        try:
+            component_paths = indirect.get_component_paths(document, path)
+        except djvu.decode.NotAvailable:
+            component_paths = None
+        document_type = document.type
+        page_count = len(document.pages)
+        def get_page_info(n):
+            page = document.pages[n]
+            page.get_info()
+            return (page.width, page.height), page.rotation
+        replaced = []
+        def iterate(page_nos):
+            # Pages are written into the new version of the document as soon
+            # as they are converted. As in start_save(), it replaces the
+            # document only after it has been verified, and the document lock
+            # is held only meanwhile.
+            if component_paths is not None:
+                version = indirect.NewComponents(path, component_paths)
+            else:
+                version = safesave.NewVersion(path, document_type, page_count)
+            try:
+                with open(ocr_path, 'rb') as file:
+                    for item in text_ocr.import_pages(text_ocr.iter_pages(file), page_nos, get_page_info, version.export):
+                        yield item
+                version.finish()
+            except:
+                version.cancel()
+                raise
+            version.replace(lock=document_lock)
+            replaced.append(True)
+        result = self.run_page_job(
+            _('Importing text'),
+            _(u'Importing text, please wait…'),
+            range(len(document.pages)),
+            iterate
+        )
+        if result is None and not replaced:
+            self.SetStatusText(_('The text has not been imported'))
+            return
+        page_no = self.page_no
+        self.do_open(self.path)
+        self.page_no = page_no
+        if result is None:
+            # The job was cancelled only after the document had been saved.
+            self.SetStatusText(_('The text has been already imported'))
+
+    def on_export_text(self, event):
+        from djvusmooth.text import export as text_export
+        dialog = ExportTextDialog(self)
+        try:
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            export_path = dialog.GetPath()
+            export = text_export.FORMATS[dialog.get_format()]
+        finally:
+            dialog.Destroy()
+        document = self.document
+        text_model = self.text_model
+        page_nos = range(len(document.pages))
+        # Page models must not be touched from other threads, but their
+        # S-expressions are never modified in place.
+        page_model_texts = dict((n, page.raw_value) for n, page in text_model.iter_page_models())
+        def iter_pages():
+            other_texts = text_model.iter_page_texts(page_nos)
+            for n in page_nos:
+                if n in page_model_texts:
+                    sexpr = page_model_texts[n]
+                else:
+                    m, sexpr = other_texts.next()
+                    assert m == n
+                page = document.pages[n]
+                page.get_info()
+                yield n, sexpr, (page.width, page.height), page.rotation
+        def iterate(page_nos):
+            with open(export_path, 'wb') as file:
+                for item in export(file, prefetch(iter_pages(), 16)):
+                    yield item
+        if self.run_page_job(
+            _('Exporting text'),
+            _(u'Exporting text, please wait…'),
+            page_nos,
+            iterate
+        ) is None:
+            try:
+                os.remove(export_path)
+            except OSError:
+                pass
+
+    def on_check_text(self, event):
+        from djvusmooth.gui.check_text import CheckTextDialog
+        from djvusmooth.text import check as text_check
+        document = self.document
+        text_model = self.text_model
+        page_model_texts = dict((n, page.raw_value) for n, page in text_model.iter_page_models())
+        def iter_pages(page_nos):
+            other_texts = text_model.iter_page_texts(page_nos)
+            for n in page_nos:
+                if n in page_model_texts:
+                    sexpr = page_model_texts[n]
+                else:
+                    m, sexpr = other_texts.next()
+                    assert m == n
+                page = document.pages[n]
+                page.get_info()
+                yield n, sexpr, (page.width, page.height)
+        checked_pages = self.run_page_job(
+            _('Checking text'),
+            _(u'Checking text, please wait…'),
+            range(len(document.pages)),
+            lambda page_nos: text_check.check_pages(iter_pages(page_nos))
+        )
+        if checked_pages is None:
+            return
+        problems = [problem for n, page_problems in checked_pages for problem in page_problems]
+        if not problems:
+            wx.MessageBox(message=_('No problems found.'), caption=_('Check text'), parent=self)
+            return
+        CheckTextDialog(self, problems, self.do_show_text_problem).Show()
+
+    def do_show_text_problem(self, problem):
+        self.on_display_text(None)
+        if problem.page_no != self.page_no:
+            self.page_no = problem.page_no
+        node = text_search.get_unit_node(self.text_model[problem.page_no], problem.path)
+        if node is not None:
+            node.notify_select()
+
     def on_show_sidebar(self, event):
         if event.IsChecked():
             self.do_show_sidebar()
@@ -662,6 +1122,8 @@ class MainWindow(wx.Frame):
     def do_show_sidebar(self):
         self.splitter.SplitVertically(self.sidebar, self.scrolled_panel, self.default_splitter_sash)
         self.default_sidebar_shown = True
+        # Don't delay showing the window.
+        wx.CallAfter(self.activate_sidebar_page)
 
     def do_hide_sidebar(self):
         self.splitter.Unsplit(self.sidebar)
@@ -754,7 +1216,28 @@ class MainWindow(wx.Frame):
         finally:
             dialog.Destroy()
 
+    def on_undo(self, event):
+        if not self.journal.can_undo():
+            self.SetStatusText(_('Nothing to undo'))
+            return
+        self.after_undo(self.journal.undo())
+
+    def on_redo(self, event):
+        if not self.journal.can_redo():
+            self.SetStatusText(_('Nothing to redo'))
+            return
+        self.after_undo(self.journal.redo())
+
+    def after_undo(self, change):
+        if self.search_index is not None:
+            for page_no in change.page_nos:
+                self.search_index.invalidate_page(page_no)
+        if len(change.page_nos) == 1 and change.page_nos[0] not in (self.page_no, models.SHARED_ANNOTATIONS_PAGENO):
+            self.page_no = change.page_nos[0]
+        self.dirty = True
+
     def on_edit_metadata(self, event):
+        from djvusmooth.gui.metadata import MetadataDialog
         document_metadata_model = self.metadata_model[models.SHARED_ANNOTATIONS_PAGENO].clone()
         document_metadata_model.title = _('Document metadata')
         page_metadata_model = self.metadata_model[self.page_no].clone()
@@ -762,13 +1245,15 @@ class MainWindow(wx.Frame):
         dialog = MetadataDialog(self, models=(document_metadata_model, page_metadata_model), known_keys=djvu.const.METADATA_KEYS)
         try:
             if dialog.ShowModal() == wx.ID_OK:
-                self.metadata_model[models.SHARED_ANNOTATIONS_PAGENO] = document_metadata_model
-                self.metadata_model[self.page_no] = page_metadata_model
+                with self.journal.group():
+                    self.metadata_model[models.SHARED_ANNOTATIONS_PAGENO].assign(document_metadata_model)
+                    self.metadata_model[self.page_no].assign(page_metadata_model)
                 self.dirty = True
         finally:
             dialog.Destroy()
 
     def on_flatten_text(self, event):
+        from djvusmooth.gui.flatten_text import FlattenTextDialog
         dialog = FlattenTextDialog(self)
         zone = None
         try:
@@ -780,11 +1265,365 @@ class MainWindow(wx.Frame):
         if zone is None:
             return
         if scope_all:
-            page_nos = xrange(len(self.document.pages))
+            self.do_flatten_all_text(zone)
         else:
-            page_nos = (self.page_no,)
-        for page_no in page_nos:
-            self.text_model[page_no].strip(zone)
+            self.text_model[self.page_no].strip(zone)
+
+    def run_page_job(self, title, message, page_nos, iterate):
+        '''
+        Run iterate(page_nos) in a background thread, showing progress.
+
+        Return list of the yielded (n, ...) items, or None if the job was
+        cancelled or failed.
+        '''
+        queue = Queue()
+        stop_event = threading.Event()
+        def job():
+            try:
+                for item in iterate(page_nos):
+                    if stop_event.is_set():
+                        break
+                    queue.put(item)
+            except Exception as exception:
+                pass
+            else:
+                exception = None
+            queue.put(exception)
+        thread = threading.Thread(target=job)
+        thread.start()
+        dialog = dialogs.ProgressDialog(
+            title=title,
+            message=message,
+            maximum=max(len(page_nos), 1),
+            parent=self,
+            style=(wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME | wx.PD_REMAINING_TIME),
+        )
+        result = []
+        try:
+            while True:
+                try:
+                    item = queue.get(block=True, timeout=0.1)
+                except QueueEmpty:
+                    pass
+                else:
+                    if not isinstance(item, tuple):
+                        exception = item
+                        break
+                    result += item,
+                    if not queue.empty():
+                        continue
+                progress = page_nos.index(result[-1][0]) + 1 if result else 0
+                if not dialog.Update(progress)[0]:
+                    return
+        finally:
+            stop_event.set()
+            thread.join()
+            dialog.Destroy()
+        if exception is not None:
+            self.error_box(_('%(operation)s failed:\n%(error)s') % dict(operation=title, error=exception))
+            return
+        return result
+
+    def do_modify_all_text(self, title, message, iterate, modify_page_model):
+        '''
+        Modify text of pages without page models in the background, using
+        iterate(page_nos); then modify the page models.
+        '''
+        page_nos = range(len(self.document.pages))
+        modified_pages = self.run_page_job(title, message, page_nos, iterate)
+        if modified_pages is None:
+            return
+        with self.journal.group():
+            self.text_model.set_serialized_pages(modified_pages)
+            for page_no, page in self.text_model.iter_page_models():
+                modify_page_model(page)
+        if self.search_index is not None:
+            for page_no in page_nos:
+                self.search_index.invalidate_page(page_no)
+        self.dirty = True
+
+    def do_flatten_all_text(self, zone):
+        self.do_modify_all_text(
+            _('Flattening text'),
+            _(u'Flattening text, please wait…'),
+            lambda page_nos: self.text_model.iter_stripped_pages(page_nos, zone),
+            lambda page: page.strip(zone)
+        )
+
+    def on_transform_text(self, event):
+        from djvusmooth.gui.transform_text import TransformTextDialog
+        dialog = TransformTextDialog(self)
+        try:
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            scope_all = dialog.get_scope()
+            try:
+                get_matrix = dialog.get_matrix_factory()
+            except ValueError:
+                self.error_box(_('Invalid number.'))
+                return
+        finally:
+            dialog.Destroy()
+        def transform(page):
+            if page.root is not None:
+                page.transform(get_matrix(page.root.rect))
+        if scope_all:
+            self.do_modify_all_text(
+                _('Transforming text'),
+                _(u'Transforming text, please wait…'),
+                lambda page_nos: self.text_model.iter_transformed_pages(page_nos, get_matrix),
+                transform
+            )
+        else:
+            transform(self.text_model[self.page_no])
+
+    def on_snap_text(self, event):
+        from djvusmooth.gui.snap_text import SnapTextDialog
+        from djvusmooth.text import ink as text_ink
+        if not text_ink.is_available():
+            self.error_box(_('Snapping to ink requires NumPy.'))
+            return
+        dialog = SnapTextDialog(self)
+        try:
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            scope_all = dialog.get_scope()
+            margin = dialog.get_margin()
+        finally:
+            dialog.Destroy()
+        if scope_all:
+            self.do_snap_all_text(margin)
+            return
+        page_job = self.page_job
+        if page_job is None:
+            return
+        page_job.wait()
+        ink = text_ink.render_stencil(page_job)
+        text_ink.snap_page_text(self.text_model[self.page_no], ink, page_job.initial_rotation, margin)
+
+    def do_snap_all_text(self, margin):
+        from djvusmooth.text import ink as text_ink
+        # Pages are rendered by worker processes, which open the document on
+        # their own; so both page models and other pages are sent serialized.
+        model_pages = [
+            (page_no, str(page.raw_value))
+            for page_no, page in self.text_model.iter_page_models()
+            if page.raw_value
+        ]
+        def iterate(page_nos):
+            pages = (
+                (n, str(sexpr))
+                for n, sexpr in self.text_model.iter_page_texts(page_nos)
+                if sexpr
+            )
+            return text_ink.iter_snapped_pages(self.path, heapq.merge(model_pages, pages), margin)
+        page_nos = range(len(self.document.pages))
+        snapped_pages = self.run_page_job(
+            _('Snapping text'),
+            _(u'Snapping words to ink, please wait…'),
+            page_nos,
+            iterate
+        )
+        if snapped_pages is None:
+            return
+        model_page_nos = set(page_no for page_no, text in model_pages)
+        with self.journal.group():
+            self.text_model.set_serialized_pages((page_no, text) for page_no, text in snapped_pages if page_no not in model_page_nos)
+            for page_no, text in snapped_pages:
+                if page_no in model_page_nos:
+                    self.text_model[page_no].raw_value = djvu.sexpr.Expression.from_string(text)
+        for page_no, text in snapped_pages:
+            if self.search_index is not None:
+                self.search_index.invalidate_page(page_no)
+        self.dirty = True
+
+    def on_replace_text(self, event):
+        from djvusmooth.gui.replace_text import ReplaceTextDialog, ReplacePreviewDialog
+        dialog = ReplaceTextDialog(self)
+        try:
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            try:
+                regex = dialog.get_regex()
+            except re.error as exception:
+                self.error_box(_('Invalid regular expression:\n%s') % exception)
+                return
+            replacement = dialog.get_replacement()
+        finally:
+            dialog.Destroy()
+        page_nos = range(len(self.document.pages))
+        def iterate(page_nos):
+            for n, sexpr in self.text_model.iter_page_texts(page_nos):
+                if not sexpr:
+                    continue
+                sexpr, count = text_mangle.replace(sexpr, regex, replacement)
+                if count:
+                    yield n, count, str(sexpr)
+        changed_pages = self.run_page_job(
+            _('Replacing text'),
+            _(u'Searching for the text, please wait…'),
+            page_nos,
+            iterate
+        )
+        if changed_pages is None:
+            return
+        changed_page_models = []
+        for page_no, page in self.text_model.iter_page_models():
+            if page.raw_value is None:
+                continue
+            sexpr, count = text_mangle.replace(page.raw_value, regex, replacement)
+            if count:
+                changed_page_models += (page_no, count, sexpr),
+        counts = sorted((page_no, count) for page_no, count, sexpr in changed_pages + changed_page_models)
+        if not counts:
+            wx.MessageBox(message=_('Text not found.'), caption=_('Replace text'), parent=self)
+            return
+        dialog = ReplacePreviewDialog(self, counts)
+        try:
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+        finally:
+            dialog.Destroy()
+        with self.journal.group():
+            self.text_model.set_serialized_pages((page_no, text) for page_no, count, text in changed_pages)
+            for page_no, count, sexpr in changed_page_models:
+                self.text_model[page_no].raw_value = sexpr
+        if self.search_index is not None:
+            for page_no, count in counts:
+                self.search_index.invalidate_page(page_no)
+        self.dirty = True
+
+    def start_search_indexing(self):
+        index = self.search_index = text_search.SearchIndex()
+        self._search_index_complete = False
+        try:
+            index.load(text_search.get_index_path(self.path), text_search.get_index_key(self.path))
+        except OSError:
+            pass
+        self.text_model.register_page_callback_factory(functools.partial(SearchIndexCallback, index))
+        stop_event = self._search_index_stop_event = threading.Event()
+        document = self.document
+        text_model = self.text_model
+        def job():
+            document.decoding_job.wait()
+            page_nos = xrange(len(document.pages))
+            if text_search.build(index, page_nos, text_model.acquire_data, stop_event):
+                wx.CallAfter(self.after_search_indexing, index)
+        thread = threading.Thread(target=job)
+        thread.daemon = True
+        thread.start()
+
+    def stop_search_indexing(self):
+        if self.search_index is None:
+            return
+        self._search_index_stop_event.set()
+        self.search_index = None
+
+    def after_search_indexing(self, index):
+        if index is not self.search_index:
+            return
+        self._search_index_complete = True
+        if not self.dirty:
+            self.save_search_index()
+
+    def refresh_search_index(self, callback=None):
+        '''
+        Reindex changed pages. Pages that have page models are reindexed right
+        away; the other ones are reindexed in a background thread, so that
+        e.g. changing text of the whole document doesn't materialize all the
+        pages. callback(index) is called once they are done.
+        '''
+        index = self.search_index
+        text_model = self.text_model
+        page_models = set(n for n, page in text_model.iter_page_models())
+        page_nos = []
+        for n, revision in index.take_stale_pages():
+            if n in page_models:
+                index.index_page(n, text_model[n].raw_value, revision=revision)
+            else:
+                page_nos += (n, revision),
+        if not page_nos:
+            if callback is not None:
+                callback(index)
+            return
+        stop_event = self._search_index_stop_event
+        def job():
+            revisions = dict(page_nos)
+            for n, sexpr in text_model.iter_page_texts(sorted(revisions)):
+                if stop_event.is_set():
+                    return
+                index.index_page(n, sexpr, revision=revisions.pop(n))
+            # Pages that got page models in the meantime are left to be
+            # indexed in the GUI thread.
+            wx.CallAfter(self.after_search_index_refresh, index, revisions, callback)
+        thread = threading.Thread(target=job)
+        thread.daemon = True
+        thread.start()
+
+    def after_search_index_refresh(self, index, revisions, callback):
+        if index is not self.search_index:
+            return
+        for n, revision in sorted(revisions.iteritems()):
+            index.index_page(n, self.text_model[n].raw_value, revision=revision)
+        if callback is not None:
+            callback(index)
+
+    def save_search_index(self):
+        if self.search_index is None:
+            return
+        self.refresh_search_index(self._save_search_index)
+
+    def _save_search_index(self, index):
+        if index is not self.search_index:
+            return
+        try:
+            self.search_index.save(text_search.get_index_path(self.path), text_search.get_index_key(self.path))
+        except (IOError, OSError):
+            # The index can be always rebuilt.
+            pass
+
+    def on_find(self, event):
+        dialog = wx.TextEntryDialog(self,
+            caption=_('Find'),
+            message=_('Find text:')
+        )
+        try:
+            dialog.SetValue(self._search_query or '')
+            if dialog.ShowModal() != wx.ID_OK:
+                return
+            self._search_query = dialog.GetValue()
+        finally:
+            dialog.Destroy()
+        self._search_position = self.page_no, ()
+        self.do_find_next()
+
+    def on_find_next(self, event):
+        if not self._search_query:
+            self.on_find(event)
+            return
+        self.do_find_next()
+
+    def do_find_next(self):
+        index = self.search_index
+        self.refresh_search_index()
+        matches = index.find(self._search_query)
+        if not matches:
+            self.SetStatusText(_('Text not found'))
+            return
+        positions = [(match.page_no, match.path) for match in matches]
+        i = bisect.bisect_right(positions, self._search_position) % len(positions)
+        match = matches[i]
+        self._search_position = positions[i]
+        self.on_display_text(None)
+        if match.page_no != self.page_no:
+            self.page_no = match.page_no
+        node = text_search.get_unit_node(self.text_model[match.page_no], match.path)
+        if node is not None:
+            node.notify_select()
+        text = _('Match %(n)d of %(count)d') % dict(n=(i + 1), count=len(matches))
+        if not self._search_index_complete or index.has_stale_pages():
+            text += ' ' + _(u'(indexing in progress…)')
+        self.SetStatusText(text)
 
     def on_bookmark_current_page(self, event):
         uri = self.get_page_uri()
@@ -843,7 +1682,9 @@ class MainWindow(wx.Frame):
                     self.external_editor(tmp_file.name)
                     tmp_file.seek(0)
                     try:
-                        new_sexpr = text_mangle.import_(sexpr, tmp_file)
+                        # import_() modifies the expression in place, but
+                        # the model's expressions are shared.
+                        new_sexpr = text_mangle.import_(copy.deepcopy(sexpr), tmp_file)
                     except text_mangle.NothingChanged:
                         pass
             except Exception as exception:
@@ -860,9 +1701,6 @@ class MainWindow(wx.Frame):
         if exception is not None:
             try:
                 raise exception
-            except text_mangle.CharacterZoneFound:
-                self.error_box(_('Cannot edit text with character zones.'))
-                return
             except text_mangle.LengthChanged:
                 self.error_box(_('Number of lines changed.'))
                 return
@@ -906,6 +1744,7 @@ class MainWindow(wx.Frame):
     def do_open(self, path):
         if isinstance(path, unicode):
             path = path.encode(system_encoding)
+        self.finish_save()
         if self.dirty:
             dialog = wx.MessageDialog(self, _('Do you want to save your changes?'), '', wx.YES_NO | wx.YES_DEFAULT | wx.CANCEL | wx.ICON_QUESTION)
             try:
@@ -920,12 +1759,18 @@ class MainWindow(wx.Frame):
                     return False
             finally:
                 dialog.Destroy()
+        self.stop_search_indexing()
+        self.discard_recovery()
+        self.recovery = None
         self.path = path
         self.document = None
         self.page_no = 0
+        self.journal.clear()
+        recovered = False
         def clear_models():
             self.metadata_model = self.text_model = self.outline_model = self.annotations_model = None
             self.models = ()
+            self.recovery = None
             self.enable_edit(False)
         if path is None:
             clear_models()
@@ -939,6 +1784,18 @@ class MainWindow(wx.Frame):
                 self.outline_model = OutlineModel(self.document)
                 self.annotations_model = AnnotationsModel(path)
                 self.models = self.metadata_model, self.text_model, self.outline_model, self.annotations_model
+                self.recovery = recovery.RecoveryJournal(path)
+                recovered = self.do_recover()
+                for model in self.models:
+                    model.journal = self.journal
+                self.recovery.attach(*self.models)
+                self.start_search_indexing()
+                if recovered:
+                    # The saved index doesn't know about the recovered text.
+                    page_nos = set(n for n, page in self.text_model.iter_page_models())
+                    page_nos.update(n for n, text in self.text_model.iter_serialized_pages())
+                    for page_no in sorted(page_nos):
+                        self.search_index.invalidate_page(page_no)
                 self.enable_edit(True)
             except djvu.decode.JobFailed:
                 clear_models()
@@ -947,7 +1804,7 @@ class MainWindow(wx.Frame):
         self.page_no = 0  # again, to set status bar text
         self.update_title()
         self.update_page_widget(new_document=True, new_page=True)
-        self.dirty = False
+        self.dirty = recovered
         return True
 
     def update_page_widget(self, new_document=False, new_page=False):
@@ -969,10 +1826,10 @@ class MainWindow(wx.Frame):
                 self.document_proxy = DocumentProxy(document=self.document, outline=self.outline_model)
                 self.document_proxy.register_outline_callback(self._outline_callback)
         self.page_widget.page = self.page_proxy
-        self.text_browser.page = self.page_proxy
-        self.maparea_browser.page = self.page_proxy
+        self.text_browser.configure(page=self.page_proxy)
+        self.maparea_browser.configure(page=self.page_proxy)
         if new_document:
-            self.outline_browser.document = self.document_proxy
+            self.outline_browser.configure(document=self.document_proxy)
 
     def update_title(self):
         if self.path is None:
@@ -1052,9 +1909,27 @@ class Application(wx.App):
         sys.excepthook = self.except_hook
         return True
 
+    def start_djvused_discovery(self, window):
+        '''
+        Find djvused in the background, so that it doesn't delay startup.
+        '''
+        def job():
+            try:
+                djvusmooth.djvused.discover(self._config)
+            except djvusmooth.djvused.IOError as exception:
+                wx.CallAfter(window.error_box, str(exception))
+            else:
+                # The config must not be modified in this thread, as it might
+                # be being flushed meanwhile.
+                wx.CallAfter(djvusmooth.djvused.remember, self._config)
+        thread = threading.Thread(target=job)
+        thread.setDaemon(True)
+        thread.start()
+
     def start(self, argv):
         window = MainWindow()
         window.Show(True)
+        self.start_djvused_discovery(window)
         if argv:
             path = argv[0]
             path = os.path.abspath(path)
@@ -16,7 +16,6 @@
 
 import wx
 
-from djvusmooth.gui.maparea_properties import MapareaPropertiesDialog
 from djvusmooth.i18n import _
 
 def show_menu(parent, annotations, node, point, origin=None):
@@ -35,6 +34,7 @@ def show_menu(parent, annotations, node, point, origin=None):
         menu.Destroy()
 
 def on_new_annotation(event, parent, annotations, origin):
+    from djvusmooth.gui.maparea_properties import MapareaPropertiesDialog
     dialog = MapareaPropertiesDialog(parent, origin=origin)
     try:
         if dialog.ShowModal() != wx.ID_OK:
@@ -44,6 +44,7 @@ def on_new_annotation(event, parent, annotations, origin):
         dialog.Destroy()
 
 def on_properties(event, parent, node):
+    from djvusmooth.gui.maparea_properties import MapareaPropertiesDialog
     dialog = MapareaPropertiesDialog(parent, node)
     try:
         if dialog.ShowModal() != wx.ID_OK:
@@ -561,12 +561,7 @@ class PageWidget(wx.lib.ogl.ShapeCanvas):
                 real_page_rect = (0, 0) + real_page_size
                 xform_real_to_screen = decode.AffineTransform(real_page_rect, screen_page_rect)
                 xform_real_to_screen.mirror_y()
-                xform_rotate = decode.AffineTransform((0, 0, 1, 1), (0, 0, 1, 1))
-                xform_rotate.rotate(rotation)
-                text_page_rect = (0, 0) + xform_rotate(real_page_rect)[2:]
-                xform_text_to_screen = decode.AffineTransform(text_page_rect, screen_page_rect)
-                xform_text_to_screen.mirror_y()
-                xform_text_to_screen.rotate(rotation)
+                xform_text_to_screen = models.text.get_image_xform(real_page_size, rotation, screen_page_size)
                 self.set_size(screen_page_size)
             except decode.NotAvailable:
                 screen_page_size = -1, -1
@@ -0,0 +1,99 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+import re
+
+import wx
+
+from djvusmooth.i18n import _
+
+class ReplaceTextDialog(wx.Dialog):
+
+    def __init__(self, parent):
+        wx.Dialog.__init__(self, parent, title=_('Replace text'))
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        grid_sizer = wx.FlexGridSizer(2, 2, 5, 5)
+        grid_sizer.AddGrowableCol(1)
+        self._pattern_edit = wx.TextCtrl(self, size=(240, -1))
+        self._replacement_edit = wx.TextCtrl(self, size=(240, -1))
+        for label, edit in [
+            (_('Regular expression') + ':', self._pattern_edit),
+            (_('Replacement') + ':', self._replacement_edit),
+        ]:
+            grid_sizer.Add(wx.StaticText(self, label=label), 0, wx.ALIGN_CENTER_VERTICAL)
+            grid_sizer.Add(edit, 1, wx.EXPAND)
+        sizer.Add(grid_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        self._ignore_case_box = wx.CheckBox(self, label=_('Ignore case'))
+        sizer.Add(self._ignore_case_box, 0, wx.EXPAND | wx.ALL, 5)
+        line = wx.StaticLine(self, -1, style=wx.LI_HORIZONTAL)
+        sizer.Add(line, 0, wx.EXPAND | wx.BOTTOM | wx.TOP, 5)
+        button_sizer = wx.StdDialogButtonSizer()
+        button = wx.Button(self, wx.ID_OK)
+        button.SetDefault()
+        button_sizer.AddButton(button)
+        button = wx.Button(self, wx.ID_CANCEL)
+        button_sizer.AddButton(button)
+        button_sizer.Realize()
+        sizer.Add(button_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        self.SetSizerAndFit(sizer)
+
+    def get_regex(self):
+        '''
+        Return the compiled regular expression.
+
+        Raise re.error if it's not valid.
+        '''
+        flags = re.UNICODE
+        if self._ignore_case_box.GetValue():
+            flags |= re.IGNORECASE
+        return re.compile(self._pattern_edit.GetValue(), flags)
+
+    def get_replacement(self):
+        return self._replacement_edit.GetValue()
+
+class ReplacePreviewDialog(wx.Dialog):
+
+    '''
+    Show the number of replacements on every page and ask for confirmation.
+    '''
+
+    def __init__(self, parent, counts):
+        wx.Dialog.__init__(self, parent, title=_('Replace text'), style=(wx.DEFAULT_DIALOG_STYLE | wx.RESIZE_BORDER))
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        total = sum(count for page_no, count in counts)
+        message = _('%(count)d replacements on %(npages)d pages.') % dict(count=total, npages=len(counts))
+        sizer.Add(wx.StaticText(self, label=message), 0, wx.EXPAND | wx.ALL, 5)
+        list_ctrl = wx.ListCtrl(self, size=(240, 200), style=(wx.LC_REPORT | wx.LC_SINGLE_SEL))
+        list_ctrl.InsertColumn(0, _('Page'))
+        list_ctrl.InsertColumn(1, _('Replacements'))
+        for i, (page_no, count) in enumerate(counts):
+            list_ctrl.InsertStringItem(i, str(page_no + 1))
+            list_ctrl.SetStringItem(i, 1, str(count))
+        sizer.Add(list_ctrl, 1, wx.EXPAND | wx.ALL, 5)
+        line = wx.StaticLine(self, -1, style=wx.LI_HORIZONTAL)
+        sizer.Add(line, 0, wx.EXPAND | wx.BOTTOM | wx.TOP, 5)
+        button_sizer = wx.StdDialogButtonSizer()
+        button = wx.Button(self, wx.ID_OK, label=_('&Replace'))
+        button.SetDefault()
+        button_sizer.AddButton(button)
+        button = wx.Button(self, wx.ID_CANCEL)
+        button_sizer.AddButton(button)
+        button_sizer.Realize()
+        sizer.Add(button_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        self.SetSizerAndFit(sizer)
+
+__all__ = ['ReplaceTextDialog', 'ReplacePreviewDialog']
+
+# vim:ts=4 sts=4 sw=4 et
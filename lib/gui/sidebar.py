@@ -0,0 +1,58 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+import importlib
+
+import wx
+
+class LazyPage(wx.Panel):
+
+    '''
+    Sidebar page that imports and creates its browser only when it's first
+    activated.
+
+    Until then, attributes passed to configure() are remembered, and then
+    they are set on the browser.
+    '''
+
+    def __init__(self, parent, module_name, class_name):
+        wx.Panel.__init__(self, parent)
+        self._module_name = module_name
+        self._class_name = class_name
+        self._attributes = {}
+        self.browser = None
+        self.SetSizer(wx.BoxSizer(wx.VERTICAL))
+
+    def configure(self, **attributes):
+        if self.browser is None:
+            self._attributes.update(attributes)
+            return
+        for name, value in attributes.iteritems():
+            setattr(self.browser, name, value)
+
+    def activate(self):
+        if self.browser is not None:
+            return
+        module = importlib.import_module(self._module_name)
+        browser = self.browser = getattr(module, self._class_name)(self)
+        for name, value in self._attributes.iteritems():
+            setattr(browser, name, value)
+        self._attributes = None
+        self.GetSizer().Add(browser, 1, wx.EXPAND)
+        self.Layout()
+
+__all__ = ['LazyPage']
+
+# vim:ts=4 sts=4 sw=4 et
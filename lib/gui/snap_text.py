@@ -0,0 +1,56 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+import wx
+
+from djvusmooth.i18n import _
+
+class SnapTextDialog(wx.Dialog):
+
+    def __init__(self, parent):
+        wx.Dialog.__init__(self, parent, title=_('Snap words to ink'))
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        self._scope_box = wx.RadioBox(self,
+            label=(_('Scope') + ':'),
+            choices=(_('current page'), _('all pages')),
+            style=wx.RA_HORIZONTAL
+        )
+        sizer.Add(self._scope_box, 0, wx.EXPAND | wx.ALL, 5)
+        margin_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        self._margin_edit = wx.SpinCtrl(self, min=0, max=100, initial=3)
+        margin_sizer.Add(wx.StaticText(self, label=(_('Search margin (pixels)') + ':')), 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        margin_sizer.Add(self._margin_edit, 1, wx.EXPAND)
+        sizer.Add(margin_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        line = wx.StaticLine(self, -1, style=wx.LI_HORIZONTAL)
+        sizer.Add(line, 0, wx.EXPAND | wx.BOTTOM | wx.TOP, 5)
+        button_sizer = wx.StdDialogButtonSizer()
+        button = wx.Button(self, wx.ID_OK)
+        button.SetDefault()
+        button_sizer.AddButton(button)
+        button = wx.Button(self, wx.ID_CANCEL)
+        button_sizer.AddButton(button)
+        button_sizer.Realize()
+        sizer.Add(button_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        self.SetSizerAndFit(sizer)
+
+    def get_scope(self):
+        return self._scope_box.GetSelection()
+
+    def get_margin(self):
+        return self._margin_edit.GetValue()
+
+__all__ = ['SnapTextDialog']
+
+# vim:ts=4 sts=4 sw=4 et
@@ -59,6 +59,7 @@ class TextBrowser(wx.TreeCtrl):
         self.Bind(wx.EVT_TREE_BEGIN_LABEL_EDIT, self.on_begin_edit, self)
         self.Bind(wx.EVT_TREE_END_LABEL_EDIT, self.on_end_edit, self)
         self.Bind(wx.EVT_TREE_SEL_CHANGED, self.on_selection_changed, self)
+        self.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.on_expanding, self)
         self.Bind(wx.EVT_KEY_DOWN, self.on_key_down)
 
     def on_key_down(self, event):
@@ -68,15 +69,15 @@ class TextBrowser(wx.TreeCtrl):
         try:
             item = self._items[node]
         except KeyError:
+            # Not shown yet, so nothing to update.
             return
         if node.is_inner():
             return
         self.SetItemText(item, get_label_for_node(node))
 
     def on_node_select(self, node):
-        try:
-            item = self._items[node]
-        except KeyError:
+        item = self._get_item(node)
+        if item is None:
             return
         if self.GetSelection() != item:
             self.SelectItem(item)
@@ -138,19 +139,42 @@ class TextBrowser(wx.TreeCtrl):
         node.text = text
         return True
 
-    def _add_children(self, item, parent_node):
+    def on_expanding(self, event):
+        self._add_children(event.GetItem())
+
+    def _get_item(self, node):
+        try:
+            return self._items[node]
+        except KeyError:
+            pass
+        try:
+            parent_item = self._get_item(node.parent)
+        except StopIteration:
+            return
+        if parent_item is None:
+            return
+        self._add_children(parent_item)
+        return self._items.get(node)
+
+    def _add_children(self, item):
+        # Children are added only when they are about to be shown, so that
+        # the text layer is not loaded in its entirety.
+        parent_node = self.GetPyData(item)
+        if parent_node in self._populated_nodes:
+            return
+        self._populated_nodes.add(parent_node)
         if not parent_node.is_inner():
             return
         for node in parent_node:
-            symbol = node.type
             label = get_label_for_node(node)
             child_item = self.AppendItem(item, label)
-            self._add_children(child_item, node)
             self._items[node] = child_item
             self.SetPyData(child_item, node)
+            self.SetItemHasChildren(child_item, node.is_inner())
 
     def _recreate_children(self):
         self._items = {}
+        self._populated_nodes = set()
         root = self.GetRootItem()
         if root.IsOk():
             self.Delete(root)
@@ -163,7 +187,7 @@ class TextBrowser(wx.TreeCtrl):
             self._items[node] = root
             self.SetPyData(root, node)
             self._have_root = True
-            self._add_children(root, node)
+            self.SetItemHasChildren(root, node.is_inner())
 
 __all__ = ['TextBrowser']
 
@@ -0,0 +1,82 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+import wx
+
+from djvusmooth.text import geometry
+from djvusmooth.i18n import _
+
+class TransformTextDialog(wx.Dialog):
+
+    def __init__(self, parent):
+        wx.Dialog.__init__(self, parent, title=_('Transform text'))
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        self._scope_box = wx.RadioBox(self,
+            label=(_('Scope') + ':'),
+            choices=(_('current page'), _('all pages')),
+            style=wx.RA_HORIZONTAL
+        )
+        sizer.Add(self._scope_box, 0, wx.EXPAND | wx.ALL, 5)
+        grid_sizer = wx.FlexGridSizer(5, 2, 5, 5)
+        grid_sizer.AddGrowableCol(1)
+        self._edits = []
+        for label, value in [
+            (_('Horizontal shift (pixels)'), '0'),
+            (_('Vertical shift (pixels, upwards)'), '0'),
+            (_('Horizontal scale (%)'), '100'),
+            (_('Vertical scale (%)'), '100'),
+            (_('Rotation (degrees, counter-clockwise)'), '0'),
+        ]:
+            edit = wx.TextCtrl(self, value=value)
+            grid_sizer.Add(wx.StaticText(self, label=(label + ':')), 0, wx.ALIGN_CENTER_VERTICAL)
+            grid_sizer.Add(edit, 1, wx.EXPAND)
+            self._edits += edit,
+        sizer.Add(grid_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        line = wx.StaticLine(self, -1, style=wx.LI_HORIZONTAL)
+        sizer.Add(line, 0, wx.EXPAND | wx.BOTTOM | wx.TOP, 5)
+        button_sizer = wx.StdDialogButtonSizer()
+        button = wx.Button(self, wx.ID_OK)
+        button.SetDefault()
+        button_sizer.AddButton(button)
+        button = wx.Button(self, wx.ID_CANCEL)
+        button_sizer.AddButton(button)
+        button_sizer.Realize()
+        sizer.Add(button_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        self.SetSizerAndFit(sizer)
+
+    def get_scope(self):
+        return self._scope_box.GetSelection()
+
+    def get_matrix_factory(self):
+        '''
+        Return function that maps page rectangle to the transformation.
+        Scaling and rotation are relative to the page center.
+
+        Raise ValueError if the input is not valid.
+        '''
+        dx, dy, sx, sy, degrees = (float(edit.GetValue()) for edit in self._edits)
+        def get_matrix(page_rect):
+            x, y, w, h = page_rect
+            center = x + w / 2.0, y + h / 2.0
+            return geometry.compose(
+                geometry.scaling(sx / 100, sy / 100, center),
+                geometry.rotation(degrees, center),
+                geometry.translation(dx, dy),
+            )
+        return get_matrix
+
+__all__ = ['TransformTextDialog']
+
+# vim:ts=4 sts=4 sw=4 et
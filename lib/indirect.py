@@ -0,0 +1,244 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Saving indirect documents.
+
+Every page of an indirect document is stored in a separate component file.
+Changes of a page are saved by editing a copy of its component file.
+Components are edited by several djvused processes in parallel. The index
+file is rewritten, as in djvusmooth.safesave, only if document-wide data
+(outline, shared annotations or metadata) has changed. Only once all the
+copies have been verified, they replace the original files.
+
+Changes of shared annotations or metadata are not crash-safe, though: djvused
+writes them directly into the shared annotations component, which is not
+copied beforehand.
+'''
+
+import multiprocessing
+import os
+import threading
+
+import djvu.decode
+
+from djvusmooth import djvused
+from djvusmooth import filecopy
+from djvusmooth import safesave
+from djvusmooth.models import SHARED_ANNOTATIONS_PAGENO
+
+class ComponentEditor(djvused.StreamEditor):
+
+    '''
+    Stream editor for a single-page component file. Any page that is selected
+    is the only page of the file.
+    '''
+
+    def select(self, page_id):
+        djvused.StreamEditor.select(self, 1)
+
+def get_component_paths(document, path):
+    '''
+    Return a dictionary mapping page numbers to paths of their component
+    files, or None if the document is not indirect.
+    '''
+    if document.type != djvu.decode.DOCUMENT_TYPE_INDIRECT:
+        return
+    directory = os.path.dirname(path)
+    return dict(
+        (n, os.path.join(directory, page.file.name))
+        for n, page in enumerate(document.pages)
+    )
+
+def split_snapshots(snapshots, component_paths):
+    '''
+    Split the snapshots into snapshots of pages, grouped by component file,
+    and snapshots that have to be exported to the index file.
+    '''
+    components = {}
+    index_snapshots = []
+    for snapshot in snapshots:
+        n = snapshot.n
+        if n is None or n == SHARED_ANNOTATIONS_PAGENO or n not in component_paths:
+            index_snapshots += snapshot,
+            continue
+        path = component_paths[n]
+        components.setdefault(path, []).append(snapshot)
+    return sorted(components.iteritems()), index_snapshots
+
+def _stage_component(path, snapshots):
+    working_path = safesave.get_working_path(path)
+    try:
+        filecopy.clone_file(path, working_path)
+        sed = ComponentEditor(working_path, autosave=True)
+        for snapshot in snapshots:
+            snapshot.export(sed)
+        sed.commit()
+        safesave.verify(working_path, 1, [0])
+    except:
+        safesave.remove_working_file(working_path)
+        raise
+    return working_path
+
+class NewComponents(object):
+
+    '''
+    New versions of component files of the indirect document whose index file
+    is at path, saved next to them. They replace the component files all at
+    once, after every one of them has been verified.
+
+    component_paths is as returned by get_component_paths(); it's needed only
+    for export().
+    '''
+
+    def __init__(self, path, component_paths=None):
+        self.path = path
+        self._component_paths = component_paths
+        self._staged = []
+        self._lock = threading.Lock()
+
+    def stage(self, component_path, snapshots):
+        '''
+        Export the snapshots to a copy of the component file, and verify it.
+        This can be called from several threads at once.
+        '''
+        working_path = _stage_component(component_path, snapshots)
+        with self._lock:
+            self._staged += (component_path, working_path),
+
+    def export(self, snapshot):
+        '''
+        Stage the component file of the page snapshot, with only this snapshot.
+        '''
+        self.stage(self._component_paths[snapshot.n], [snapshot])
+
+    def finish(self):
+        # Components are verified as soon as they are staged.
+        pass
+
+    def replace(self, lock=None, index_version=None):
+        '''
+        Replace the component files with their new versions; then replace the
+        index file with index_version (a safesave.NewVersion object), if it's
+        not None. The lock, if not None, is held meanwhile.
+
+        The files are only renamed, so this is unlikely to fail; but if it
+        does, only some of them might have been replaced.
+        '''
+        if lock is None:
+            self._replace(index_version)
+            return
+        with lock:
+            self._replace(index_version)
+
+    def _replace(self, index_version):
+        try:
+            for component_path, working_path in self._staged:
+                filecopy.replace_file(working_path, component_path)
+            if index_version is not None:
+                index_version.replace()
+            else:
+                # The index file is intact, but its modification time tells
+                # that the document has changed, e.g. to the recovery journal
+                # and the search index.
+                os.utime(self.path, None)
+        except:
+            self.cancel()
+            if index_version is not None:
+                index_version.cancel()
+            raise
+        self._staged = []
+
+    def cancel(self):
+        '''
+        Discard new versions of the component files that haven't replaced the
+        original ones.
+        '''
+        for component_path, working_path in self._staged:
+            safesave.remove_working_file(working_path)
+        self._staged = []
+
+def save(path, page_count, components, index_snapshots, progress=None, nworkers=None, lock=None):
+    '''
+    Save the (component path, snapshots) pairs using nworkers djvused
+    processes (by default, one per CPU); then export the index snapshots to
+    the index file of the page_count pages document. Files are replaced only
+    after all of them have been saved and verified; the lock, if not None, is
+    held only meanwhile.
+
+    progress(done, total) is called as in djvused.StreamEditor.start(). If it
+    returns false, CommitCancelled is raised, and nothing is replaced.
+    '''
+    if nworkers is None:
+        nworkers = multiprocessing.cpu_count()
+    npages = len(components) + len(set(snapshot.n for snapshot in index_snapshots))
+    total = npages + 1
+    new_components = NewComponents(path)
+    state_lock = threading.Lock()
+    queue = list(reversed(components))
+    state = dict(done=0, cancelled=False, exception=None)
+    def worker():
+        while True:
+            with state_lock:
+                if not queue or state['cancelled'] or state['exception'] is not None:
+                    return
+                component_path, snapshots = queue.pop()
+            try:
+                new_components.stage(component_path, snapshots)
+            except Exception as exception:
+                with state_lock:
+                    if state['exception'] is None:
+                        state['exception'] = exception
+                return
+            with state_lock:
+                state['done'] += 1
+                if progress is not None and not progress(state['done'], total):
+                    state['cancelled'] = True
+    threads = [threading.Thread(target=worker) for i in xrange(min(nworkers, len(components)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    index_version = None
+    try:
+        if state['exception'] is not None:
+            raise state['exception']
+        if state['cancelled']:
+            raise djvused.CommitCancelled
+        if index_snapshots:
+            offset = len(components)
+            def index_progress(done, index_total):
+                return progress(offset + done, offset + index_total)
+            index_version = safesave.NewVersion(path, djvu.decode.DOCUMENT_TYPE_INDIRECT, page_count,
+                progress=(index_progress if progress is not None else None),
+                npages=(npages - offset),
+            )
+            try:
+                for snapshot in index_snapshots:
+                    index_version.export(snapshot)
+            except:
+                index_version.cancel()
+                raise
+            index_version.finish()
+    except:
+        new_components.cancel()
+        raise
+    new_components.replace(lock, index_version)
+    if index_version is None and progress is not None:
+        progress(total, total)
+
+__all__ = ['ComponentEditor', 'NewComponents', 'get_component_paths', 'split_snapshots', 'save']
+
+# vim:ts=4 sts=4 sw=4 et
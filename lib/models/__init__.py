@@ -15,6 +15,30 @@
 
 SHARED_ANNOTATIONS_PAGENO = -1
 
+class Snapshot(object):
+
+    '''
+    State of a dirty model, taken for saving.
+
+    Models must not modify the data in place afterwards, so that the snapshot
+    can be exported in a background thread while the model is being edited.
+    Every modification of the model increases its revision.
+
+    n is the page number, or None for the whole document.
+    '''
+
+    def __init__(self, model, data, n=None):
+        self.model = model
+        self.revision = model.revision
+        self.data = data
+        self.n = n
+
+    def export(self, djvused):
+        self.model.export_data(djvused, self.data)
+
+    def mark_saved(self):
+        self.model.mark_saved(self)
+
 class MultiPageModel(object):
 
     def get_page_model_class(self, n):
@@ -22,15 +46,57 @@ class MultiPageModel(object):
 
     def __init__(self):
         self._pages = {}
+        self._callback_factories = []
+        self._page_callbacks = {}
+        self._journal = None
 
     def __getitem__(self, n):
         if n not in self._pages:
             cls = self.get_page_model_class(n)
-            self._pages[n] = cls(n, self.acquire_data(n))
+            self[n] = cls(n, self.acquire_data(n))
         return self._pages[n]
 
     def __setitem__(self, n, model):
         self._pages[n] = model
+        model.journal = self._journal
+        self._page_callbacks[n] = []
+        for factory in self._callback_factories:
+            self._register_page_callback(n, factory)
+
+    def _register_page_callback(self, n, factory):
+        callback = factory(n)
+        # Page models keep only weak references to their callbacks.
+        self._page_callbacks[n] += callback,
+        self._pages[n].register_callback(callback)
+
+    def register_page_callback_factory(self, factory):
+        '''
+        Register factory(n) as a callback of the n-th page model, for every
+        page model that has been or will be created.
+        '''
+        self._callback_factories += factory,
+        for n in self._pages:
+            self._register_page_callback(n, factory)
+
+    @apply
+    def journal():
+        def get(self):
+            return self._journal
+        def set(self, journal):
+            self._journal = journal
+            for model in self._pages.itervalues():
+                model.journal = journal
+        return property(get, set)
+
+    def _record(self, change):
+        if self._journal is not None:
+            self._journal.record(change)
+
+    def iter_page_models(self):
+        '''
+        Yield (n, page model) pairs for page models that have been created.
+        '''
+        return iter(sorted(self._pages.items()))
 
     def acquire_data(self, n):
         return {}
@@ -39,6 +105,13 @@ class MultiPageModel(object):
         for id in sorted(self._pages):
             self._pages[id].export(djvused)
 
-__all__ = ['MultiPageModel', 'SHARED_ANNOTATIONS_PAGENO']
+    def take_snapshot(self):
+        '''
+        Return list of snapshots of the dirty page models, in the export order.
+        '''
+        snapshots = (self._pages[id].take_snapshot() for id in sorted(self._pages))
+        return [snapshot for snapshot in snapshots if snapshot is not None]
+
+__all__ = ['MultiPageModel', 'Snapshot', 'SHARED_ANNOTATIONS_PAGENO']
 
 # vim:ts=4 sts=4 sw=4 et
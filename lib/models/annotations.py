@@ -28,7 +28,8 @@ import djvu.const
 import djvu.sexpr
 import djvu.decode
 
-from djvusmooth.models import MultiPageModel, SHARED_ANNOTATIONS_PAGENO
+from djvusmooth.models import MultiPageModel, Snapshot, SHARED_ANNOTATIONS_PAGENO
+from djvusmooth.models.journal import Change
 from djvusmooth.varietes import not_overridden, is_html_color
 
 class AnnotationSyntaxError(ValueError):
@@ -400,12 +401,19 @@ class MapArea(Annotation):
         x0, y0, w, h = self._get_rect()
         self._set_rect((x1, y1, w, h))
 
+    def _record_rect_change(self, old_rect):
+        if self._owner is None:
+            return
+        self._owner._record(_MapAreaRectChange(self, old_rect, self._get_rect()))
+
     @apply
     def origin():
         def get(self):
             return self._get_origin()
         def set(self, rect):
+            old_rect = self._get_rect()
             self._set_origin(rect)
+            self._record_rect_change(old_rect)
             self._notify_change()
         return property(get, set)
 
@@ -414,7 +422,9 @@ class MapArea(Annotation):
         def get(self):
             return self._get_rect()
         def set(self, rect):
+            old_rect = self._get_rect()
             self._set_rect(rect)
+            self._record_rect_change(old_rect)
             self._notify_change()
         return property(get, set)
 
@@ -840,11 +850,77 @@ ANNOTATION_TYPE_TO_CLASS = {
     djvu.const.ANNOTATION_MAPAREA: MapArea
 }
 
+class _MapAreaRectChange(Change):
+
+    def __init__(self, node, old_rect, new_rect):
+        self._node = node
+        self._old_rect = old_rect
+        self._new_rect = new_rect
+        self.page_nos = node._owner._n,
+
+    def _set(self, rect):
+        self._node._set_rect(rect)
+        self._node._notify_change()
+
+    def undo(self):
+        self._set(self._old_rect)
+
+    def redo(self):
+        self._set(self._new_rect)
+
+class _MapAreaAdd(Change):
+
+    def __init__(self, owner, node, i):
+        self._owner = owner
+        self._node = node
+        self._i = i
+        self.page_nos = owner._n,
+
+    def _add(self):
+        self._owner.insert_maparea(self._i, self._node)
+        self._node._owner = self._owner
+
+    def _remove(self):
+        self._owner.remove_maparea(self._node)
+        self._node._owner = None
+
+    def undo(self):
+        self._remove()
+
+    def redo(self):
+        self._add()
+
+class _MapAreaRemoval(_MapAreaAdd):
+
+    def undo(self):
+        self._add()
+
+    def redo(self):
+        self._remove()
+
+class _MapAreaReplacement(Change):
+
+    def __init__(self, owner, node, other_node):
+        self._owner = owner
+        self._node = node
+        self._other_node = other_node
+        self.page_nos = owner._n,
+
+    def undo(self):
+        self._owner.replace_maparea(self._other_node, self._node)
+        self._node._owner = self._owner
+
+    def redo(self):
+        self._owner.replace_maparea(self._node, self._other_node)
+        self._other_node._owner = self._owner
+
 class PageAnnotations(object):
 
     def __init__(self, n, original_data):
         self._old_data = original_data
         self._callbacks = weakref.WeakKeyDictionary()
+        self.journal = None
+        self.revision = 0
         self.revert()
         self._n = n
 
@@ -865,15 +941,27 @@ class PageAnnotations(object):
             result[cls].append(item)
         return result
 
-    def add_maparea(self, node):
-        self._data[MapArea] += node,
+    def _record(self, change):
+        if self.journal is not None:
+            self.journal.record(change)
+
+    def insert_maparea(self, i, node):
+        self._data[MapArea].insert(i, node)
         self.notify_node_add(node)
 
+    def add_maparea(self, node):
+        mapareas = self._data[MapArea]
+        self._record(_MapAreaAdd(self, node, len(mapareas)))
+        self.insert_maparea(len(mapareas), node)
+
     def remove_maparea(self, node):
+        mapareas = self._data[MapArea]
         try:
-            self._data[MapArea].remove(node)
+            i = mapareas.index(node)
         except ValueError:
             return
+        del mapareas[i]
+        self._record(_MapAreaRemoval(self, node, i))
         self.notify_node_delete(node)
 
     def replace_maparea(self, node, other_node):
@@ -883,6 +971,7 @@ class PageAnnotations(object):
         except ValueError:
             return
         mapareas[i] = other_node
+        self._record(_MapAreaReplacement(self, node, other_node))
         self.notify_node_replace(node, other_node)
 
     @property
@@ -896,29 +985,49 @@ class PageAnnotations(object):
     def export(self, djvused):
         if not self._dirty:
             return
+        self.export_data(djvused, self._get_sexprs())
+
+    def _get_sexprs(self):
+        return [node.sexpr for nodes in self._data.itervalues() for node in nodes]
+
+    def export_data(self, djvused, sexprs):
         self.export_select(djvused)
-        djvused.set_annotations(node.sexpr for nodes in self._data.itervalues() for node in nodes)
+        djvused.set_annotations(sexprs)
+
+    def take_snapshot(self):
+        if not self._dirty:
+            return
+        return Snapshot(self, self._get_sexprs(), self._n)
+
+    def mark_saved(self, snapshot):
+        self._old_data = snapshot.data
+        if self.revision == snapshot.revision:
+            self._dirty = False
 
     def export_select(self, djvused):
         djvused.select(self._n + 1)
 
     def notify_node_add(self, node):
         self._dirty = True
+        self.revision += 1
         for callback in self._callbacks:
             callback.notify_node_add(node)
 
     def notify_node_change(self, node):
         self._dirty = True
+        self.revision += 1
         for callback in self._callbacks:
             callback.notify_node_change(node)
 
     def notify_node_replace(self, node, other_node):
         self._dirty = True
+        self.revision += 1
         for callback in self._callbacks:
             callback.notify_node_replace(node, other_node)
 
     def notify_node_delete(self, node):
         self._dirty = True
+        self.revision += 1
         for callback in self._callbacks:
             callback.notify_node_delete(node)
 
@@ -0,0 +1,178 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Undo/redo journal.
+
+Models record reversible changes (deltas) rather than snapshots of pages.
+When the estimated memory usage of the journal exceeds the limit, the oldest
+changes are forgotten.
+'''
+
+import collections
+import contextlib
+
+DEFAULT_MAX_SIZE = 64 << 20
+
+class Change(object):
+
+    '''
+    A reversible change of a model.
+
+    size is a rough estimate of memory held by the change, in bytes;
+    page_nos are numbers of the affected pages.
+    '''
+
+    size = 128
+    page_nos = ()
+
+    def undo(self):
+        raise NotImplementedError
+
+    def redo(self):
+        raise NotImplementedError
+
+class ChangeGroup(Change):
+
+    def __init__(self, changes):
+        self.changes = changes
+        self.size = sum(change.size for change in changes)
+        self.page_nos = tuple(sorted(set(n for change in changes for n in change.page_nos)))
+
+    def undo(self):
+        for change in reversed(self.changes):
+            change.undo()
+
+    def redo(self):
+        for change in self.changes:
+            change.redo()
+
+class Journal(object):
+
+    '''
+    >>> class Append(Change):
+    ...     def __init__(self, list, item):
+    ...         self.list = list
+    ...         self.item = item
+    ...     def undo(self):
+    ...         self.list.pop()
+    ...     def redo(self):
+    ...         self.list.append(self.item)
+    >>> journal = Journal(max_size=(3 * Change.size))
+    >>> items = []
+    >>> for i in xrange(5):
+    ...     items.append(i)
+    ...     journal.record(Append(items, i))
+    >>> while journal.can_undo():
+    ...     change = journal.undo()
+    >>> items
+    [0, 1]
+    >>> change = journal.redo()
+    >>> items
+    [0, 1, 2]
+
+    The latest change is kept even if it alone exceeds the limit:
+
+    >>> journal.max_size = 0
+    >>> items.append(3)
+    >>> journal.record(Append(items, 3))
+    >>> journal.can_undo()
+    True
+    '''
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._undo_changes = collections.deque()
+        self._redo_changes = []
+        self._size = 0
+        self._group = None
+        self._suspended = False
+
+    @property
+    def size(self):
+        return self._size
+
+    def record(self, change):
+        if self._suspended:
+            return
+        if self._group is not None:
+            self._group += change,
+            return
+        for old_change in self._redo_changes:
+            self._size -= old_change.size
+        self._redo_changes = []
+        self._undo_changes.append(change)
+        self._size += change.size
+        while self._size > self.max_size and len(self._undo_changes) > 1:
+            self._size -= self._undo_changes.popleft().size
+
+    @contextlib.contextmanager
+    def group(self):
+        '''
+        Record changes made within the context as a single change.
+        '''
+        if self._group is not None:
+            yield
+            return
+        self._group = group = []
+        try:
+            yield
+        finally:
+            self._group = None
+            if group:
+                self.record(ChangeGroup(group))
+
+    @contextlib.contextmanager
+    def _suspend(self):
+        self._suspended = True
+        try:
+            yield
+        finally:
+            self._suspended = False
+
+    def can_undo(self):
+        return bool(self._undo_changes)
+
+    def can_redo(self):
+        return bool(self._redo_changes)
+
+    def undo(self):
+        '''
+        Undo the most recent change, and return it.
+        '''
+        change = self._undo_changes.pop()
+        with self._suspend():
+            change.undo()
+        self._redo_changes += change,
+        return change
+
+    def redo(self):
+        '''
+        Redo the most recently undone change, and return it.
+        '''
+        change = self._redo_changes.pop()
+        with self._suspend():
+            change.redo()
+        self._undo_changes.append(change)
+        return change
+
+    def clear(self):
+        self._undo_changes.clear()
+        self._redo_changes = []
+        self._size = 0
+
+__all__ = ['Journal', 'Change', 'ChangeGroup', 'DEFAULT_MAX_SIZE']
+
+# vim:ts=4 sts=4 sw=4 et
@@ -22,7 +22,11 @@ See ``djvuchanges.txt``:
 - 5. Document Annotations and Metadata.
 '''
 
-from djvusmooth.models import MultiPageModel, SHARED_ANNOTATIONS_PAGENO
+import weakref
+
+from djvusmooth.models import MultiPageModel, Snapshot, SHARED_ANNOTATIONS_PAGENO
+from djvusmooth.models.journal import Change
+from djvusmooth.varietes import not_overridden
 
 class Metadata(MultiPageModel):
 
@@ -32,26 +36,103 @@ class Metadata(MultiPageModel):
         else:
             return PageMetadata
 
+class PageMetadataCallback(object):
+
+    @not_overridden
+    def notify_key_change(self, key):
+        pass
+
+_MISSING = object()
+
+class _KeyChange(Change):
+
+    def __init__(self, metadata, key, old_value, new_value):
+        self._metadata = metadata
+        self._key = key
+        self._old_value = old_value
+        self._new_value = new_value
+        self.page_nos = metadata._n,
+
+    def _set(self, value):
+        if value is _MISSING:
+            del self._metadata[self._key]
+        else:
+            self._metadata[self._key] = value
+
+    def undo(self):
+        self._set(self._old_value)
+
+    def redo(self):
+        self._set(self._new_value)
+
 class PageMetadata(dict):
 
     def __init__(self, n, original_data):
         self._old_data = None
         self._dirty = False
+        self.revision = 0
         self._n = n
+        self._callbacks = weakref.WeakKeyDictionary()
+        self.journal = None
         self.load(original_data, overwrite=True)
 
+    def register_callback(self, callback):
+        if not isinstance(callback, PageMetadataCallback):
+            raise TypeError
+        self._callbacks[callback] = 1
+
+    def notify_key_change(self, key):
+        for callback in self._callbacks:
+            callback.notify_key_change(key)
+
+    def _record(self, key, new_value):
+        if self.journal is not None:
+            self.journal.record(_KeyChange(self, key, self.get(key, _MISSING), new_value))
+
     def __setitem__(self, key, value):
+        self._record(key, value)
         self._dirty = True
+        self.revision += 1
         dict.__setitem__(self, key, value)
+        self.notify_key_change(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._record(key, _MISSING)
+        dict.__delitem__(self, key)
+        self._dirty = True
+        self.revision += 1
+        self.notify_key_change(key)
+
+    def assign(self, other):
+        '''
+        Make the metadata equal to the other one, changing only the keys that
+        differ.
+        '''
+        for key in list(self):
+            if key not in other:
+                del self[key]
+        for key, value in other.iteritems():
+            if self.get(key, _MISSING) != value:
+                self[key] = value
 
     def clone(self):
-        from copy import copy
-        return copy(self)
+        # copy.copy() would fill the clone with __setitem__(), while the
+        # clone still shared the journal and callbacks.
+        clone = dict.__new__(type(self))
+        clone.__dict__.update(self.__dict__)
+        dict.update(clone, self)
+        clone._callbacks = weakref.WeakKeyDictionary()
+        clone.journal = None
+        return clone
 
     def load(self, original_data, overwrite=False):
         if self._old_data is not None or overwrite:
             self._old_data = dict(original_data)
-            self.revert()
+            dict.clear(self)
+            dict.update(self, self._old_data)
+            self._dirty = False
 
     def export_select(self, djvused):
         djvused.select(self._n + 1)
@@ -59,19 +140,38 @@ class PageMetadata(dict):
     def export(self, djvused):
         if not self._dirty:
             return
+        self.export_data(djvused, self)
+
+    def export_data(self, djvused, meta):
         self.export_select(djvused)
-        djvused.set_metadata(self)
+        djvused.set_metadata(meta)
+
+    def take_snapshot(self):
+        if not self._dirty:
+            return
+        return Snapshot(self, dict(self), self._n)
+
+    def mark_saved(self, snapshot):
+        self._old_data = snapshot.data
+        # Even reverting since the snapshot makes the model differ from the
+        # saved data.
+        self._dirty = self.revision != snapshot.revision
 
     def revert(self, key=None):
         if key is None:
-            self.clear()
-            self.update(self._old_data)
+            # Keys are reverted one by one, so that the changes are recorded.
+            if self.journal is None:
+                self.assign(self._old_data)
+            else:
+                with self.journal.group():
+                    self.assign(self._old_data)
             self._dirty = False
         else:
             try:
                 self[key] = self._old_data[key]
             except KeyError:
-                del self[key]
+                if key in self:
+                    del self[key]
 
     def is_dirty(self, key=None):
         if key is None:
@@ -87,6 +187,6 @@ class SharedMetadata(PageMetadata):
     def export_select(self, djvused):
         djvused.create_shared_annotations()
 
-__all__ = ['Metadata', 'PageMetadata', 'SharedMetadata']
+__all__ = ['Metadata', 'PageMetadata', 'PageMetadataCallback', 'SharedMetadata']
 
 # vim:ts=4 sts=4 sw=4 et
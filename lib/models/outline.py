@@ -27,6 +27,8 @@ import itertools
 import djvu.sexpr
 import djvu.const
 
+from djvusmooth.models import Snapshot
+from djvusmooth.models.journal import Change
 from djvusmooth.varietes import not_overridden, wref, fix_uri, indents_to_tree
 
 class Node(object):
@@ -48,24 +50,28 @@ class Node(object):
             child._link_right = wref(prev)
             prev = child
 
+    def _insert_child(self, i, node):
+        self._children.insert(i, node)
+        self._set_children(self._children)
+        self._owner.notify_child_insertion(self, i)
+
+    def _remove_child(self, i):
+        child = self._children.pop(i)
+        child._link_left = child._link_right = child._link_parent = wref(None)
+        self._set_children(self._children)
+        self._owner.notify_child_removal(self, i)
+
+    def insert_child(self, i, node):
+        self._insert_child(i, node)
+        self._owner._record(_ChildInsertion(self, i, node))
+
     def add_child(self, node):
-        self._children
-        if self._children:
-            self._children[-1]._link_ref = wref(node)
-            node._link_right = wref(self._children[-1])
-        node._link_parent = wref(self)
-        self._children += node,
-        self._notify_children_change()
+        self.insert_child(len(self._children), node)
 
     def remove_child(self, child):
-        child_idx = self._children.index(child)
-        if child_idx - 1 >= 0:
-            self._children[child_idx - 1]._link_right = child._link_right
-        if child_idx + 1 < len(self._children):
-            self._children[child_idx + 1]._link_left = child._link_left
-        child._link_left = child._link_right = child._link_parent = wref(None)
-        del self._children[child_idx]
-        self._notify_children_change()
+        i = self._children.index(child)
+        self._remove_child(i)
+        self._owner._record(_ChildRemoval(self, i, child))
 
     uri = property()
     text = property()
@@ -129,9 +135,6 @@ class Node(object):
     def notify_select(self):
         self._owner.notify_node_select(self)
 
-    def _notify_children_change(self):
-        return self._owner.notify_node_children_change(self)
-
 class RootNode(Node):
 
     def __init__(self, sexpr, owner):
@@ -170,6 +173,7 @@ class InnerNode(Node):
         def get(self):
             return self._uri
         def set(self, value):
+            self._owner._record(_NodeChange(self, 'uri', self._uri, value))
             self._uri = value
             self._notify_change()
         return property(get, set)
@@ -179,6 +183,7 @@ class InnerNode(Node):
         def get(self):
             return self._text
         def set(self, value):
+            self._owner._record(_NodeChange(self, 'text', self._text, value))
             self._text = value
             self._notify_change()
         return property(get, set)
@@ -202,6 +207,71 @@ class InnerNode(Node):
             return
         parent.remove_child(self)
 
+def _count_nodes(node):
+    return 1 + sum(_count_nodes(child) for child in node)
+
+class _NodeChange(Change):
+
+    def __init__(self, node, name, old_value, new_value):
+        self._node = node
+        self._name = name
+        self._old_value = old_value
+        self._new_value = new_value
+        self.size += 4 * (len(old_value) + len(new_value))
+
+    def undo(self):
+        setattr(self._node, self._name, self._old_value)
+
+    def redo(self):
+        setattr(self._node, self._name, self._new_value)
+
+class _ChildInsertion(Change):
+
+    def __init__(self, parent, i, child):
+        self._parent = parent
+        self._i = i
+        self._child = child
+
+    def undo(self):
+        self._parent._remove_child(self._i)
+
+    def redo(self):
+        self._parent._insert_child(self._i, self._child)
+
+class _ChildRemoval(Change):
+
+    def __init__(self, parent, i, child):
+        self._parent = parent
+        self._i = i
+        self._child = child
+
+    def undo(self):
+        self._parent._insert_child(self._i, self._child)
+
+    def redo(self):
+        self._parent._remove_child(self._i)
+
+class _TreeChange(Change):
+
+    '''
+    Replacement of the whole outline. Nodes of the old tree are kept.
+    '''
+
+    def __init__(self, outline, old_root, new_root):
+        self._outline = outline
+        self._old_root = old_root
+        self._new_root = new_root
+        self.size += Change.size * (_count_nodes(old_root) + _count_nodes(new_root))
+
+    def _set(self, root):
+        self._outline._set_root(root)
+
+    def undo(self):
+        self._set(self._old_root)
+
+    def redo(self):
+        self._set(self._new_root)
+
 class OutlineCallback(object):
 
     @not_overridden
@@ -216,6 +286,18 @@ class OutlineCallback(object):
     def notify_node_children_change(self, node):
         pass
 
+    def notify_child_insertion(self, node, i):
+        '''
+        The node got a new i-th child.
+        '''
+        self.notify_node_children_change(node)
+
+    def notify_child_removal(self, node, i):
+        '''
+        The i-th child of the node has been removed.
+        '''
+        self.notify_node_children_change(node)
+
     @not_overridden
     def notify_node_select(self, node):
         pass
@@ -225,6 +307,9 @@ class Outline(object):
     def __init__(self):
         self._callbacks = weakref.WeakKeyDictionary()
         self._original_sexpr = self.acquire_data()
+        self._root = None
+        self.journal = None
+        self.revision = 0
         self.revert()
 
     def register_callback(self, callback):
@@ -245,10 +330,20 @@ class Outline(object):
         def set(self, sexpr):
             if not sexpr:
                 sexpr = djvu.const.EMPTY_OUTLINE
-            self._root = RootNode(sexpr, self)
-            self.notify_tree_change()
+            old_root = self._root
+            self._set_root(RootNode(sexpr, self))
+            if old_root is not None:
+                self._record(_TreeChange(self, old_root, self._root))
         return property(get, set)
 
+    def _set_root(self, root):
+        self._root = root
+        self.notify_tree_change()
+
+    def _record(self, change):
+        if self.journal is not None:
+            self.journal.record(change)
+
     def remove(self):
         self.raw_value = djvu.const.EMPTY_OUTLINE
 
@@ -261,19 +356,34 @@ class Outline(object):
 
     def notify_tree_change(self):
         self._dirty = True
+        self.revision += 1
         for callback in self._callbacks:
             callback.notify_tree_change(self._root)
 
     def notify_node_change(self, node):
         self._dirty = True
+        self.revision += 1
         for callback in self._callbacks:
             callback.notify_node_change(node)
 
     def notify_node_children_change(self, node):
         self._dirty = True
+        self.revision += 1
         for callback in self._callbacks:
             callback.notify_node_children_change(node)
 
+    def notify_child_insertion(self, node, i):
+        self._dirty = True
+        self.revision += 1
+        for callback in self._callbacks:
+            callback.notify_child_insertion(node, i)
+
+    def notify_child_removal(self, node, i):
+        self._dirty = True
+        self.revision += 1
+        for callback in self._callbacks:
+            callback.notify_child_removal(node, i)
+
     def notify_node_select(self, node):
         for callback in self._callbacks:
             callback.notify_node_select(node)
@@ -285,6 +395,25 @@ class Outline(object):
             value = None
         djvused.set_outline(value)
 
+    def export_data(self, djvused, sexpr):
+        if len(sexpr) == 1:
+            # No entries, only the "bookmarks" symbol.
+            sexpr = None
+        djvused.set_outline(sexpr)
+
+    def take_snapshot(self):
+        '''
+        Return list of snapshots of the outline, if it's dirty.
+        '''
+        if not self._dirty:
+            return []
+        return [Snapshot(self, self.raw_value)]
+
+    def mark_saved(self, snapshot):
+        self._original_sexpr = snapshot.data
+        if self.revision == snapshot.revision:
+            self._dirty = False
+
     def export_as_plaintext(self, stream):
         return self.root.export_as_plaintext(stream)
 
@@ -21,124 +21,585 @@ See Lizardtech DjVu Reference (DjVu 3):
 - 8.3.5 Text Chunk.
 '''
 
+import array
 import copy
 import weakref
 import itertools
 
+import djvu.const
 import djvu.decode
 import djvu.sexpr
 
-from djvusmooth.varietes import not_overridden, wref
-from djvusmooth.models import MultiPageModel
+from djvusmooth.varietes import not_overridden
+from djvusmooth.text import geometry
+from djvusmooth.models import MultiPageModel, Snapshot
+from djvusmooth.models.journal import Change
+
+_ZONE_TYPES = (
+    djvu.const.TEXT_ZONE_PAGE,
+    djvu.const.TEXT_ZONE_COLUMN,
+    djvu.const.TEXT_ZONE_REGION,
+    djvu.const.TEXT_ZONE_PARAGRAPH,
+    djvu.const.TEXT_ZONE_LINE,
+    djvu.const.TEXT_ZONE_WORD,
+    djvu.const.TEXT_ZONE_CHARACTER,
+)
+
+_ZONE_TYPE_CODES = dict((zone_type, code) for code, zone_type in enumerate(_ZONE_TYPES))
+
+NO_ZONE = -1
+
+def _is_leaf_sexpr(sexpr):
+    return len(sexpr) == 6 and isinstance(sexpr[5], djvu.sexpr.StringExpression)
+
+class Zones(object):
+
+    '''
+    Text zones of a single page.
+
+    Zones are identified by their indices; their attributes are kept in typed
+    arrays rather than in per-zone Python objects. Zones that are removed from
+    the tree are merely unlinked.
+
+    Children of a zone are loaded from the S-expression only when they are
+    first needed. Until then, the S-expression is kept in .pending.
+
+    Serialized subtrees are cached in .sexprs; every modification drops the
+    cached S-expressions of the zone and its ancestors. The returned
+    S-expressions are shared, so they must not be modified in place.
+
+    Preorder, postorder and leaf orders are computed once and kept in .orders
+    until the structure of the tree changes. Likewise, arrays of children of
+    zones are kept in .child_lists, so that children can be accessed by index.
+    '''
+
+    def __init__(self, owner):
+        self.owner = owner
+        self.types = array.array('B')
+        self.rects = array.array('i')  # x, y, w, h for every zone
+        self.parents = array.array('i')
+        self.left_siblings = array.array('i')
+        self.right_siblings = array.array('i')
+        self.first_children = array.array('i')
+        self.last_children = array.array('i')
+        self.text_offsets = array.array('i')
+        self.text_lengths = array.array('i')  # -1 for inner zones
+        self.text = array.array('u')
+        self.pending = {}
+        self.sexprs = {}
+        self.orders = None
+        self.child_lists = {}
+        self.root = NO_ZONE
+
+    _ARRAYS = (
+        'types', 'rects',
+        'parents', 'left_siblings', 'right_siblings', 'first_children', 'last_children',
+        'text_offsets', 'text_lengths', 'text',
+    )
+
+    def __len__(self):
+        return len(self.types)
+
+    def copy(self):
+        other = copy.copy(self)
+        for name in self._ARRAYS:
+            setattr(other, name, getattr(self, name)[:])
+        other.pending = dict(self.pending)
+        other.sexprs = dict(self.sexprs)
+        other.orders = None
+        other.child_lists = {}
+        return other
+
+    def get_size(self):
+        '''
+        Return estimated memory usage of the zone arrays, in bytes.
+        '''
+        return sum(getattr(self, name).itemsize * len(getattr(self, name)) for name in self._ARRAYS)
+
+    def _add(self, sexpr, parent):
+        n = len(self.types)
+        self.types.append(_ZONE_TYPE_CODES[djvu.const.get_text_zone_type(sexpr[0].value)])
+        x0, y0, x1, y1 = (sexpr[i].value for i in xrange(1, 5))
+        self.rects.extend((x0, y0, x1 - x0, y1 - y0))
+        self.parents.append(parent)
+        self.right_siblings.append(NO_ZONE)
+        self.first_children.append(NO_ZONE)
+        self.last_children.append(NO_ZONE)
+        if parent == NO_ZONE:
+            self.left_siblings.append(NO_ZONE)
+        else:
+            self.child_lists.pop(parent, None)
+            left = self.last_children[parent]
+            self.left_siblings.append(left)
+            if left == NO_ZONE:
+                self.first_children[parent] = n
+            else:
+                self.right_siblings[left] = n
+            self.last_children[parent] = n
+        if _is_leaf_sexpr(sexpr):
+            self.text_offsets.append(0)
+            self.text_lengths.append(0)
+            self._set_text(n, sexpr[5].value.decode('UTF-8', 'replace'))
+        else:
+            self.text_offsets.append(0)
+            self.text_lengths.append(-1)
+            self.pending[n] = sexpr
+        return n
+
+    def load(self, sexpr):
+        self.root = self._add(sexpr, NO_ZONE)
+
+    def expand(self, n):
+        sexpr = self.pending.pop(n, None)
+        if sexpr is None:
+            return
+        # Until something changes, the original S-expression is still good.
+        self.sexprs[n] = sexpr
+        for child_sexpr in sexpr[5:]:
+            self._add(child_sexpr, n)
+
+    def get_first_child(self, n):
+        self.expand(n)
+        return self.first_children[n]
+
+    def is_leaf(self, n):
+        return self.text_lengths[n] >= 0
+
+    def get_type(self, n):
+        return _ZONE_TYPES[self.types[n]]
+
+    def get_rect(self, n):
+        i = 4 * n
+        return tuple(self.rects[i:i + 4])
+
+    def invalidate(self, n):
+        while n != NO_ZONE:
+            self.sexprs.pop(n, None)
+            n = self.parents[n]
+
+    def set_rect(self, n, rect):
+        self.expand(n)  # the pending S-expression would be stale
+        self.invalidate(n)
+        i = 4 * n
+        self.rects[i:i + 4] = array.array('i', rect)
+
+    def get_text(self, n):
+        length = self.text_lengths[n]
+        if length < 0:
+            return
+        offset = self.text_offsets[n]
+        return self.text[offset:offset + length].tounicode()
+
+    def _set_text(self, n, text):
+        # Old text is not reclaimed, but edits are rare compared to the amount
+        # of text loaded from the document.
+        self.text_offsets[n] = len(self.text)
+        self.text_lengths[n] = len(text)
+        self.text.fromunicode(text)
+
+    def set_text(self, n, text):
+        if not self.is_leaf(n):
+            raise TypeError
+        if isinstance(text, str):
+            text = text.decode('UTF-8', 'replace')
+        self.invalidate(n)
+        self._set_text(n, text)
+
+    def iter_children(self, n):
+        self.expand(n)
+        child = self.first_children[n]
+        while child != NO_ZONE:
+            yield child
+            child = self.right_siblings[child]
+
+    def get_children(self, n):
+        '''
+        Return an array of children of the zone. The array must not be
+        modified.
+        '''
+        children = self.child_lists.get(n)
+        if children is None:
+            children = self.child_lists[n] = array.array('i', self.iter_children(n))
+        return children
+
+    def get_index(self, n):
+        '''
+        Return position of the zone among its siblings.
+        '''
+        i = 0
+        left = self.left_siblings[n]
+        while left != NO_ZONE:
+            i += 1
+            left = self.left_siblings[left]
+        return i
+
+    def insert(self, parent, i, sexpr):
+        '''
+        Add a zone (with descendants) made of the S-expression as the i-th
+        child of the parent zone. Return the new zone.
+        '''
+        children = self.get_children(parent)
+        left = children[i - 1] if i > 0 else NO_ZONE
+        n = self._add(sexpr, parent)
+        self.unlink(n)
+        self.link(n, parent, left)
+        return n
+
+    def unlink(self, n):
+        parent = self.parents[n]
+        self.invalidate(parent)
+        self.orders = None
+        self.child_lists.pop(parent, None)
+        left = self.left_siblings[n]
+        right = self.right_siblings[n]
+        if left != NO_ZONE:
+            self.right_siblings[left] = right
+        elif parent != NO_ZONE:
+            self.first_children[parent] = right
+        if right != NO_ZONE:
+            self.left_siblings[right] = left
+        elif parent != NO_ZONE:
+            self.last_children[parent] = left
+        self.parents[n] = self.left_siblings[n] = self.right_siblings[n] = NO_ZONE
+
+    def link(self, n, parent, left):
+        '''
+        Link the unlinked zone back into the tree, as the right sibling of
+        left (or the first child of parent).
+        '''
+        self.invalidate(parent)
+        self.orders = None
+        self.child_lists.pop(parent, None)
+        if left == NO_ZONE:
+            right = self.first_children[parent]
+            self.first_children[parent] = n
+        else:
+            right = self.right_siblings[left]
+            self.right_siblings[left] = n
+        if right == NO_ZONE:
+            self.last_children[parent] = n
+        else:
+            self.left_siblings[right] = n
+        self.parents[n] = parent
+        self.left_siblings[n] = left
+        self.right_siblings[n] = right
+
+    def load_subtree(self, n, sexpr):
+        '''
+        Replace rectangle and descendants of the zone with those of the
+        S-expression.
+        '''
+        self.set_children(n, ())
+        self.pending.pop(n, None)
+        x0, y0, x1, y1 = (sexpr[i].value for i in xrange(1, 5))
+        self.rects[4 * n:4 * n + 4] = array.array('i', (x0, y0, x1 - x0, y1 - y0))
+        if _is_leaf_sexpr(sexpr):
+            self._set_text(n, sexpr[5].value.decode('UTF-8', 'replace'))
+        else:
+            self.text_lengths[n] = -1
+            self.pending[n] = sexpr
+        self.invalidate(n)
+
+    def set_children(self, n, children):
+        self.invalidate(n)
+        self.orders = None
+        self.child_lists.pop(n, None)
+        for child in list(self.iter_children(n)):
+            self.unlink(child)
+        left = NO_ZONE
+        for child in children:
+            self.parents[child] = n
+            self.left_siblings[child] = left
+            if left == NO_ZONE:
+                self.first_children[n] = child
+            else:
+                self.right_siblings[left] = child
+            left = child
+        self.last_children[n] = left
+
+    def make_leaf(self, n, text):
+        self.pending.pop(n, None)
+        self.set_children(n, ())
+        self._set_text(n, text)
+        self.invalidate(n)
+
+    def get_orders(self):
+        if self.orders is None:
+            self.orders = _Orders(self)
+        return self.orders
+
+    def strip(self, n, zone_type):
+        '''
+        Remove zones of the zone_type type and below from the subtree.
+
+        Return n if the zone survived, or (text, separator) otherwise.
+        '''
+        stripped = {}
+        for m in self.get_orders().get_postorder(n):
+            zone_type_m = self.get_type(m)
+            if self.is_leaf(m):
+                if zone_type_m <= zone_type:
+                    stripped[m] = self.get_text(m), djvu.const.TEXT_ZONE_SEPARATORS[zone_type_m]
+                else:
+                    stripped[m] = m
+                continue
+            stripped_children = [stripped.pop(child) for child in self.iter_children(m)]
+            texts = [child for child in stripped_children if isinstance(child, tuple)]
+            child_separator = texts[-1][1] if texts else ''
+            text = child_separator.join(text for text, separator in texts)
+            if zone_type_m <= zone_type:
+                stripped[m] = text, djvu.const.TEXT_ZONE_SEPARATORS[zone_type_m]
+                continue
+            node_children = [child for child in stripped_children if not isinstance(child, tuple)]
+            if node_children:
+                self.set_children(m, node_children)
+            else:
+                self.make_leaf(m, text)
+            stripped[m] = m
+        return stripped[n]
+
+    def transform(self, matrix):
+        '''
+        Apply the affine transformation to all the zones but the root.
+        '''
+        self.get_orders()  # make sure that all the zones are expanded
+        root_rect = self.get_rect(self.root)
+        geometry.transform_rects(self.rects, matrix)
+        self.rects[4 * self.root:4 * self.root + 4] = array.array('i', root_rect)
+        self.sexprs.clear()
+
+    def set_rects(self, ns, rects):
+        '''
+        Set rectangles of many zones at once, then fit other inner zones but
+        the root to their children.
+        '''
+        orders = self.get_orders()  # make sure that all the zones are expanded
+        ns = list(ns)
+        for i, n in enumerate(ns):
+            self.rects[4 * n:4 * n + 4] = array.array('i', rects[i])
+        fixed = set(ns)
+        fixed.add(self.root)
+        for n in orders.get_postorder():
+            if n in fixed or self.is_leaf(n):
+                continue
+            children = list(self.iter_children(n))
+            if not children:
+                continue
+            x0s, y0s, x1s, y1s = zip(*(self._get_corners(child) for child in children))
+            x0, y0 = min(x0s), min(y0s)
+            self.rects[4 * n:4 * n + 4] = array.array('i', (x0, y0, max(x1s) - x0, max(y1s) - y0))
+        self.sexprs.clear()
+
+    def _get_corners(self, n):
+        x, y, w, h = self.get_rect(n)
+        return x, y, x + w, y + h
+
+    def get_sexpr(self, n):
+        try:
+            return self.pending[n]
+        except LookupError:
+            pass
+        try:
+            return self.sexprs[n]
+        except LookupError:
+            pass
+        x, y, w, h = self.get_rect(n)
+        head = (self.get_type(n), x, y, x + w, y + h)
+        if self.is_leaf(n):
+            sexpr = djvu.sexpr.Expression(head + (self.get_text(n),))
+        else:
+            child_sexprs = [self.get_sexpr(child) for child in self.iter_children(n)]
+            if not child_sexprs:
+                # FIXME: this needs a better solution
+                child_sexprs = [djvu.sexpr.Expression('')]
+            sexpr = djvu.sexpr.Expression(itertools.chain(head, child_sexprs))
+        self.sexprs[n] = sexpr
+        return sexpr
+
+class _Orders(object):
+
+    '''
+    Flat traversal orders of a zone tree.
+
+    The subtree of every zone occupies a contiguous range of each order.
+    '''
+
+    def __init__(self, zones):
+        self.preorder = preorder = array.array('i')
+        self.postorder = postorder = array.array('i')
+        self.leafs = leafs = array.array('i')
+        # The following arrays are indexed by zones:
+        self._preorder_starts = array.array('i')
+        self._preorder_ends = array.array('i')
+        self._leaf_starts = array.array('i')
+        self._leaf_ends = array.array('i')
+        self._postorder_positions = array.array('i')
+        stack = [(zones.root, False)]
+        while stack:
+            n, visited = stack.pop()
+            if not visited:
+                self._grow(len(zones))
+                self._preorder_starts[n] = len(preorder)
+                self._leaf_starts[n] = len(leafs)
+                preorder.append(n)
+                if zones.is_leaf(n):
+                    leafs.append(n)
+                else:
+                    stack += (n, True),
+                    stack += ((child, False) for child in reversed(list(zones.iter_children(n))))
+                    continue
+            self._preorder_ends[n] = len(preorder)
+            self._leaf_ends[n] = len(leafs)
+            self._postorder_positions[n] = len(postorder)
+            postorder.append(n)
+
+    def _grow(self, size):
+        missing = size - len(self._preorder_starts)
+        if missing <= 0:
+            return
+        padding = array.array('i', [NO_ZONE]) * missing
+        for ranges in self._preorder_starts, self._preorder_ends, self._leaf_starts, self._leaf_ends, self._postorder_positions:
+            ranges.extend(padding)
+
+    def get_preorder(self, n=None):
+        if n is None:
+            return self.preorder
+        return self.preorder[self._preorder_starts[n]:self._preorder_ends[n]]
+
+    def get_postorder(self, n=None):
+        if n is None:
+            return self.postorder
+        end = self._postorder_positions[n] + 1
+        return self.postorder[end - self._preorder_ends[n] + self._preorder_starts[n]:end]
+
+    def get_leafs(self, n=None):
+        if n is None:
+            return self.leafs
+        return self.leafs[self._leaf_starts[n]:self._leaf_ends[n]]
 
 class Node(object):
 
-    def __new__(cls, sexpr, owner):
-        if len(sexpr) == 6 and isinstance(sexpr[5], djvu.sexpr.StringExpression):
+    '''
+    A lightweight view of a text zone.
+
+    Views are created on demand; two views of the same zone compare equal.
+    '''
+
+    __slots__ = ('_zones', '_n')
+
+    def __new__(cls, zones, n):
+        if zones.is_leaf(n):
             cls = LeafNode
         else:
             cls = InnerNode
         return object.__new__(cls)
 
-    def __init__(self, sexpr, owner):
-        self._owner = owner
-        self._type = djvu.const.get_text_zone_type(sexpr[0].value)
-        x0, y0, x1, y1 = (sexpr[i].value for i in xrange(1, 5))
-        self._x = x0
-        self._y = y0
-        self._w = x1 - x0
-        self._h = y1 - y0
-        self._link_left = self._link_right = self._link_parent = wref(None)
+    def __init__(self, zones, n):
+        self._zones = zones
+        self._n = n
+
+    def __eq__(self, other):
+        if not isinstance(other, Node):
+            return NotImplemented
+        return self._zones is other._zones and self._n == other._n
+
+    def __ne__(self, other):
+        if not isinstance(other, Node):
+            return NotImplemented
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._zones), self._n))
+
+    def _get_node(self, n):
+        if n == NO_ZONE:
+            raise StopIteration
+        return Node(self._zones, n)
 
     @property
     def sexpr(self):
-        return self._construct_sexpr()
-
-    def _construct_sexpr(self):
-        raise NotImplementedError
+        return self._zones.get_sexpr(self._n)
 
     @apply
     def separator():
         def get(self):
-            return djvu.const.TEXT_ZONE_SEPARATORS[self._type]
+            return djvu.const.TEXT_ZONE_SEPARATORS[self.type]
         return property(get)
 
+    def _set_rect(self, rect):
+        zones = self._zones
+        old_rect = zones.get_rect(self._n)
+        zones.set_rect(self._n, rect)
+        zones.owner._record(_RectChange(zones, self._n, old_rect, zones.get_rect(self._n)))
+        self._notify_change()
+
+    def _set_rect_item(self, i, value):
+        rect = list(self._zones.get_rect(self._n))
+        rect[i] = value
+        self._set_rect(rect)
+
     @apply
     def x():
         def get(self):
-            return self._x
+            return self._zones.get_rect(self._n)[0]
         def set(self, value):
-            self._x = value
-            self._notify_change()
+            self._set_rect_item(0, value)
         return property(get, set)
 
     @apply
     def y():
         def get(self):
-            return self._y
+            return self._zones.get_rect(self._n)[1]
         def set(self, value):
-            self._y = value
-            self._notify_change()
+            self._set_rect_item(1, value)
         return property(get, set)
 
     @apply
     def w():
         def get(self):
-            return self._w
+            return self._zones.get_rect(self._n)[2]
         def set(self, value):
-            self._w = value
-            self._notify_change()
+            self._set_rect_item(2, value)
         return property(get, set)
 
     @apply
     def h():
         def get(self):
-            return self._h
+            return self._zones.get_rect(self._n)[3]
         def set(self, value):
-            self._h = value
-            self._notify_change()
+            self._set_rect_item(3, value)
         return property(get, set)
 
     @apply
     def rect():
         def get(self):
-            return self._x, self._y, self._w, self._h
+            return self._zones.get_rect(self._n)
         def set(self, value):
-            self._x, self._y, self._w, self._h = value
-            self._notify_change()
+            self._set_rect(value)
         return property(get, set)
 
     @apply
     def type():
         def get(self):
-            return self._type
+            return self._zones.get_type(self._n)
         return property(get)
 
     @apply
     def left_sibling():
         def get(self):
-            link = self._link_left()
-            if link is None:
-                raise StopIteration
-            return link
+            return self._get_node(self._zones.left_siblings[self._n])
         return property(get)
 
     @apply
     def right_sibling():
         def get(self):
-            link = self._link_right()
-            if link is None:
-                raise StopIteration
-            return link
+            return self._get_node(self._zones.right_siblings[self._n])
         return property(get)
 
     @apply
     def parent():
         def get(self):
-            link = self._link_parent()
-            if link is None:
-                raise StopIteration
-            return link
+            return self._get_node(self._zones.parents[self._n])
         return property(get)
 
     @apply
@@ -167,36 +628,30 @@ class Node(object):
         return False
 
     def notify_select(self):
-        self._owner.notify_node_select(self)
+        self._zones.owner.notify_node_select(self)
 
     def notify_deselect(self):
-        self._owner.notify_node_deselect(self)
+        self._zones.owner.notify_node_deselect(self)
 
     def _notify_change(self):
-        return self._owner.notify_node_change(self)
-
-    def _notify_children_change(self):
-        return self._owner.notify_node_children_change(self)
+        return self._zones.owner.notify_node_change(self)
 
 class LeafNode(Node):
 
+    __slots__ = ()
+
     def is_leaf(self):
         return True
 
-    def __init__(self, sexpr, owner):
-        Node.__init__(self, sexpr, owner)
-        self._text = sexpr[5].value.decode('UTF-8', 'replace')
-
-    def _construct_sexpr(self):
-        x, y, w, h = self.x, self.y, self.w, self.h
-        return djvu.sexpr.Expression((self.type, x, y, x + w, y + h, self.text))
-
     @apply
     def text():
         def get(self):
-            return self._text
+            return self._zones.get_text(self._n)
         def set(self, value):
-            self._text = value
+            zones = self._zones
+            old_text = zones.get_text(self._n)
+            zones.set_text(self._n, value)
+            zones.owner._record(_TextChange(zones, self._n, old_text, zones.get_text(self._n)))
             self._notify_change()
         return property(get, set)
 
@@ -219,39 +674,11 @@ class LeafNode(Node):
 
 class InnerNode(Node):
 
+    __slots__ = ()
+
     def is_inner(self):
         return True
 
-    def __init__(self, sexpr, owner):
-        Node.__init__(self, sexpr, owner)
-        self._set_children(Node(child, self._owner) for child in sexpr[5:])
-
-    def _set_children(self, children):
-        self._children = list(children)
-        prev = None
-        for child in self._children:
-            child._link_left = wref(prev)
-            child._link_parent = wref(self)
-            prev = child
-        prev = None
-        for child in reversed(self._children):
-            child._link_right = wref(prev)
-            prev = child
-
-    def _construct_sexpr(self):
-        x, y, w, h = self.x, self.y, self.w, self.h
-        if self._children:
-            child_sexprs = (child.sexpr for child in self)
-        else:
-            # FIXME: this needs a better solution
-            child_sexprs = (djvu.sexpr.Expression(''),)
-        return djvu.sexpr.Expression(
-            itertools.chain(
-                (self.type, x, y, x + w, y + h),
-                child_sexprs
-            )
-        )
-
     @apply
     def text():
         return property()
@@ -259,56 +686,389 @@ class InnerNode(Node):
     @apply
     def left_child():
         def get(self):
-            return iter(self._children).next()
+            return self._get_node(self._zones.get_first_child(self._n))
         return property(get)
 
     def remove_child(self, child):
-        child_idx = self._children.index(child)
-        if child_idx - 1 >= 0:
-            self._children[child_idx - 1]._link_right = child._link_right
-        if child_idx + 1 < len(self._children):
-            self._children[child_idx + 1]._link_left = child._link_left
-        child._link_left = child._link_right = child._link_parent = wref(None)
-        del self._children[child_idx]
-        self._notify_children_change()
+        if child._zones is not self._zones or self._zones.parents[child._n] != self._n:
+            raise ValueError('{0!r} is not a child of {1!r}'.format(child, self))
+        zones = self._zones
+        i = zones.get_index(child._n)
+        left = zones.left_siblings[child._n]
+        zones.unlink(child._n)
+        zones.owner._record(_ChildRemoval(zones, child._n, self._n, left))
+        zones.owner.notify_child_removal(self, i)
+
+    def insert_child(self, i, sexpr):
+        '''
+        Insert a zone made of the S-expression as the i-th child.
+        '''
+        zones = self._zones
+        n = zones.insert(self._n, i, sexpr)
+        zones.owner._record(_ChildInsertion(zones, n, self._n, zones.left_siblings[n]))
+        zones.owner.notify_child_insertion(self, i)
 
     def strip(self, zone_type):
-        stripped_children = [child.strip(zone_type) for child in self._children]
-        if self.type <= zone_type:
-            texts = [text for text, child_separator in stripped_children]
-            return child_separator.join(texts), self.separator
-        else:
-            node_children = [child for child in stripped_children if isinstance(child, Node)]
-            if node_children:
-                self._set_children(node_children)
-                return self
-            else:
-                texts = [text for text, child_separator in stripped_children]
-                text = child_separator.join(texts)
-                return Node(
-                    djvu.sexpr.Expression((
-                        self.type,
-                        self.x, self.y,
-                        self.x + self.w, self.y + self.h,
-                        text
-                    )), self._owner
-                )
-        return self
-
-    def __getitem__(self, n):
-        return self._children[n]
+        stripped = self._zones.strip(self._n, zone_type)
+        if isinstance(stripped, tuple):
+            return stripped
+        return Node(self._zones, stripped)
+
+    def __getitem__(self, i):
+        zones = self._zones
+        children = zones.get_children(self._n)
+        if isinstance(i, slice):
+            return [Node(zones, child) for child in children[i]]
+        return Node(zones, children[i])
 
     def __len__(self):
-        return len(self._children)
+        return len(self._zones.get_children(self._n))
 
     def __iter__(self):
-        return iter(self._children)
+        zones = self._zones
+        return (Node(zones, child) for child in zones.iter_children(self._n))
+
+class _RectChange(Change):
+
+    def __init__(self, zones, n, old_rect, new_rect):
+        self._zones = zones
+        self._n = n
+        self._old_rect = old_rect
+        self._new_rect = new_rect
+        self.page_nos = zones.owner._n,
+
+    def _set(self, rect):
+        self._zones.set_rect(self._n, rect)
+        self._zones.owner.notify_node_change(Node(self._zones, self._n))
+
+    def undo(self):
+        self._set(self._old_rect)
+
+    def redo(self):
+        self._set(self._new_rect)
+
+class _TextChange(Change):
+
+    def __init__(self, zones, n, old_text, new_text):
+        self._zones = zones
+        self._n = n
+        self._old_text = old_text
+        self._new_text = new_text
+        self.size += 4 * (len(old_text) + len(new_text))
+        self.page_nos = zones.owner._n,
+
+    def _set(self, text):
+        self._zones.set_text(self._n, text)
+        self._zones.owner.notify_node_change(Node(self._zones, self._n))
+
+    def undo(self):
+        self._set(self._old_text)
+
+    def redo(self):
+        self._set(self._new_text)
+
+class _ChildRemoval(Change):
+
+    def __init__(self, zones, n, parent, left):
+        self._zones = zones
+        self._n = n
+        self._parent = parent
+        self._left = left
+        self.page_nos = zones.owner._n,
+
+    def _link(self):
+        zones = self._zones
+        zones.link(self._n, self._parent, self._left)
+        zones.owner.notify_child_insertion(Node(zones, self._parent), zones.get_index(self._n))
+
+    def _unlink(self):
+        zones = self._zones
+        i = zones.get_index(self._n)
+        zones.unlink(self._n)
+        zones.owner.notify_child_removal(Node(zones, self._parent), i)
+
+    def undo(self):
+        self._link()
+
+    def redo(self):
+        self._unlink()
+
+class _ChildInsertion(_ChildRemoval):
+
+    def undo(self):
+        self._unlink()
+
+    def redo(self):
+        self._link()
+
+class _TreeChange(Change):
+
+    '''
+    Replacement of all the zones of a page. Zones that were modified in place
+    are copied beforehand.
+    '''
+
+    def __init__(self, page_text, old_zones, new_zones):
+        self._page_text = page_text
+        self._old_zones = old_zones
+        self._new_zones = new_zones
+        if old_zones is not None:
+            self.size += old_zones.get_size()
+        self.page_nos = page_text._n,
+
+    def _set(self, zones):
+        self._page_text._zones = zones
+        self._page_text.notify_tree_change()
+
+    def undo(self):
+        self._set(self._old_zones)
+
+    def redo(self):
+        self._set(self._new_zones)
+
+ORIGINAL_TEXT = object()
+
+class _SerializedPagesChange(Change):
+
+    def __init__(self, text, old_pages, new_pages):
+        self._text = text
+        self._old_pages = old_pages
+        self._new_pages = new_pages
+        self.size += sum(len(page) for pages in (old_pages, new_pages) for n, page in pages if isinstance(page, str))
+        self.page_nos = tuple(n for n, page in new_pages)
+
+    def undo(self):
+        self._text.restore_serialized_pages(self._old_pages)
+
+    def redo(self):
+        self._text.restore_serialized_pages(self._new_pages)
+
+def get_image_xform(page_size, rotation, image_size):
+    '''
+    Return transform from text zone coordinates to coordinates of the page
+    image, as displayed (i.e. rotated) and scaled to image_size, with the
+    origin at the top-left corner.
+    '''
+    xform_rotate = djvu.decode.AffineTransform((0, 0, 1, 1), (0, 0, 1, 1))
+    xform_rotate.rotate(rotation)
+    text_page_rect = (0, 0) + xform_rotate((0, 0) + tuple(page_size))[2:]
+    xform = djvu.decode.AffineTransform(text_page_rect, (0, 0) + tuple(image_size))
+    xform.mirror_y()
+    xform.rotate(rotation)
+    return xform
+
+def strip_sexpr(sexpr, zone_type):
+    '''
+    Remove zones of the zone_type type and below from the page text.
+
+    Return the new page text, or None if nothing is left.
+    '''
+    zone_type = djvu.const.get_text_zone_type(zone_type)
+    if not sexpr:
+        return
+    zones = Zones(None)
+    zones.load(sexpr)
+    if isinstance(zones.strip(zones.root, zone_type), tuple):
+        return
+    return zones.get_sexpr(zones.root)
+
+def transform_sexpr(sexpr, get_matrix):
+    '''
+    Apply the affine transformation get_matrix(page_rect) to all the zones of
+    the page text but the page zone itself. Return the new page text.
+    '''
+    if not sexpr:
+        return sexpr
+    zones = Zones(None)
+    zones.load(sexpr)
+    zones.transform(get_matrix(zones.get_rect(zones.root)))
+    return zones.get_sexpr(zones.root)
+
+class _SerializedPageSnapshot(object):
+
+    def __init__(self, text, n, page_text):
+        self._text = text
+        self.n = n
+        self._page_text = page_text
+
+    def export(self, djvused):
+        djvused.select(self.n + 1)
+        djvused.set_text(self._page_text)
+
+    def mark_saved(self):
+        self._text.mark_serialized_page_saved(self.n, self._page_text)
+
+class TextCallback(object):
+
+    @not_overridden
+    def notify_serialized_pages_change(self, pages):
+        pass
 
 class Text(MultiPageModel):
 
+    '''
+    Besides page models, the text model can hold pages that were changed in
+    bulk. They are kept serialized, and page models are created for them only
+    when requested.
+    '''
+
+    def __init__(self):
+        MultiPageModel.__init__(self)
+        self._serialized_pages = {}
+        self._callbacks = weakref.WeakKeyDictionary()
+
+    def register_callback(self, callback):
+        if not isinstance(callback, TextCallback):
+            raise TypeError
+        self._callbacks[callback] = 1
+
     def get_page_model_class(self, n):
         return PageText
 
+    def __getitem__(self, n):
+        if n in self._serialized_pages and n not in self._pages:
+            model = PageText(n, self.acquire_data(n))
+            model.raw_value = self._get_serialized_page(n)
+            del self._serialized_pages[n]
+            self[n] = model
+        return MultiPageModel.__getitem__(self, n)
+
+    def _get_serialized_page(self, n):
+        text = self._serialized_pages[n]
+        if text is not None:
+            return djvu.sexpr.Expression.from_string(text)
+
+    def prefetch_data(self, n):
+        '''
+        Start acquiring data for the n-th page, without waiting for it.
+        '''
+        pass
+
+    def iter_page_texts(self, page_nos, window=16):
+        '''
+        Yield (n, sexpr) pairs with the current text of pages that don't have
+        page models yet. Data for the next window pages is acquired in advance.
+
+        Neither page models nor the model itself are modified, so this can be
+        run in a background thread.
+        '''
+        page_nos = [n for n in page_nos if n not in self._pages]
+        for n in page_nos[:window]:
+            self.prefetch_data(n)
+        for i, n in enumerate(page_nos):
+            if i + window < len(page_nos):
+                self.prefetch_data(page_nos[i + window])
+            try:
+                sexpr = self._get_serialized_page(n)
+            except LookupError:
+                sexpr = self.acquire_data(n)
+            yield n, sexpr
+
+    def iter_stripped_pages(self, page_nos, zone_type):
+        '''
+        Strip pages that don't have page models yet, as with strip_sexpr().
+
+        Yield (n, text) pairs, where text is serialized, or None if nothing is
+        left. Pages that stripping doesn't change are skipped.
+        '''
+        return self._iter_modified_pages(page_nos, lambda sexpr: strip_sexpr(sexpr, zone_type))
+
+    def iter_transformed_pages(self, page_nos, get_matrix):
+        '''
+        Transform pages that don't have page models yet, as with
+        transform_sexpr().
+
+        Yield (n, text) pairs, where text is serialized. Pages that the
+        transformation doesn't change are skipped.
+        '''
+        return self._iter_modified_pages(page_nos, lambda sexpr: transform_sexpr(sexpr, get_matrix))
+
+    def _iter_modified_pages(self, page_nos, modify):
+        for n, sexpr in self.iter_page_texts(page_nos):
+            if not sexpr:
+                continue
+            text = modify(sexpr)
+            if text is not None:
+                text = str(text)
+                if text == str(sexpr):
+                    continue
+            yield n, text
+
+    def iter_serialized_pages(self):
+        '''
+        Yield (n, text) pairs for pages that are kept serialized.
+        '''
+        return iter(sorted(self._serialized_pages.items()))
+
+    def set_serialized_pages(self, pages):
+        '''
+        Replace text of pages that don't have page models with serialized text,
+        e.g. results of iter_stripped_pages().
+        '''
+        pages = list(pages)
+        old_pages = []
+        for n, text in pages:
+            if n in self._pages:
+                raise ValueError('page {0} already has a model'.format(n))
+            old_pages += (n, self._serialized_pages.get(n, ORIGINAL_TEXT)),
+            self._serialized_pages[n] = text
+        self._record(_SerializedPagesChange(self, old_pages, pages))
+        self.notify_serialized_pages_change(pages)
+
+    def restore_serialized_pages(self, pages):
+        '''
+        Set text of the pages to the serialized text, or to the original one
+        if it's ORIGINAL_TEXT. Page models are updated, if they exist.
+        '''
+        changed_pages = []
+        for n, text in pages:
+            model = self._pages.get(n)
+            if model is not None:
+                # The page model has been created in the meantime.
+                if text is ORIGINAL_TEXT:
+                    model.raw_value = self.acquire_data(n)
+                else:
+                    model.raw_value = text and djvu.sexpr.Expression.from_string(text)
+            elif text is ORIGINAL_TEXT:
+                self._serialized_pages.pop(n, None)
+                changed_pages += (n, text),
+            else:
+                self._serialized_pages[n] = text
+                changed_pages += (n, text),
+        self.notify_serialized_pages_change(changed_pages)
+
+    def notify_serialized_pages_change(self, pages):
+        for callback in self._callbacks:
+            callback.notify_serialized_pages_change(pages)
+
+    def export(self, djvused):
+        for snapshot in self.take_snapshot():
+            snapshot.export(djvused)
+
+    def take_snapshot(self):
+        '''
+        Return list of snapshots of the dirty page models and of the
+        serialized pages, in the page order.
+        '''
+        snapshots = []
+        for n in sorted(set(self._pages) | set(self._serialized_pages)):
+            try:
+                snapshot = self._pages[n].take_snapshot()
+            except LookupError:
+                snapshot = _SerializedPageSnapshot(self, n, self._serialized_pages[n])
+            if snapshot is not None:
+                snapshots += snapshot,
+        return snapshots
+
+    def mark_serialized_page_saved(self, n, text):
+        '''
+        Forget the serialized text of the page, unless it has changed since it
+        was saved. acquire_data() must then return the saved text, i.e. the
+        document has to be reopened.
+        '''
+        if self._serialized_pages.get(n, ORIGINAL_TEXT) is text:
+            del self._serialized_pages[n]
+
 class PageTextCallback(object):
 
     @not_overridden
@@ -319,6 +1079,18 @@ class PageTextCallback(object):
     def notify_node_children_change(self, node):
         pass
 
+    def notify_child_insertion(self, node, i):
+        '''
+        The node got a new i-th child.
+        '''
+        self.notify_node_children_change(node)
+
+    def notify_child_removal(self, node, i):
+        '''
+        The i-th child of the node has been removed.
+        '''
+        self.notify_node_children_change(node)
+
     @not_overridden
     def notify_node_select(self, node):
         pass
@@ -336,8 +1108,11 @@ class PageText(object):
     def __init__(self, n, original_data):
         self._callbacks = weakref.WeakKeyDictionary()
         self._original_sexpr = original_data
-        self.revert()
+        self._zones = None
         self._n = n
+        self.journal = None
+        self.revision = 0
+        self.revert()
 
     def register_callback(self, callback):
         if not isinstance(callback, PageTextCallback):
@@ -347,41 +1122,116 @@ class PageText(object):
     @apply
     def root():
         def get(self):
-            return self._root
+            if self._zones is None:
+                return None
+            return Node(self._zones, self._zones.root)
         return property(get)
 
     @apply
     def raw_value():
         def get(self):
-            if self._root is None:
+            if self._zones is None:
                 return None
-            return self._root.sexpr
+            return self._zones.get_sexpr(self._zones.root)
         def set(self, sexpr):
+            old_zones = self._zones
             if sexpr:
-                self._root = Node(sexpr, self)
+                self._zones = Zones(self)
+                self._zones.load(sexpr)
             else:
-                self._root = None
+                self._zones = None
+            self._record_tree_change(old_zones)
             self.notify_tree_change()
         return property(get, set)
 
+    def _record(self, change):
+        if self.journal is not None:
+            self.journal.record(change)
+
+    def _record_tree_change(self, old_zones):
+        if self.journal is not None:
+            self.journal.record(_TreeChange(self, old_zones, self._zones))
+
+    def _detach_zones(self):
+        '''
+        Prepare zones for modification in place. Return the zones to be
+        recorded as the old ones.
+        '''
+        old_zones = self._zones
+        if self.journal is not None:
+            self._zones = old_zones.copy()
+        return old_zones
+
     def strip(self, zone_type):
         zone_type = djvu.const.get_text_zone_type(zone_type)  # ensure it's not a plain Symbol
-        if self._root is None:
+        if self._zones is None:
             return
-        stripped_root = self._root.strip(zone_type)
+        old_zones = self._detach_zones()
+        stripped_root = self.root.strip(zone_type)
         if not isinstance(stripped_root, Node):
-            stripped_root = None
-        self._root = stripped_root
+            self._zones = None
+        self._record_tree_change(old_zones)
+        self.notify_tree_change()
+
+    def transform(self, matrix):
+        '''
+        Apply the affine transformation (see djvusmooth.text.geometry) to all
+        the zones but the page zone.
+        '''
+        if self._zones is None:
+            return
+        old_zones = self._detach_zones()
+        self._zones.transform(matrix)
+        self._record_tree_change(old_zones)
+        self.notify_tree_change()
+
+    def set_rects(self, nodes, rects):
+        '''
+        Set (x, y, w, h) rectangles of the nodes, and fit their ancestors
+        (except the page zone) to them.
+        '''
+        if self._zones is None:
+            return
+        ns = [node._n for node in nodes]
+        old_zones = self._detach_zones()
+        self._zones.set_rects(ns, rects)
+        self._record_tree_change(old_zones)
         self.notify_tree_change()
 
+    def set_subtree(self, node, sexpr):
+        '''
+        Replace rectangle and descendants of the node with those of the
+        S-expression.
+        '''
+        n = node._n
+        old_zones = self._detach_zones()
+        zones = self._zones
+        zones.load_subtree(n, sexpr)
+        self._record_tree_change(old_zones)
+        self.notify_node_children_change(Node(zones, n))
+
     def clone(self):
         return copy.copy(self)
 
     def export(self, djvused):
         if not self._dirty:
             return
+        self.export_data(djvused, self.raw_value)
+
+    def export_data(self, djvused, sexpr):
         djvused.select(self._n + 1)
-        djvused.set_text(self.raw_value)
+        djvused.set_text(sexpr)
+
+    def take_snapshot(self):
+        if not self._dirty:
+            return
+        # The S-expressions are never modified in place.
+        return Snapshot(self, self.raw_value, self._n)
+
+    def mark_saved(self, snapshot):
+        self._original_sexpr = snapshot.data
+        if self.revision == snapshot.revision:
+            self._dirty = False
 
     def revert(self):
         self.raw_value = self._original_sexpr
@@ -389,14 +1239,28 @@ class PageText(object):
 
     def notify_node_change(self, node):
         self._dirty = True
+        self.revision += 1
         for callback in self._callbacks:
             callback.notify_node_change(node)
 
     def notify_node_children_change(self, node):
         self._dirty = True
+        self.revision += 1
         for callback in self._callbacks:
             callback.notify_node_children_change(node)
 
+    def notify_child_insertion(self, node, i):
+        self._dirty = True
+        self.revision += 1
+        for callback in self._callbacks:
+            callback.notify_child_insertion(node, i)
+
+    def notify_child_removal(self, node, i):
+        self._dirty = True
+        self.revision += 1
+        for callback in self._callbacks:
+            callback.notify_child_removal(node, i)
+
     def notify_node_select(self, node):
         for callback in self._callbacks:
             callback.notify_node_select(node)
@@ -407,47 +1271,38 @@ class PageText(object):
 
     def notify_tree_change(self):
         self._dirty = True
+        self.revision += 1
         for callback in self._callbacks:
-            callback.notify_tree_change(self._root)
-
-    def get_preorder_nodes(self):
-        if self.root is None:
-            return ()
-        return _get_preorder_nodes(self.root)
+            callback.notify_tree_change(self.root)
 
-    def get_postorder_nodes(self):
-        if self.root is None:
+    def _get_nodes(self, get_order, node):
+        zones = self._zones
+        if zones is None:
             return ()
-        return _get_postorder_nodes(self.root)
-
-    def get_leafs(self):
-        if self.root is None:
-            return ()
-        return _get_leafs(self.root)
-
-def _get_preorder_nodes(node):
-    yield node
-    if isinstance(node, LeafNode):
-        return
-    for child in node:
-        for item in _get_preorder_nodes(child):
-            yield item
-
-def _get_postorder_nodes(node):
-    if isinstance(node, InnerNode):
-        for child in node:
-            for item in _get_postorder_nodes(child):
-                yield item
-    yield node
-
-def _get_leafs(node):
-    if isinstance(node, LeafNode):
-        yield node
-    else:
-        for child in node:
-            for item in _get_leafs(child):
-                yield item
-
-__all__ = ['Text', 'PageText']
+        if node is not None:
+            node = node._n
+        return (Node(zones, n) for n in get_order(zones.get_orders(), node))
+
+    def get_preorder_nodes(self, node=None):
+        return self._get_nodes(_Orders.get_preorder, node)
+
+    def get_postorder_nodes(self, node=None):
+        return self._get_nodes(_Orders.get_postorder, node)
+
+    def get_leafs(self, node=None):
+        return self._get_nodes(_Orders.get_leafs, node)
+
+    def get_nodes(self, zone_type, node=None):
+        '''
+        Return zones of the zone_type type within the node subtree (or within
+        the whole page), e.g. all words of a line.
+        '''
+        zone_type = djvu.const.get_text_zone_type(zone_type)
+        return (descendant for descendant in self.get_preorder_nodes(node) if descendant.type == zone_type)
+
+__all__ = [
+    'Text', 'TextCallback', 'PageText', 'ORIGINAL_TEXT',
+    'strip_sexpr', 'transform_sexpr', 'get_image_xform',
+]
 
 # vim:ts=4 sts=4 sw=4 et
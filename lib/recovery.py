@@ -0,0 +1,450 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Crash recovery of unsaved changes.
+
+Changes of the models are appended to a journal file next to the document,
+one S-expression per line. Every record describes only the changed part of a
+model: a single text zone, a hyperlink, a metadata key, etc. The records are
+replayed onto freshly loaded models when the document is opened again.
+'''
+
+import errno
+import functools
+import os
+
+import djvu.sexpr
+
+from djvusmooth import models
+import djvusmooth.models.annotations
+import djvusmooth.models.metadata
+import djvusmooth.models.outline
+import djvusmooth.models.text
+
+FORMAT_VERSION = 1
+
+_MAGIC = djvu.sexpr.Symbol('djvusmooth-journal')
+
+_TEXT_NODE = djvu.sexpr.Symbol('text-node')
+_TEXT_SUBTREE = djvu.sexpr.Symbol('text-subtree')
+_TEXT_INSERT = djvu.sexpr.Symbol('text-insert')
+_TEXT_REMOVE = djvu.sexpr.Symbol('text-remove')
+_TEXT_PAGE = djvu.sexpr.Symbol('text-page')
+_TEXT_SERIALIZED = djvu.sexpr.Symbol('text-serialized')
+_TEXT_ORIGINAL = djvu.sexpr.Symbol('text-original')
+_MAPAREA_INSERT = djvu.sexpr.Symbol('maparea-insert')
+_MAPAREA_SET = djvu.sexpr.Symbol('maparea-set')
+_MAPAREA_DELETE = djvu.sexpr.Symbol('maparea-delete')
+_MAPAREA_PAGE = djvu.sexpr.Symbol('maparea-page')
+_METADATA_SET = djvu.sexpr.Symbol('metadata-set')
+_METADATA_DELETE = djvu.sexpr.Symbol('metadata-delete')
+_METADATA_PAGE = djvu.sexpr.Symbol('metadata-page')
+_OUTLINE = djvu.sexpr.Symbol('outline')
+_OUTLINE_NODE = djvu.sexpr.Symbol('outline-node')
+_OUTLINE_INSERT = djvu.sexpr.Symbol('outline-insert')
+_OUTLINE_REMOVE = djvu.sexpr.Symbol('outline-remove')
+
+def get_journal_path(document_path):
+    '''
+    Return path of the journal file of the document.
+    '''
+    directory, name = os.path.split(document_path)
+    return os.path.join(directory, '.%s.djvusmooth-journal' % name)
+
+def get_document_key(document_path):
+    '''
+    Return a key that changes whenever the document is modified.
+    '''
+    stat = os.stat(document_path)
+    return repr(stat.st_mtime), int(stat.st_size)
+
+def get_node_path(node):
+    '''
+    Return child indices leading from the page zone to the text node.
+    '''
+    path = []
+    while True:
+        try:
+            parent = node.parent
+        except StopIteration:
+            break
+        i = 0
+        sibling = node
+        while True:
+            try:
+                sibling = sibling.left_sibling
+            except StopIteration:
+                break
+            i += 1
+        path += i,
+        node = parent
+    return tuple(reversed(path))
+
+def get_outline_node_path(node):
+    '''
+    Return child indices leading from the outline root to the node.
+    '''
+    path = []
+    while True:
+        try:
+            parent = node.parent
+        except StopIteration:
+            break
+        path += list(parent).index(node),
+        node = parent
+    return tuple(reversed(path))
+
+def get_node(page_text, path):
+    node = page_text.root
+    for i in path:
+        node = node[i]
+    return node
+
+def get_outline_node(outline, path):
+    node = outline.root
+    for i in path:
+        node = node[i]
+    return node
+
+class PageTextRecorder(models.text.PageTextCallback):
+
+    def __init__(self, journal, n):
+        self._journal = journal
+        self._n = n
+
+    def notify_node_change(self, node):
+        record = [_TEXT_NODE, self._n, get_node_path(node)] + list(node.rect)
+        if node.is_leaf():
+            record += node.text,
+        self._journal.record(record)
+
+    def notify_node_children_change(self, node):
+        path = get_node_path(node)
+        if path:
+            self._journal.record([_TEXT_SUBTREE, self._n, path, node.sexpr])
+        else:
+            self._journal.record([_TEXT_PAGE, self._n, node.sexpr])
+
+    def notify_child_insertion(self, node, i):
+        self._journal.record([_TEXT_INSERT, self._n, get_node_path(node), i, node[i].sexpr])
+
+    def notify_child_removal(self, node, i):
+        self._journal.record([_TEXT_REMOVE, self._n, get_node_path(node), i])
+
+    def notify_tree_change(self, node):
+        if node is None:
+            self._journal.record([_TEXT_PAGE, self._n])
+        else:
+            self._journal.record([_TEXT_PAGE, self._n, node.sexpr])
+
+    def notify_node_select(self, node):
+        pass
+
+    def notify_node_deselect(self, node):
+        pass
+
+class TextRecorder(models.text.TextCallback):
+
+    def __init__(self, journal):
+        self._journal = journal
+
+    def notify_serialized_pages_change(self, pages):
+        for n, text in pages:
+            if text is models.text.ORIGINAL_TEXT:
+                self._journal.record([_TEXT_ORIGINAL, n])
+            elif text is None:
+                self._journal.record([_TEXT_SERIALIZED, n])
+            else:
+                self._journal.record([_TEXT_SERIALIZED, n, text])
+
+class PageAnnotationsRecorder(models.annotations.PageAnnotationsCallback):
+
+    def __init__(self, journal, annotations_model, n):
+        self._journal = journal
+        self._model = annotations_model
+        self._n = n
+
+    def _record_maparea(self, symbol, node):
+        i = self._model[self._n].mapareas.index(node)
+        self._journal.record([symbol, self._n, i, node.sexpr])
+
+    def notify_node_add(self, node):
+        self._record_maparea(_MAPAREA_INSERT, node)
+
+    def notify_node_change(self, node):
+        self._record_maparea(_MAPAREA_SET, node)
+
+    def notify_node_replace(self, node, other_node):
+        self._record_maparea(_MAPAREA_SET, other_node)
+
+    def notify_node_delete(self, node):
+        self._journal.record([_MAPAREA_DELETE, self._n, node.sexpr])
+
+    def notify_node_select(self, node):
+        pass
+
+    def notify_node_deselect(self, node):
+        pass
+
+class PageMetadataRecorder(models.metadata.PageMetadataCallback):
+
+    def __init__(self, journal, metadata_model, n):
+        self._journal = journal
+        self._model = metadata_model
+        self._n = n
+
+    def notify_key_change(self, key):
+        metadata = self._model[self._n]
+        if key in metadata:
+            self._journal.record([_METADATA_SET, self._n, key, metadata[key]])
+        else:
+            self._journal.record([_METADATA_DELETE, self._n, key])
+
+class OutlineRecorder(models.outline.OutlineCallback):
+
+    def __init__(self, journal, outline_model):
+        self._journal = journal
+        self._model = outline_model
+
+    def notify_tree_change(self, node):
+        self._journal.record([_OUTLINE, self._model.raw_value])
+
+    def notify_node_change(self, node):
+        self._journal.record([_OUTLINE_NODE, get_outline_node_path(node), node.uri, node.text])
+
+    def notify_node_children_change(self, node):
+        self.notify_tree_change(node)
+
+    def notify_child_insertion(self, node, i):
+        self._journal.record([_OUTLINE_INSERT, get_outline_node_path(node), i, node[i].sexpr])
+
+    def notify_child_removal(self, node, i):
+        self._journal.record([_OUTLINE_REMOVE, get_outline_node_path(node), i])
+
+    def notify_node_select(self, node):
+        pass
+
+class RecoveryJournal(object):
+
+    '''
+    The journal file is created on the first change, and synced only on
+    sync(); call it periodically.
+    '''
+
+    def __init__(self, document_path):
+        self._document_path = document_path
+        self.path = get_journal_path(document_path)
+        self._file = None
+        self._unsynced = False
+        self._suspended = False
+        self._recorders = []
+
+    def attach(self, metadata_model, text_model, outline_model, annotations_model):
+        '''
+        Start recording changes of the models.
+        '''
+        text_model.register_page_callback_factory(functools.partial(PageTextRecorder, self))
+        annotations_model.register_page_callback_factory(functools.partial(PageAnnotationsRecorder, self, annotations_model))
+        metadata_model.register_page_callback_factory(functools.partial(PageMetadataRecorder, self, metadata_model))
+        # The following models keep only weak references to their callbacks.
+        self._recorders = [TextRecorder(self), OutlineRecorder(self, outline_model)]
+        text_model.register_callback(self._recorders[0])
+        outline_model.register_callback(self._recorders[1])
+
+    def _write(self, record):
+        self._file.write(str(djvu.sexpr.Expression(record)) + '\n')
+        self._unsynced = True
+
+    def record(self, record):
+        if self._suspended:
+            return
+        if self._file is None:
+            self._file = open(self.path, 'wb')
+            self._write([_MAGIC, FORMAT_VERSION] + list(get_document_key(self._document_path)))
+        self._write(record)
+
+    def sync(self):
+        if not self._unsynced:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = False
+
+    def discard(self):
+        '''
+        Forget the recorded changes, e.g. after they were saved.
+        '''
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._unsynced = False
+        try:
+            os.remove(self.path)
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def restart(self, metadata_model, text_model, outline_model, annotations_model):
+        '''
+        Start a new journal for the current version of the document, e.g.
+        after it has been saved, and record the changes that are still
+        unsaved.
+        '''
+        self.discard()
+        for n, page in text_model.iter_page_models():
+            if page.take_snapshot() is not None:
+                sexpr = page.raw_value
+                self.record([_TEXT_PAGE, n] + ([sexpr] if sexpr else []))
+        for n, text in text_model.iter_serialized_pages():
+            self.record([_TEXT_SERIALIZED, n] + ([text] if text is not None else []))
+        for n, page in annotations_model.iter_page_models():
+            if page.take_snapshot() is not None:
+                self.record([_MAPAREA_PAGE, n] + [node.sexpr for node in page.mapareas])
+        for n, page in metadata_model.iter_page_models():
+            if page.is_dirty():
+                self.record([_METADATA_PAGE, n] + [(key, value) for key, value in sorted(page.iteritems())])
+        if outline_model.take_snapshot():
+            self.record([_OUTLINE, outline_model.raw_value])
+
+    def _iter_records(self, file):
+        '''
+        Yield (offset, record) pairs, where offset is the end of the record.
+        Stop at the first incomplete or malformed record.
+        '''
+        offset = 0
+        for line in file:
+            if not line.endswith('\n'):
+                return
+            try:
+                record = djvu.sexpr.Expression.from_string(line)
+            except djvu.sexpr.ExpressionSyntaxError:
+                return
+            offset += len(line)
+            yield offset, record
+
+    def can_recover(self):
+        '''
+        Return true if there are changes recorded for the current version of
+        the document.
+        '''
+        try:
+            with open(self.path, 'rb') as file:
+                for offset, header in self._iter_records(file):
+                    break
+                else:
+                    return False
+        except IOError:
+            return False
+        if header[0].value is not _MAGIC or header[1].value != FORMAT_VERSION:
+            return False
+        return tuple(item.value for item in header[2:]) == get_document_key(self._document_path)
+
+    def replay(self, metadata_model, text_model, outline_model, annotations_model):
+        '''
+        Apply the recorded changes to the models. Recording continues where
+        the journal ends.
+        '''
+        file = open(self.path, 'r+b')
+        end = 0
+        self._suspended = True
+        try:
+            records = self._iter_records(file)
+            for end, header in records:
+                break
+            for end, record in records:
+                symbol = record[0].value
+                args = record[1:]
+                if symbol is _TEXT_NODE:
+                    n, path, x, y, w, h = (arg.value for arg in args[:6])
+                    node = get_node(text_model[n], path)
+                    node.rect = x, y, w, h
+                    if len(args) > 6:
+                        node.text = args[6].value
+                elif symbol is _TEXT_SUBTREE:
+                    page_text = text_model[args[0].value]
+                    page_text.set_subtree(get_node(page_text, args[1].value), args[2])
+                elif symbol is _TEXT_INSERT:
+                    page_text = text_model[args[0].value]
+                    get_node(page_text, args[1].value).insert_child(args[2].value, args[3])
+                elif symbol is _TEXT_REMOVE:
+                    node = get_node(text_model[args[0].value], args[1].value)
+                    node.remove_child(node[args[2].value])
+                elif symbol is _TEXT_PAGE:
+                    text_model[args[0].value].raw_value = args[1] if len(args) > 1 else None
+                elif symbol is _TEXT_SERIALIZED:
+                    text = args[1].value if len(args) > 1 else None
+                    text_model.restore_serialized_pages([(args[0].value, text)])
+                elif symbol is _TEXT_ORIGINAL:
+                    text_model.restore_serialized_pages([(args[0].value, models.text.ORIGINAL_TEXT)])
+                elif symbol is _MAPAREA_INSERT:
+                    page_annotations = annotations_model[args[0].value]
+                    node = models.annotations.MapArea.from_sexpr(args[2], page_annotations)
+                    page_annotations.insert_maparea(args[1].value, node)
+                elif symbol is _MAPAREA_SET:
+                    page_annotations = annotations_model[args[0].value]
+                    node = models.annotations.MapArea.from_sexpr(args[2], page_annotations)
+                    page_annotations.mapareas[args[1].value].replace(node)
+                elif symbol is _MAPAREA_PAGE:
+                    page_annotations = annotations_model[args[0].value]
+                    for node in list(page_annotations.mapareas):
+                        page_annotations.remove_maparea(node)
+                    for i, sexpr in enumerate(args[1:]):
+                        node = models.annotations.MapArea.from_sexpr(sexpr, page_annotations)
+                        page_annotations.insert_maparea(i, node)
+                elif symbol is _MAPAREA_DELETE:
+                    page_annotations = annotations_model[args[0].value]
+                    sexpr = str(args[1])
+                    for node in page_annotations.mapareas:
+                        if str(node.sexpr) == sexpr:
+                            node.delete()
+                            break
+                elif symbol is _METADATA_SET:
+                    metadata_model[args[0].value][args[1].value] = args[2].value.decode('UTF-8')
+                elif symbol is _METADATA_PAGE:
+                    metadata_model[args[0].value].assign(dict(
+                        (key.value, value.value.decode('UTF-8'))
+                        for key, value in args[1:]
+                    ))
+                elif symbol is _METADATA_DELETE:
+                    del metadata_model[args[0].value][args[1].value]
+                elif symbol is _OUTLINE:
+                    outline_model.raw_value = args[0]
+                elif symbol is _OUTLINE_NODE:
+                    node = get_outline_node(outline_model, args[0].value)
+                    node.uri = args[1].value
+                    node.text = args[2].value.decode('UTF-8')
+                elif symbol is _OUTLINE_INSERT:
+                    node = get_outline_node(outline_model, args[0].value)
+                    node.insert_child(args[1].value, models.outline.InnerNode(args[2], outline_model))
+                elif symbol is _OUTLINE_REMOVE:
+                    node = get_outline_node(outline_model, args[0].value)
+                    node.remove_child(node[args[1].value])
+                else:
+                    raise ValueError('unknown journal record: {0}'.format(symbol))
+        except:
+            file.close()
+            raise
+        finally:
+            self._suspended = False
+        # Drop the incomplete record, if any, and continue after the last
+        # complete one.
+        file.seek(end)
+        file.truncate()
+        self._file = file
+
+__all__ = ['RecoveryJournal', 'get_journal_path']
+
+# vim:ts=4 sts=4 sw=4 et
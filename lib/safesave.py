@@ -0,0 +1,172 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Crash-safe saving.
+
+The changes are saved into a new version of the document, next to it. The new
+version is verified, and only then it atomically replaces the document. If
+anything goes wrong, the new version is removed, and the document is intact.
+
+Bundled documents are written directly by djvused's save-bundled, so that
+they are not copied beforehand. Other documents are edited in a copy, which
+shares data with the original if the file system allows it.
+
+Only bundled and single-page documents are saved this way as a whole. For an
+indirect document, only its index file is copied: djvused still modifies
+other component files in place, namely the shared annotations component (and
+every page component, if the shared annotations component has to be
+created). See djvusmooth.indirect for saving pages of such documents.
+'''
+
+import errno
+import os
+
+import djvu.decode
+
+from djvusmooth import djvused
+from djvusmooth import filecopy
+from djvusmooth.models import SHARED_ANNOTATIONS_PAGENO
+
+def get_working_path(document_path):
+    '''
+    Return path of the new version of the document, while it's being saved.
+    '''
+    directory, name = os.path.split(document_path)
+    return os.path.join(directory, '.%s.djvusmooth-save' % name)
+
+def verify(path, page_count, page_nos):
+    '''
+    Check that the document has page_count pages, and that text and
+    annotations of the pages can be read. Raise IOError otherwise.
+    '''
+    sed = djvused.StreamEditor(path)
+    sed.print_page_count()
+    for n in sorted(set(page_nos)):
+        if n == SHARED_ANNOTATIONS_PAGENO:
+            sed.select_shared_annotations()
+        else:
+            sed.select(n + 1)
+            sed.print_text()
+        sed.print_annotations()
+    output = sed.commit()
+    try:
+        actual_page_count = int(output.split('\n', 1)[0])
+    except ValueError:
+        actual_page_count = None
+    if actual_page_count != page_count:
+        raise djvused.IOError('The saved document has {0} pages instead of {1}'.format(actual_page_count, page_count))
+
+def replace(working_path, path, lock=None):
+    '''
+    Atomically replace the document with its new version. The lock, if not
+    None, is held meanwhile.
+    '''
+    if lock is None:
+        filecopy.replace_file(working_path, path)
+        return
+    with lock:
+        filecopy.replace_file(working_path, path)
+
+def remove_working_file(working_path):
+    '''
+    Remove the new version of the document, if it exists.
+    '''
+    try:
+        os.remove(working_path)
+    except OSError as ex:
+        if ex.errno != errno.ENOENT:
+            raise
+
+class NewVersion(object):
+
+    '''
+    New version of the document, being saved next to it.
+
+    Snapshots are exported one by one, as they are produced, so that they
+    don't have to be kept in memory all at once. progress and npages are
+    passed to djvused.StreamEditor.start().
+    '''
+
+    def __init__(self, path, document_type, page_count, progress=None, npages=0):
+        self.path = path
+        self.working_path = get_working_path(path)
+        self._bundled = document_type == djvu.decode.DOCUMENT_TYPE_BUNDLED
+        self._page_count = page_count
+        self._page_nos = set()
+        try:
+            if self._bundled:
+                sed = djvused.StreamEditor(path)
+            else:
+                filecopy.clone_file(path, self.working_path)
+                sed = djvused.StreamEditor(self.working_path, autosave=True)
+            sed.start(progress=progress, npages=npages)
+        except:
+            remove_working_file(self.working_path)
+            raise
+        self._sed = sed
+
+    def export(self, snapshot):
+        snapshot.export(self._sed)
+        if snapshot.n is not None:
+            self._page_nos.add(snapshot.n)
+
+    def finish(self):
+        '''
+        Save the new version, and verify it. The document is not replaced yet;
+        call either replace() or cancel() afterwards.
+        '''
+        try:
+            if self._bundled:
+                self._sed.save_as_bundled(self.working_path)
+            self._sed.commit()
+            if self._bundled:
+                os.chmod(self.working_path, os.stat(self.path).st_mode & 0o7777)
+            verify(self.working_path, self._page_count, self._page_nos)
+        except:
+            self.cancel()
+            raise
+
+    def replace(self, lock=None):
+        replace(self.working_path, self.path, lock)
+
+    def cancel(self):
+        '''
+        Discard the new version.
+        '''
+        self._sed.cancel()
+        remove_working_file(self.working_path)
+
+def save(path, document_type, page_count, snapshots, progress=None, npages=0, lock=None):
+    '''
+    Export the snapshots to a new version of the document, verify it, and
+    replace the document with it.
+
+    progress and npages are passed to djvused.StreamEditor.start(). The lock,
+    if not None, is held only while the document is being replaced.
+    '''
+    version = NewVersion(path, document_type, page_count, progress=progress, npages=npages)
+    try:
+        for snapshot in snapshots:
+            version.export(snapshot)
+        version.finish()
+        version.replace(lock)
+    except:
+        version.cancel()
+        raise
+
+__all__ = ['NewVersion', 'save', 'verify', 'replace', 'get_working_path', 'remove_working_file']
+
+# vim:ts=4 sts=4 sw=4 et
@@ -0,0 +1,212 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Consistency checks of the hidden text.
+
+Zones of many pages are collected into flat arrays, which are then checked
+all at once (with NumPy, if it's available).
+'''
+
+import array
+
+import djvu.const
+import djvu.sexpr
+
+try:
+    import numpy
+except ImportError:  # no coverage
+    numpy = None
+
+OUTSIDE_PARENT = 'outside-parent'
+EMPTY_SIZE = 'empty-size'
+OUTSIDE_PAGE = 'outside-page'
+OVERLAPPING_WORDS = 'overlapping-words'
+EMPTY_TEXT = 'empty-text'
+
+PROBLEMS = [OUTSIDE_PARENT, EMPTY_SIZE, OUTSIDE_PAGE, OVERLAPPING_WORDS, EMPTY_TEXT]
+
+class Problem(object):
+
+    def __init__(self, page_no, path, zone_type, code):
+        self.page_no = page_no
+        self.path = path
+        self.zone_type = zone_type
+        self.code = code
+
+class _Batch(object):
+
+    '''
+    Zones of a few pages, in preorder.
+
+    The path of a zone consists of child indices leading from the page zone to
+    it, as in djvusmooth.text.search.
+    '''
+
+    def __init__(self):
+        self.page_nos = []
+        self.page_rects = array.array('i')  # x0, y0, x1, y1 for every page
+        self.zone_pages = array.array('i')  # index of the page for every zone
+        self.paths = []
+        self.types = []
+        self.rects = array.array('i')  # x0, y0, x1, y1 for every zone
+        self.parents = array.array('i')
+        self.left_siblings = array.array('i')
+        self.empty_texts = array.array('B')
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add_page(self, n, sexpr, page_size):
+        '''
+        Add zones of the page text; page_size is the size of the page in text
+        coordinates, i.e. before rotation.
+        '''
+        page_index = len(self.page_nos)
+        self.page_nos += n,
+        width, height = page_size
+        self.page_rects.extend((0, 0, width, height))
+        if not sexpr:
+            return
+        last_children = {}
+        stack = [((), sexpr, -1)]
+        while stack:
+            path, sexpr, parent = stack.pop()
+            i = len(self.paths)
+            self.zone_pages.append(page_index)
+            self.paths += path,
+            self.types += djvu.const.get_text_zone_type(sexpr[0].value),
+            self.rects.extend(sexpr[j].value for j in xrange(1, 5))
+            self.parents.append(parent)
+            self.left_siblings.append(last_children.get(parent, -1))
+            last_children[parent] = i
+            if isinstance(sexpr[5], djvu.sexpr.StringExpression):
+                self.empty_texts.append(not sexpr[5].value.strip())
+                continue
+            self.empty_texts.append(False)
+            children = [child for child in sexpr[5:] if isinstance(child, djvu.sexpr.ListExpression)]
+            for j in reversed(xrange(len(children))):
+                stack += (path + (j,), children[j], i),
+
+    def _check_numpy(self):
+        rects = numpy.frombuffer(self.rects, dtype=numpy.int32).reshape(-1, 4)
+        x0, y0, x1, y1 = rects.T
+        parents = numpy.frombuffer(self.parents, dtype=numpy.int32)
+        left_siblings = numpy.frombuffer(self.left_siblings, dtype=numpy.int32)
+        is_word = numpy.array([zone_type == djvu.const.TEXT_ZONE_WORD for zone_type in self.types], dtype=bool)
+        page_rects = numpy.frombuffer(self.page_rects, dtype=numpy.int32).reshape(-1, 4)
+        page_rects = page_rects[numpy.frombuffer(self.zone_pages, dtype=numpy.int32)]
+        parent_rects = rects[parents.clip(0)]
+        sibling_rects = rects[left_siblings.clip(0)]
+        flags = {
+            OUTSIDE_PARENT: (parents >= 0) & (
+                (x0 < parent_rects[:, 0]) | (y0 < parent_rects[:, 1]) |
+                (x1 > parent_rects[:, 2]) | (y1 > parent_rects[:, 3])
+            ),
+            EMPTY_SIZE: (x1 <= x0) | (y1 <= y0),
+            OUTSIDE_PAGE: (
+                (x0 < page_rects[:, 0]) | (y0 < page_rects[:, 1]) |
+                (x1 > page_rects[:, 2]) | (y1 > page_rects[:, 3])
+            ),
+            OVERLAPPING_WORDS: is_word & (left_siblings >= 0) & is_word[left_siblings.clip(0)] & (
+                (numpy.minimum(x1, sibling_rects[:, 2]) > numpy.maximum(x0, sibling_rects[:, 0])) &
+                (numpy.minimum(y1, sibling_rects[:, 3]) > numpy.maximum(y0, sibling_rects[:, 1]))
+            ),
+            EMPTY_TEXT: numpy.frombuffer(self.empty_texts, dtype=numpy.uint8).astype(bool),
+        }
+        for code in PROBLEMS:
+            for i in numpy.flatnonzero(flags[code]):
+                yield int(i), code
+
+    def _check_python(self):
+        rects = self.rects
+        page_rects = self.page_rects
+        for i in xrange(len(self)):
+            x0, y0, x1, y1 = rects[4 * i:4 * i + 4]
+            parent = self.parents[i]
+            if parent >= 0:
+                px0, py0, px1, py1 = rects[4 * parent:4 * parent + 4]
+                if x0 < px0 or y0 < py0 or x1 > px1 or y1 > py1:
+                    yield i, OUTSIDE_PARENT
+            if x1 <= x0 or y1 <= y0:
+                yield i, EMPTY_SIZE
+            page_index = self.zone_pages[i]
+            px0, py0, px1, py1 = page_rects[4 * page_index:4 * page_index + 4]
+            if x0 < px0 or y0 < py0 or x1 > px1 or y1 > py1:
+                yield i, OUTSIDE_PAGE
+            sibling = self.left_siblings[i]
+            if sibling >= 0 and self.types[i] == self.types[sibling] == djvu.const.TEXT_ZONE_WORD:
+                sx0, sy0, sx1, sy1 = rects[4 * sibling:4 * sibling + 4]
+                if min(x1, sx1) > max(x0, sx0) and min(y1, sy1) > max(y0, sy0):
+                    yield i, OVERLAPPING_WORDS
+            if self.empty_texts[i]:
+                yield i, EMPTY_TEXT
+
+    def check(self):
+        '''
+        Return list of problems for every page of the batch.
+        '''
+        if numpy is not None and len(self) > 0:
+            problems = self._check_numpy()
+        else:
+            problems = self._check_python()
+        result = dict((n, []) for n in self.page_nos)
+        for i, code in sorted(problems, key=lambda (i, code): (i, PROBLEMS.index(code))):
+            n = self.page_nos[self.zone_pages[i]]
+            result[n] += Problem(n, self.paths[i], self.types[i], code),
+        return [(page_no, result[page_no]) for page_no in self.page_nos]
+
+def check_page(sexpr, page_size, n=0):
+    '''
+    Return list of problems of the page text.
+
+    >>> sexpr = djvu.sexpr.Expression.from_string(
+    ...     '(page 0 0 100 100 (line 10 10 90 20 (word 10 10 50 20 "a") (word 40 10 95 20 " ")))'
+    ... )
+    >>> for problem in check_page(sexpr, (100, 100)):
+    ...     print problem.path, problem.code
+    (0, 1) outside-parent
+    (0, 1) overlapping-words
+    (0, 1) empty-text
+    '''
+    batch = _Batch()
+    batch.add_page(n, sexpr, page_size)
+    [(n, problems)] = batch.check()
+    return problems
+
+def check_pages(pages, batch_size=50000):
+    '''
+    Check the (n, sexpr, page_size) pages, in batches of at least batch_size
+    zones.
+
+    Yield (n, problems) pairs, in the original order.
+    '''
+    batch = _Batch()
+    for n, sexpr, page_size in pages:
+        batch.add_page(n, sexpr, page_size)
+        if len(batch) >= batch_size:
+            for item in batch.check():
+                yield item
+            batch = _Batch()
+    for item in batch.check():
+        yield item
+
+__all__ = [
+    'Problem', 'PROBLEMS',
+    'OUTSIDE_PARENT', 'EMPTY_SIZE', 'OUTSIDE_PAGE', 'OVERLAPPING_WORDS', 'EMPTY_TEXT',
+    'check_page', 'check_pages',
+]
+
+# vim:ts=4 sts=4 sw=4 et
@@ -0,0 +1,154 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Export of the hidden text of a whole document.
+
+Pages are given as an iterable of (n, sexpr, page_size, rotation) tuples, and
+written one at a time; page_size and rotation are needed only for hOCR.
+Exporters yield (n,) tuples as pages are written.
+'''
+
+import json
+from xml.sax.saxutils import escape, quoteattr
+
+import djvu.const
+import djvu.sexpr
+
+from djvusmooth.models.text import get_image_xform
+from djvusmooth.text.mangle import linearize_for_export
+
+def _get_text(sexpr):
+    if isinstance(sexpr[5], djvu.sexpr.StringExpression):
+        return sexpr[5].value
+    return str.join('', (_get_text(child) for child in sexpr[5:] if isinstance(child, djvu.sexpr.ListExpression)))
+
+def iter_zones(sexpr):
+    '''
+    Yield (depth, zone_type, bbox, text) for every zone of the page text, in
+    preorder. text is None for zones that are not leafs.
+    '''
+    if not sexpr:
+        return
+    stack = [(0, sexpr)]
+    while stack:
+        depth, sexpr = stack.pop()
+        zone_type = djvu.const.get_text_zone_type(sexpr[0].value)
+        bbox = tuple(sexpr[i].value for i in xrange(1, 5))
+        if isinstance(sexpr[5], djvu.sexpr.StringExpression):
+            yield depth, zone_type, bbox, sexpr[5].value
+            continue
+        yield depth, zone_type, bbox, None
+        children = [child for child in sexpr[5:] if isinstance(child, djvu.sexpr.ListExpression)]
+        stack += ((depth + 1, child) for child in reversed(children))
+
+def export_plain_text(stream, pages):
+    '''
+    Write text of every page line by line; terminate every page with a form
+    feed.
+    '''
+    for n, sexpr, page_size, rotation in pages:
+        if sexpr:
+            for line in linearize_for_export(sexpr):
+                stream.write(line + '\n')
+        stream.write('\f')
+        yield n,
+
+def export_json_lines(stream, pages):
+    '''
+    Write every zone as a JSON object on a separate line.
+    '''
+    for n, sexpr, page_size, rotation in pages:
+        for depth, zone_type, bbox, text in iter_zones(sexpr):
+            zone = dict(page=(n + 1), depth=depth, type=str(zone_type), bbox=bbox)
+            if text is not None:
+                zone['text'] = text.decode('UTF-8', 'replace')
+            stream.write(json.dumps(zone, sort_keys=True) + '\n')
+        yield n,
+
+_HOCR_HEADER = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<title></title>
+<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+<meta name="ocr-system" content="djvusmooth" />
+<meta name="ocr-capabilities" content="ocr_page ocr_carea ocr_par ocr_line ocrx_word" />
+</head>
+<body>
+'''
+
+_HOCR_FOOTER = '''\
+</body>
+</html>
+'''
+
+_HOCR_ELEMENTS = {
+    djvu.const.TEXT_ZONE_COLUMN: ('div', 'ocr_carea'),
+    djvu.const.TEXT_ZONE_REGION: ('div', 'ocr_carea'),
+    djvu.const.TEXT_ZONE_PARAGRAPH: ('p', 'ocr_par'),
+    djvu.const.TEXT_ZONE_LINE: ('span', 'ocr_line'),
+    djvu.const.TEXT_ZONE_WORD: ('span', 'ocrx_word'),
+}
+
+def _write_hocr_zone(stream, sexpr, xform):
+    x0, y0, x1, y1 = (sexpr[i].value for i in xrange(1, 5))
+    x, y, w, h = xform((x0, y0, x1 - x0, y1 - y0))
+    zone_type = djvu.const.get_text_zone_type(sexpr[0].value)
+    tag, class_ = _HOCR_ELEMENTS[zone_type]
+    stream.write('<%s class="%s" title="bbox %d %d %d %d">' % (tag, class_, x, y, x + w, y + h))
+    children = [child for child in sexpr[5:] if isinstance(child, djvu.sexpr.ListExpression)]
+    if zone_type == djvu.const.TEXT_ZONE_WORD or not children:
+        stream.write(escape(_get_text(sexpr)))
+    else:
+        stream.write('\n')
+        for child in children:
+            _write_hocr_zone(stream, child, xform)
+    stream.write('</%s>\n' % tag)
+
+def export_hocr(stream, pages):
+    '''
+    Write a hOCR document. Coordinates are those of the page image, as
+    displayed.
+    '''
+    stream.write(_HOCR_HEADER)
+    for n, sexpr, page_size, rotation in pages:
+        width, height = page_size
+        stream.write('<div class="ocr_page" id=%s title="bbox 0 0 %d %d; ppageno %d">\n' % (quoteattr('page_%d' % (n + 1)), width, height, n))
+        if sexpr:
+            xform = get_image_xform(page_size, rotation, page_size)
+            if isinstance(sexpr[5], djvu.sexpr.StringExpression):
+                stream.write('<p class="ocr_par">%s</p>\n' % escape(sexpr[5].value))
+            for child in sexpr[5:]:
+                if isinstance(child, djvu.sexpr.ListExpression):
+                    _write_hocr_zone(stream, child, xform)
+        stream.write('</div>\n')
+        yield n,
+    stream.write(_HOCR_FOOTER)
+
+FORMATS = {
+    'text': export_plain_text,
+    'jsonl': export_json_lines,
+    'hocr': export_hocr,
+}
+
+__all__ = [
+    'iter_zones',
+    'export_plain_text', 'export_json_lines', 'export_hocr',
+    'FORMATS',
+]
+
+# vim:ts=4 sts=4 sw=4 et
@@ -0,0 +1,122 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Affine transformations of text zone rectangles.
+
+A transformation is a (a, b, c, d, e, f) tuple, which maps (x, y) to
+(a * x + b * y + e, c * x + d * y + f).
+'''
+
+import array
+import math
+
+try:
+    import numpy
+except ImportError:  # no coverage
+    numpy = None
+
+IDENTITY = (1, 0, 0, 1, 0, 0)
+
+def translation(dx, dy):
+    return (1, 0, 0, 1, dx, dy)
+
+def scaling(sx, sy, origin=(0, 0)):
+    x, y = origin
+    return (sx, 0, 0, sy, x - sx * x, y - sy * y)
+
+def rotation(degrees, origin=(0, 0)):
+    '''
+    Counter-clockwise rotation (with the y axis pointing up, as in text zone
+    coordinates).
+
+    >>> [round(z, 6) for z in rotation(90, (1, 0))]
+    [0.0, -1.0, 1.0, 0.0, 1.0, -1.0]
+    '''
+    x, y = origin
+    cos = math.cos(math.radians(degrees))
+    sin = math.sin(math.radians(degrees))
+    return (cos, -sin, sin, cos, x - cos * x + sin * y, y - sin * x - cos * y)
+
+def compose(*matrices):
+    '''
+    Return transformation that applies the matrices in order.
+
+    >>> compose(translation(1, 2), scaling(2, 3))
+    (2, 0, 0, 3, 2, 6)
+    '''
+    result = IDENTITY
+    for a2, b2, c2, d2, e2, f2 in matrices:
+        a1, b1, c1, d1, e1, f1 = result
+        result = (
+            a2 * a1 + b2 * c1,
+            a2 * b1 + b2 * d1,
+            c2 * a1 + d2 * c1,
+            c2 * b1 + d2 * d1,
+            a2 * e1 + b2 * f1 + e2,
+            c2 * e1 + d2 * f1 + f2,
+        )
+    return result
+
+def _transform_rects_numpy(rects, matrix):
+    a, b, c, d, e, f = matrix
+    xywh = numpy.array(rects, dtype=float).reshape(-1, 4)
+    x0 = xywh[:, 0]
+    y0 = xywh[:, 1]
+    x1 = x0 + xywh[:, 2]
+    y1 = y0 + xywh[:, 3]
+    xs = numpy.array([a * x + b * y + e for x, y in ((x0, y0), (x0, y1), (x1, y0), (x1, y1))])
+    ys = numpy.array([c * x + d * y + f for x, y in ((x0, y0), (x0, y1), (x1, y0), (x1, y1))])
+    new_x0 = numpy.floor(xs.min(axis=0) + 0.5)
+    new_y0 = numpy.floor(ys.min(axis=0) + 0.5)
+    new_x1 = numpy.floor(xs.max(axis=0) + 0.5)
+    new_y1 = numpy.floor(ys.max(axis=0) + 0.5)
+    result = numpy.column_stack((new_x0, new_y0, new_x1 - new_x0, new_y1 - new_y0))
+    return array.array(rects.typecode, result.astype(numpy.dtype(rects.typecode)).tostring())
+
+def _transform_rects_python(rects, matrix):
+    a, b, c, d, e, f = matrix
+    result = array.array(rects.typecode)
+    for i in xrange(0, len(rects), 4):
+        x0, y0, w, h = rects[i:i + 4]
+        corners = (x0, y0), (x0, y0 + h), (x0 + w, y0), (x0 + w, y0 + h)
+        xs = [a * x + b * y + e for x, y in corners]
+        ys = [c * x + d * y + f for x, y in corners]
+        new_x0, new_y0, new_x1, new_y1 = (int(math.floor(z + 0.5)) for z in (min(xs), min(ys), max(xs), max(ys)))
+        result.extend((new_x0, new_y0, new_x1 - new_x0, new_y1 - new_y0))
+    return result
+
+def transform_rects(rects, matrix):
+    '''
+    Transform rectangles stored as (x, y, w, h) quadruples in the array, in
+    place. Every rectangle is replaced with the bounding box of its image.
+
+    >>> rects = array.array('i', [0, 0, 10, 20, 5, 5, 1, 1])
+    >>> transform_rects(rects, compose(scaling(2, 2), translation(1, 0)))
+    >>> rects.tolist()
+    [1, 0, 20, 40, 11, 10, 2, 2]
+    '''
+    if numpy is not None:
+        rects[:] = _transform_rects_numpy(rects, matrix)
+    else:
+        rects[:] = _transform_rects_python(rects, matrix)
+
+__all__ = [
+    'IDENTITY',
+    'translation', 'scaling', 'rotation', 'compose',
+    'transform_rects',
+]
+
+# vim:ts=4 sts=4 sw=4 et
@@ -0,0 +1,141 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Snapping of word boxes to the ink of the page stencil.
+
+The stencil is rendered with RENDER_BLACK at the full resolution, in the same
+orientation as in PageWidget. NumPy is required.
+'''
+
+import multiprocessing
+
+import djvu.const
+import djvu.decode
+import djvu.sexpr
+
+try:
+    import numpy
+except ImportError:  # no coverage
+    numpy = None
+
+from djvusmooth.models.text import PageText, get_image_xform
+
+PIXEL_FORMAT = djvu.decode.PixelFormatGrey()
+PIXEL_FORMAT.rows_top_to_bottom = 1
+PIXEL_FORMAT.y_top_to_bottom = 1
+
+def is_available():
+    return numpy is not None
+
+def render_stencil(page_job):
+    '''
+    Render the stencil of the decoded page.
+
+    Return a boolean array of (height, width) shape, true for black pixels.
+    '''
+    width, height = page_job.width, page_job.height
+    page_rect = (0, 0, width, height)
+    data = page_job.render(djvu.decode.RENDER_BLACK, page_rect, page_rect, PIXEL_FORMAT, 1)
+    image = numpy.frombuffer(data, dtype=numpy.uint8).reshape(height, width)
+    return image < 128
+
+def snap_rects(ink, rects, margin=0):
+    '''
+    Shrink every (x0, y0, x1, y1) rectangle of the array to the bounding box
+    of ink inside it, extended by margin pixels in every direction.
+    Rectangles without any ink are left intact.
+
+    >>> ink = numpy.zeros((10, 10), dtype=bool)
+    >>> ink[2:4, 3:7] = True
+    >>> snap_rects(ink, numpy.array([[0, 0, 5, 5], [2, 1, 8, 8], [8, 8, 9, 9]])).tolist()
+    [[3, 2, 5, 4], [3, 2, 7, 4], [8, 8, 9, 9]]
+    >>> snap_rects(ink, numpy.array([[4, 4, 8, 8]]), margin=1).tolist()
+    [[3, 3, 7, 4]]
+    '''
+    height, width = ink.shape
+    rects = numpy.asarray(rects, dtype=int).reshape(-1, 4)
+    regions = rects + numpy.array([-margin, -margin, margin, margin])
+    regions[:, 0::2] = regions[:, 0::2].clip(0, width)
+    regions[:, 1::2] = regions[:, 1::2].clip(0, height)
+    result = rects.copy()
+    for i, (x0, y0, x1, y1) in enumerate(regions):
+        region = ink[y0:y1, x0:x1]
+        xs = numpy.flatnonzero(region.any(axis=0))
+        if len(xs) == 0:
+            continue
+        ys = numpy.flatnonzero(region.any(axis=1))
+        result[i] = x0 + xs[0], y0 + ys[0], x0 + xs[-1] + 1, y0 + ys[-1] + 1
+    return result
+
+def snap_page_text(page_text, ink, rotation, margin=0, zone_type=djvu.const.TEXT_ZONE_WORD):
+    '''
+    Snap zones of the given type to the ink, and fit the containing zones to
+    them. ink is the rendered stencil of the page, and rotation is its
+    initial rotation.
+    '''
+    nodes = list(page_text.get_nodes(zone_type))
+    if not nodes:
+        return
+    height, width = ink.shape
+    xform = get_image_xform((width, height), rotation, (width, height))
+    rects = []
+    for node in nodes:
+        x, y, w, h = xform(node.rect)
+        rects += (x, y, x + w, y + h),
+    new_rects = []
+    for x0, y0, x1, y1 in snap_rects(ink, rects, margin).tolist():
+        new_rects += xform.inverse((x0, y0, x1 - x0, y1 - y0)),
+    page_text.set_rects(nodes, new_rects)
+
+_document = None
+
+def _initialize_worker(path):
+    global _document
+    context = djvu.decode.Context()
+    _document = context.new_document(djvu.decode.FileURI(path))
+    _document.decoding_job.wait()
+
+def _snap_page(args):
+    n, text, margin = args
+    page_job = _document.pages[n].decode(wait=True)
+    ink = render_stencil(page_job)
+    page_text = PageText(n, djvu.sexpr.Expression.from_string(text))
+    snap_page_text(page_text, ink, page_job.initial_rotation, margin)
+    return n, str(page_text.raw_value)
+
+def iter_snapped_pages(path, pages, margin=0, processes=None):
+    '''
+    Snap word boxes of the (n, text) pages of the document in a process pool.
+    text is the serialized page text, as it should be snapped.
+
+    Yield (n, text) pairs in the original order.
+    '''
+    pool = multiprocessing.Pool(processes, _initialize_worker, (path,))
+    try:
+        for item in pool.imap(_snap_page, ((n, text, margin) for n, text in pages)):
+            yield item
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+__all__ = [
+    'is_available',
+    'render_stencil', 'snap_rects', 'snap_page_text',
+    'iter_snapped_pages',
+]
+
+# vim:ts=4 sts=4 sw=4 et
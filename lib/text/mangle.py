@@ -15,6 +15,7 @@
 
 from __future__ import print_function
 
+import copy
 import itertools
 
 import djvu.sexpr
@@ -79,11 +80,211 @@ def mangle(s, t, input):
         j += 1
     yield input_head[:5] + [current_word]
 
+def _is_leaf(expr):
+    return len(expr) == 6 and isinstance(expr[5], djvu.sexpr.StringExpression)
+
+def _is_character_zone(expr):
+    return isinstance(expr, djvu.sexpr.ListExpression) and expr[0].value == djvu.const.TEXT_ZONE_CHARACTER
+
+def _has_character_zones(expr):
+    return any(_is_character_zone(subexpr) for subexpr in expr[5:])
+
+def _get_rect(expr):
+    return [expr[i].value for i in xrange(1, 5)]
+
+def _union_rect(rects):
+    x0s, y0s, x1s, y1s = zip(*rects)
+    return [min(x0s), min(y0s), max(x1s), max(y1s)]
+
+def _split_rect(rect, n):
+    x0, y0, x1, y1 = rect
+    edges = [x0 + (x1 - x0) * i // n for i in xrange(n + 1)]
+    return [[edges[i], y0, edges[i + 1], y1] for i in xrange(n)]
+
+def _align(s, t):
+    '''
+    For every character of t, return index of the corresponding character
+    of s, or None if the character was inserted.
+    '''
+    result = []
+    j = 0
+    for i, ot, to in distance(s, t):
+        while j < i:
+            result += j,
+            j += 1
+        if not ot:
+            result += None,
+        elif not to:
+            j += 1
+        else:
+            result += j,
+            j += 1
+    result += xrange(j, len(s))
+    return result
+
+class _Character(object):
+
+    def __init__(self, expr, rect, text, word):
+        self.expr = expr
+        self.rect = rect
+        self.text = text
+        self.word = word
+
+class _Group(object):
+
+    '''
+    Characters of the new text that will share a single character zone.
+    '''
+
+    def __init__(self, char, text, word):
+        self.char = char
+        self.text = text
+        self.word = word
+        self.rect = None if char is None else list(char.rect)
+        self.dirty = False
+
+    def is_intact(self):
+        return not self.dirty and self.char is not None and self.text == self.char.text
+
+    def get_sexpr(self):
+        if self.is_intact() and self.char.expr is not None:
+            return self.char.expr
+        return djvu.sexpr.Expression([djvu.const.TEXT_ZONE_CHARACTER] + self.rect + [self.text])
+
+def _place_inserted(run, left, right, rect):
+    '''
+    Assign boxes to a run of inserted characters.
+
+    Use the gap between the neighbours if it is wide enough; otherwise carve
+    the boxes out of one of the neighbours.
+    '''
+    n = len(run)
+    if left is not None and right is not None and right.rect[0] - left.rect[2] >= n:
+        y0 = min(left.rect[1], right.rect[1])
+        y1 = max(left.rect[3], right.rect[3])
+        rects = _split_rect([left.rect[2], y0, right.rect[0], y1], n)
+    elif left is not None:
+        rects = _split_rect(left.rect, n + 1)
+        left.rect = rects.pop(0)
+        left.dirty = True
+    elif right is not None:
+        rects = _split_rect(right.rect, n + 1)
+        right.rect = rects.pop()
+        right.dirty = True
+    else:
+        rects = _split_rect(rect, n)
+    for group, rect in itertools.izip(run, rects):
+        group.rect = rect
+
+def mangle_characters(s, t, input):
+    '''
+    Like mangle(), but for zones with character-level details.
+
+    Character zones that survived the edit keep their boxes; boxes for inserted
+    characters are taken from the gap between neighbours or carved out of them.
+    Words with all characters intact are passed through as they are.
+    '''
+    s = s.decode('UTF-8', 'replace')
+    t = t.decode('UTF-8', 'replace')
+    input = list(input)
+    if any(_is_character_zone(item) for item in input):
+        # The characters are not grouped into words.
+        words = [None]
+    else:
+        words = input
+    chars = []
+    owners = []
+    word_chars = []
+    for n, word in enumerate(words):
+        if n > 0:
+            owners += None,
+        first = len(chars)
+        if word is not None and _is_leaf(word):
+            # Pretend that the word consists of characters of equal width:
+            text = word[5].value.decode('UTF-8', 'replace')
+            rects = _split_rect(_get_rect(word), len(text)) if text else ()
+            for c, rect in itertools.izip(text, rects):
+                owners += len(chars),
+                chars += _Character(None, rect, c, n),
+        else:
+            for char in (input if word is None else word[5:]):
+                if not _is_leaf(char):
+                    continue
+                text = char[5].value.decode('UTF-8', 'replace')
+                owners += [len(chars)] * len(text)
+                chars += _Character(char, _get_rect(char), text, n),
+        word_chars += chars[first:],
+    assert len(owners) == len(s)
+    groups = []
+    used = set()
+    n = 0
+    for c, i in itertools.izip(t, _align(s, t)):
+        if c == ' ' and words[0] is not None:
+            n += 1
+            continue
+        char = None if i is None or owners[i] is None else chars[owners[i]]
+        if char is not None and groups and groups[-1].char is char and groups[-1].word == n:
+            groups[-1].text += c
+            continue
+        if char in used:
+            # e.g. a space inserted into a ligature
+            char = None
+        used.add(char)
+        groups += _Group(char, c, n),
+    if not groups:
+        return
+    # Find boxes for the inserted characters:
+    rect = _union_rect([_get_rect(item) for item in input])
+    right = None
+    next_kept = [None] * len(groups)
+    for i in reversed(xrange(len(groups))):
+        if groups[i].char is not None:
+            right = groups[i]
+        next_kept[i] = right
+    i = 0
+    while i < len(groups):
+        if groups[i].char is not None:
+            i += 1
+            continue
+        n = groups[i].word
+        j = i
+        while j < len(groups) and groups[j].char is None and groups[j].word == n:
+            j += 1
+        left = groups[i - 1] if i > 0 else None
+        right = next_kept[j] if j < len(groups) else None
+        if (left is not None and left.word == n) or (right is not None and right.word == n):
+            # Don't steal space from other words if possible.
+            if left is not None and left.word != n:
+                left = None
+            if right is not None and right.word != n:
+                right = None
+        _place_inserted(groups[i:j], left, right, rect)
+        i = j
+    # Put it all together:
+    for n, new_word in itertools.groupby(groups, lambda group: group.word):
+        new_word = list(new_word)
+        if words[0] is None:
+            for group in new_word:
+                yield group.get_sexpr()
+            continue
+        old_chars = [group.char for group in new_word]
+        old_word = words[old_chars[0].word] if old_chars[0] is not None else None
+        if old_word is not None and old_chars == word_chars[old_chars[0].word] and all(group.is_intact() for group in new_word):
+            yield old_word
+            continue
+        word_type = djvu.const.TEXT_ZONE_WORD if old_word is None else old_word[0].value
+        word_rect = _union_rect([group.rect for group in new_word])
+        if any(group.char is not None and group.char.expr is not None for group in new_word):
+            children = [group.get_sexpr() for group in new_word]
+        else:
+            children = [unicode.join(u'', (group.text for group in new_word))]
+        yield djvu.sexpr.Expression([word_type] + word_rect + children)
+
 def linearize_for_export(expr):
-    if expr[0].value == djvu.const.TEXT_ZONE_CHARACTER:
-        raise CharacterZoneFound
-    if len(expr) == 6 and isinstance(expr[5], djvu.sexpr.StringExpression):
+    if _is_leaf(expr):
         yield expr[5].value
+    elif _has_character_zones(expr):
+        yield str.join('', (subexpr[5].value for subexpr in expr[5:] if _is_leaf(subexpr)))
     elif expr[0].value == djvu.const.TEXT_ZONE_LINE:
         yield str.join(' ', linearize_for_export(expr[5:]))
     else:
@@ -94,9 +295,9 @@ def linearize_for_export(expr):
                 yield item
 
 def linearize_for_import(expr):
-    if expr[0].value == djvu.const.TEXT_ZONE_CHARACTER:
-        raise CharacterZoneFound
-    if len(expr) == 6 and isinstance(expr[5], djvu.sexpr.StringExpression):
+    if _is_leaf(expr):
+        yield expr
+    elif _has_character_zones(expr):
         yield expr
     elif expr[0].value == djvu.const.TEXT_ZONE_LINE:
         yield expr
@@ -111,35 +312,63 @@ def export(sexpr, stream):
     for line in linearize_for_export(sexpr):
         print(line, file=stream)
 
+def _update(exported, inputs, lines):
+    dirty = False
+    for line, xline, input in itertools.izip(lines, exported, inputs):
+        if line == xline:
+            continue
+        if _has_character_zones(input) or any(_has_character_zones(item) for item in input[5:] if isinstance(item, djvu.sexpr.ListExpression)):
+            input[5:] = list(mangle_characters(xline, line, input[5:]))
+        else:
+            input[5:] = list(mangle(xline, line, input[5:]))
+        dirty = True
+    return dirty
+
 def import_(sexpr, stdin):
     exported = tuple(linearize_for_export(sexpr))
     inputs = tuple(linearize_for_import(sexpr))
-    stdin = tuple(line for line in stdin)
+    stdin = tuple(line.rstrip('\n') for line in stdin)
     if len(exported) != len(stdin):
         raise LengthChanged
     assert len(exported) == len(inputs) == len(stdin)
-    dirty = False
-    for n, line, xline, input in itertools.izip(itertools.count(1), stdin, exported, inputs):
-        line = line.rstrip('\n')
-        if line != xline:
-            input[5:] = list(mangle(xline, line, input[5:]))
-            dirty = True
-    if not dirty:
+    if not _update(exported, inputs, stdin):
         raise NothingChanged
     return sexpr
 
+def replace(sexpr, regex, replacement):
+    '''
+    Replace matches of the regular expression in every line of the text.
+
+    Return a (new_sexpr, n) pair, where n is the number of replacements made.
+    The original expression is left intact.
+    '''
+    exported = tuple(linearize_for_export(sexpr))
+    lines = []
+    count = 0
+    for xline in exported:
+        line, n = regex.subn(replacement, xline.decode('UTF-8', 'replace'))
+        if n:
+            line = line.encode('UTF-8')
+        else:
+            line = xline
+        lines += line,
+        count += n
+    if not count:
+        return sexpr, 0
+    sexpr = copy.deepcopy(sexpr)
+    inputs = tuple(linearize_for_import(sexpr))
+    _update(exported, inputs, lines)
+    return sexpr, count
+
 class NothingChanged(Exception):
     pass
 
 class LengthChanged(Exception):
     pass
 
-class CharacterZoneFound(Exception):
-    pass
-
 __all__ = [
-    'import_', 'export',
-    'NothingChanged', 'CharacterZoneFound', 'LengthChanged'
+    'import_', 'export', 'replace',
+    'NothingChanged', 'LengthChanged'
 ]
 
 # vim:ts=4 sts=4 sw=4 et
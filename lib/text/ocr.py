@@ -0,0 +1,239 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Import of hOCR and ALTO files into the hidden text.
+
+The files are parsed incrementally, one page at a time; elements of pages
+that have been already converted are discarded.
+'''
+
+import itertools
+import re
+import xml.etree.cElementTree as etree
+
+import djvu.const
+import djvu.sexpr
+
+from djvusmooth.models.text import get_image_xform
+
+class Zone(object):
+
+    '''
+    Text zone in coordinates of the OCR-ed image.
+    '''
+
+    __slots__ = ('type', 'bbox', 'children', 'text')
+
+    def __init__(self, type, bbox):
+        self.type = type
+        self.bbox = bbox
+        self.children = []
+        self.text = None
+
+_HOCR_ZONE_TYPES = {
+    'ocr_page': djvu.const.TEXT_ZONE_PAGE,
+    'ocr_carea': djvu.const.TEXT_ZONE_REGION,
+    'ocr_par': djvu.const.TEXT_ZONE_PARAGRAPH,
+    'ocr_line': djvu.const.TEXT_ZONE_LINE,
+    'ocrx_line': djvu.const.TEXT_ZONE_LINE,
+    'ocr_caption': djvu.const.TEXT_ZONE_LINE,
+    'ocr_header': djvu.const.TEXT_ZONE_LINE,
+    'ocr_textfloat': djvu.const.TEXT_ZONE_LINE,
+    'ocrx_word': djvu.const.TEXT_ZONE_WORD,
+}
+
+_HOCR_BBOX_RE = re.compile(r'\bbbox\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)\s+(-?\d+)')
+
+_ALTO_ZONE_TYPES = {
+    'Page': djvu.const.TEXT_ZONE_PAGE,
+    'ComposedBlock': djvu.const.TEXT_ZONE_REGION,
+    'TextBlock': djvu.const.TEXT_ZONE_PARAGRAPH,
+    'TextLine': djvu.const.TEXT_ZONE_LINE,
+    'String': djvu.const.TEXT_ZONE_WORD,
+}
+
+def _get_local_name(tag):
+    return tag.rpartition('}')[2]
+
+def _get_hocr_zone(elem):
+    for class_ in elem.get('class', '').split():
+        try:
+            zone_type = _HOCR_ZONE_TYPES[class_]
+        except LookupError:
+            continue
+        match = _HOCR_BBOX_RE.search(elem.get('title', ''))
+        bbox = tuple(map(int, match.groups())) if match else None
+        return Zone(zone_type, bbox)
+
+def _get_hocr_text(elem):
+    return str.join('', (s.encode('UTF-8') if isinstance(s, unicode) else s for s in elem.itertext())).strip()
+
+def _get_alto_zone(elem):
+    try:
+        zone_type = _ALTO_ZONE_TYPES[_get_local_name(elem.tag)]
+    except LookupError:
+        return
+    try:
+        if zone_type == djvu.const.TEXT_ZONE_PAGE:
+            x, y = 0, 0
+        else:
+            x, y = (float(elem.get(key)) for key in ('HPOS', 'VPOS'))
+        w, h = (float(elem.get(key)) for key in ('WIDTH', 'HEIGHT'))
+    except (TypeError, ValueError):
+        bbox = None
+    else:
+        bbox = tuple(int(round(z)) for z in (x, y, x + w, y + h))
+    return Zone(zone_type, bbox)
+
+def _get_alto_text(elem):
+    text = elem.get('CONTENT', '')
+    if isinstance(text, unicode):
+        text = text.encode('UTF-8')
+    return text.strip()
+
+def _finish(zone):
+    '''
+    Drop empty zones, and compute missing bounding boxes.
+    Return false if the zone itself should be dropped.
+
+    Lines without words keep their own text.
+    '''
+    if zone.type == djvu.const.TEXT_ZONE_WORD:
+        zone.children = []
+        return zone.text and zone.bbox is not None
+    if not zone.children:
+        return zone.type == djvu.const.TEXT_ZONE_LINE and zone.text and zone.bbox is not None
+    if zone.bbox is None:
+        x0s, y0s, x1s, y1s = zip(*(child.bbox for child in zone.children))
+        zone.bbox = min(x0s), min(y0s), max(x1s), max(y1s)
+    return True
+
+def _iter_pages(file, get_zone, get_text):
+    stack = []
+    for event, elem in etree.iterparse(file, events=('start', 'end')):
+        if event == 'start':
+            zone = get_zone(elem)
+            if zone is not None:
+                stack += (elem, zone),
+            continue
+        if not stack or stack[-1][0] is not elem:
+            continue
+        elem, zone = stack.pop()
+        if zone.type == djvu.const.TEXT_ZONE_WORD:
+            zone.text = get_text(elem)
+        elif zone.type == djvu.const.TEXT_ZONE_LINE and not zone.children:
+            # Text of words has been already cleared.
+            zone.text = get_text(elem)
+        elem.clear()
+        if zone.type == djvu.const.TEXT_ZONE_PAGE:
+            yield zone
+            continue
+        if not _finish(zone):
+            continue
+        parents = [parent for parent_elem, parent in stack if parent.type > zone.type]
+        if parents:
+            parents[-1].children += zone,
+        else:
+            # Zones of the same type must not be nested.
+            parents = [parent for parent_elem, parent in stack]
+            if parents:
+                parents[-1].children += zone.children
+
+def iter_hocr_pages(file):
+    '''
+    Yield page zones from a hOCR file.
+    '''
+    return _iter_pages(file, _get_hocr_zone, _get_hocr_text)
+
+def iter_alto_pages(file):
+    '''
+    Yield page zones from an ALTO file.
+    '''
+    return _iter_pages(file, _get_alto_zone, _get_alto_text)
+
+def iter_pages(file):
+    '''
+    Yield page zones from a hOCR or ALTO file.
+    '''
+    head = file.read(4096)
+    file.seek(0)
+    if re.search(r'<(\w+:)?alto\b', head):
+        return iter_alto_pages(file)
+    else:
+        return iter_hocr_pages(file)
+
+def _get_sexpr(zone, xform):
+    x0, y0, x1, y1 = zone.bbox
+    x, y, w, h = xform.inverse((x0, y0, x1 - x0, y1 - y0))
+    head = [zone.type, x, y, x + w, y + h]
+    if zone.children:
+        return djvu.sexpr.Expression(head + [_get_sexpr(child, xform) for child in zone.children])
+    else:
+        return djvu.sexpr.Expression(head + [zone.text])
+
+def get_page_sexpr(page_zone, page_size, rotation):
+    '''
+    Convert the page zone into page text, or None if there's no text.
+
+    page_size and rotation are as in PageWidget: size of the page as displayed
+    and its initial rotation. The OCR-ed image is assumed to be displayed in
+    the same way, though possibly with a different resolution.
+    '''
+    if not page_zone.children:
+        return
+    if page_zone.bbox is None:
+        image_size = page_size
+    else:
+        x0, y0, x1, y1 = page_zone.bbox
+        image_size = x1 - x0, y1 - y0
+    xform = get_image_xform(page_size, rotation, image_size)
+    x, y, w, h = xform.inverse((0, 0) + tuple(image_size))
+    head = [djvu.const.TEXT_ZONE_PAGE, x, y, x + w, y + h]
+    return djvu.sexpr.Expression(head + [_get_sexpr(child, xform) for child in page_zone.children])
+
+class PageTextSnapshot(object):
+
+    '''
+    Imported text of a page, exported as a text model snapshot would be.
+    '''
+
+    def __init__(self, n, sexpr):
+        self.n = n
+        self.sexpr = sexpr
+
+    def export(self, djvused):
+        djvused.select(self.n + 1)
+        djvused.set_text(self.sexpr)
+
+def import_pages(page_zones, page_nos, get_page_info, export):
+    '''
+    Convert the page zones into text of the pages, and pass it to
+    export(snapshot) page by page, as PageTextSnapshot objects.
+    get_page_info(n) should return the (page_size, rotation) pair.
+
+    Yield (n,) tuples for every exported page.
+    '''
+    for n, page_zone in itertools.izip(page_nos, page_zones):
+        page_size, rotation = get_page_info(n)
+        export(PageTextSnapshot(n, get_page_sexpr(page_zone, page_size, rotation)))
+        yield n,
+
+__all__ = [
+    'iter_pages', 'iter_hocr_pages', 'iter_alto_pages',
+    'get_page_sexpr', 'PageTextSnapshot', 'import_pages',
+]
+
+# vim:ts=4 sts=4 sw=4 et
@@ -0,0 +1,351 @@
+# encoding=UTF-8
+
+# Copyright © 2008-2022 Jakub Wilk <jwilk@jwilk.net>
+#
+# This file is part of djvusmooth.
+#
+# djvusmooth is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License version 2 as published
+# by the Free Software Foundation.
+#
+# djvusmooth is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for
+# more details.
+
+'''
+Full-text search over the hidden text of a whole document.
+
+Every page is split into units (words, or leaf zones coarser than words) and
+units into normalized words. The index maps words to pages; phrases are then
+matched only against pages that contain all their words.
+'''
+
+import array
+import json
+import os
+import re
+import threading
+
+import djvu.const
+import djvu.sexpr
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+_COARSE_ZONE_TYPES = frozenset([
+    djvu.const.TEXT_ZONE_PAGE,
+    djvu.const.TEXT_ZONE_COLUMN,
+    djvu.const.TEXT_ZONE_REGION,
+    djvu.const.TEXT_ZONE_PARAGRAPH,
+    djvu.const.TEXT_ZONE_LINE,
+])
+
+FORMAT_VERSION = 2
+
+def normalize(text):
+    '''
+    Split the text into lowercase words.
+
+    >>> normalize(u'Hello, World!')
+    [u'hello', u'world']
+    '''
+    if isinstance(text, str):
+        text = text.decode('UTF-8', 'replace')
+    return _WORD_RE.findall(text.lower())
+
+def _get_children(sexpr):
+    return [item for item in sexpr[5:] if isinstance(item, djvu.sexpr.ListExpression)]
+
+def _get_text(sexpr):
+    if isinstance(sexpr[5], djvu.sexpr.StringExpression):
+        return sexpr[5].value
+    return str.join('', (_get_text(child) for child in _get_children(sexpr)))
+
+def iter_units(sexpr):
+    '''
+    Yield (path, rect, text) for every unit of the page text, in reading order.
+
+    The path consists of child indices leading from the page zone to the unit.
+    '''
+    if not sexpr:
+        return
+    stack = [((), sexpr)]
+    while stack:
+        path, sexpr = stack.pop()
+        zone_type = djvu.const.get_text_zone_type(sexpr[0].value)
+        if zone_type in _COARSE_ZONE_TYPES and not isinstance(sexpr[5], djvu.sexpr.StringExpression):
+            children = _get_children(sexpr)
+            for i in reversed(xrange(len(children))):
+                stack += (path + (i,), children[i]),
+            continue
+        rect = tuple(sexpr[i].value for i in xrange(1, 5))
+        yield path, rect, _get_text(sexpr)
+
+def get_unit_node(page_text, path):
+    '''
+    Return the node of the page text model that corresponds to the unit path,
+    or None if there is no such node.
+    '''
+    node = page_text.root
+    try:
+        for i in path:
+            node = node[i]
+    except (IndexError, TypeError):
+        return None
+    return node
+
+class _PageEntry(object):
+
+    def __init__(self, sexpr):
+        self.paths = []
+        self.rects = array.array('i')
+        # For every word of the page: the word and the index of its unit.
+        self.words = []
+        self.units = array.array('I')
+        for path, rect, text in iter_units(sexpr):
+            words = normalize(text)
+            if not words:
+                continue
+            unit = len(self.paths)
+            self.paths += path,
+            self.rects.extend(rect)
+            self.words += words
+            self.units.extend([unit] * len(words))
+
+    def dump(self):
+        return [self.paths, self.rects.tolist(), self.words, self.units.tolist()]
+
+    @classmethod
+    def load(cls, data):
+        '''
+        Recreate the entry from data returned by dump(), after a JSON round
+        trip. Raise ValueError if the data is malformed.
+        '''
+        try:
+            paths, rects, words, units = data
+            self = cls(None)
+            self.paths = [tuple(int(i) for i in path) for path in paths]
+            self.rects = array.array('i', rects)
+            self.words = [unicode(word) for word in words]
+            self.units = array.array('I', units)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError
+        if len(self.rects) != 4 * len(self.paths) or len(self.units) != len(self.words):
+            raise ValueError
+        if any(unit >= len(self.paths) for unit in self.units):
+            raise ValueError
+        return self
+
+class Match(object):
+
+    def __init__(self, page_no, path, rect):
+        self.page_no = page_no
+        self.path = path
+        self.rect = rect
+
+    def __repr__(self):
+        return '%s.%s(%r, %r, %r)' % (self.__module__, type(self).__name__, self.page_no, self.path, self.rect)
+
+class SearchIndex(object):
+
+    '''
+    Inverted index from normalized words to pages.
+
+    Pages can be indexed from a background thread; all the other methods
+    should be called from the thread that modifies the text model.
+
+    Every invalidation of a page gets a new revision number. A changed page
+    stays stale until it's reindexed with text of its latest revision.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pages = {}
+        self._word_pages = {}
+        self._revision = 0
+        self._stale = {}
+        self._taken = {}
+
+    def __len__(self):
+        return len(self._pages)
+
+    def has_page(self, n):
+        return n in self._pages
+
+    def _add_entry(self, n, entry):
+        self._pages[n] = entry
+        for word in set(entry.words):
+            self._word_pages.setdefault(word, set()).add(n)
+
+    def _remove_entry(self, n):
+        entry = self._pages.pop(n, None)
+        if entry is None:
+            return
+        for word in set(entry.words):
+            page_nos = self._word_pages[word]
+            page_nos.discard(n)
+            if not page_nos:
+                del self._word_pages[word]
+
+    def index_page(self, n, sexpr, replace=True, revision=None):
+        '''
+        Index the n-th page text. Unless replace is true, do nothing if the
+        page has been already indexed.
+
+        If revision is not None, the text is that of a changed page, as
+        returned by take_stale_pages(); do nothing if the page has been
+        changed again since.
+        '''
+        if not replace and n in self._pages:
+            return
+        entry = _PageEntry(sexpr)
+        with self._lock:
+            if revision is not None:
+                if self._stale.get(n) != revision:
+                    return
+                del self._stale[n]
+                self._taken.pop(n, None)
+            elif not replace and n in self._pages:
+                return
+            self._remove_entry(n)
+            self._add_entry(n, entry)
+
+    def invalidate_page(self, n):
+        '''
+        Mark the n-th page as changed. It has to be reindexed then.
+        '''
+        with self._lock:
+            self._revision += 1
+            self._stale[n] = self._revision
+
+    def take_stale_pages(self):
+        '''
+        Return (n, revision) pairs for changed pages, in page order. Pages
+        returned by a previous call are skipped, unless they have changed
+        again. The pages stay stale until they are reindexed.
+        '''
+        with self._lock:
+            pages = sorted(
+                (n, revision) for n, revision in self._stale.iteritems()
+                if self._taken.get(n) != revision
+            )
+            self._taken.update(pages)
+        return pages
+
+    def has_stale_pages(self):
+        return bool(self._stale)
+
+    def find(self, query):
+        '''
+        Return matches of the query phrase, in document order.
+        '''
+        query = normalize(query)
+        if not query:
+            return []
+        with self._lock:
+            page_nos = None
+            for word in set(query):
+                current_page_nos = self._word_pages.get(word, ())
+                if page_nos is None:
+                    page_nos = set(current_page_nos)
+                else:
+                    page_nos &= current_page_nos
+                if not page_nos:
+                    return []
+            entries = [(n, self._pages[n]) for n in sorted(page_nos)]
+        result = []
+        length = len(query)
+        for n, entry in entries:
+            words = entry.words
+            i = -1
+            while True:
+                try:
+                    i = words.index(query[0], i + 1)
+                except ValueError:
+                    break
+                if words[i:i + length] != query:
+                    continue
+                unit = entry.units[i]
+                rect = tuple(entry.rects[4 * unit:4 * unit + 4])
+                result += Match(n, entry.paths[unit], rect),
+        return result
+
+    def save(self, path, key):
+        '''
+        Save the index into a file. Only pages that are up to date are saved.
+        '''
+        with self._lock:
+            pages = dict((n, entry) for n, entry in self._pages.iteritems() if n not in self._stale)
+        data = dict(
+            version=FORMAT_VERSION,
+            key=list(key),
+            pages=[[n] + entry.dump() for n, entry in sorted(pages.iteritems())],
+        )
+        tmp_path = path + '.tmp'
+        file = open(tmp_path, 'wb')
+        try:
+            # The file is next to the document, so it must not be anything
+            # that could execute code when loaded, such as a pickle.
+            json.dump(data, file, separators=(',', ':'))
+            file.flush()
+            os.fsync(file.fileno())
+        finally:
+            file.close()
+        os.rename(tmp_path, path)
+
+    def load(self, path, key):
+        '''
+        Load the index from a file, unless it's out of date.
+        Return true on success.
+        '''
+        try:
+            with open(path, 'rb') as file:
+                data = json.load(file)
+            if data['version'] != FORMAT_VERSION or data['key'] != list(key):
+                return False
+            pages = {}
+            for page in data['pages']:
+                n = int(page[0])
+                pages[n] = _PageEntry.load(page[1:])
+        except (EnvironmentError, LookupError, TypeError, ValueError):
+            return False
+        with self._lock:
+            for n, entry in pages.iteritems():
+                self._remove_entry(n)
+                self._add_entry(n, entry)
+        return True
+
+def get_index_path(document_path):
+    '''
+    Return path of the file the index of the document is saved in.
+    '''
+    directory, name = os.path.split(document_path)
+    return os.path.join(directory, '.%s.djvusmooth-index' % name)
+
+def get_index_key(document_path):
+    '''
+    Return a key that changes whenever the document is modified.
+    '''
+    stat = os.stat(document_path)
+    return (stat.st_mtime, stat.st_size)
+
+def build(index, page_nos, get_sexpr, stop_event):
+    '''
+    Index pages that have not been indexed yet, until stop_event is set.
+    Return true if all the pages were indexed.
+    '''
+    for n in page_nos:
+        if stop_event.is_set():
+            return False
+        if index.has_page(n):
+            continue
+        index.index_page(n, get_sexpr(n), replace=False)
+    return True
+
+__all__ = [
+    'SearchIndex', 'Match',
+    'normalize', 'iter_units', 'get_unit_node',
+    'get_index_path', 'get_index_key', 'build',
+]
+
+# vim:ts=4 sts=4 sw=4 et
@@ -14,7 +14,10 @@
 # more details.
 
 import re
+import sys
 import functools
+import threading
+import Queue
 import warnings
 import weakref
 
@@ -149,6 +152,54 @@ def is_html_color(s):
     '''
     return bool(_is_html_color(s))
 
+def prefetch(iterable, size):
+    r'''
+    Iterate over the iterable in a background thread, keeping at most size
+    items ready in advance.
+
+    >>> list(prefetch(xrange(5), 2))
+    [0, 1, 2, 3, 4]
+    >>> def spam():
+    ...   yield 'eggs'
+    ...   raise ValueError('ham')
+    >>> list(prefetch(spam(), 1))
+    Traceback (most recent call last):
+    ...
+    ValueError: ham
+    '''
+    queue = Queue.Queue(maxsize=size)
+    stop_event = threading.Event()
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Queue.Full:
+                continue
+            return True
+        return False
+    def producer():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception:
+            put((False, sys.exc_info()))
+        else:
+            put((None, None))
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            ok, item = queue.get()
+            if ok is None:
+                return
+            if not ok:
+                raise item[0], item[1], item[2]
+            yield item
+    finally:
+        stop_event.set()
+
 class idict(object):
 
     '''
@@ -210,7 +210,7 @@ distutils.core.setup(
         ['djvusmooth.{mod}'.format(mod=mod) for mod in ['gui', 'models', 'text']]
     ),
     package_dir=dict(djvusmooth='lib'),
-    scripts=['djvusmooth'],
+    scripts=['djvusmooth', 'djvusmooth-batch'],
     data_files=data_files,
     cmdclass=dict(
         build_doc=build_doc,